@@ -0,0 +1,83 @@
+"""Shared pytest fixtures. Run from this directory: python -m pytest -q
+
+Tests never call Gemini, Firestore or Supabase: epub_report is imported with local-only backends and every test gets
+it with a fake Gemini model and the shared stores switched off (opt back in with the firestore_fake fixture).
+"""
+import asyncio
+import contextlib
+import io
+import os
+
+import pytest
+
+# Read by epub_report at import time
+os.environ.setdefault("BOOK_CACHE_BACKEND", "none")
+os.environ.setdefault("CHECKPOINT_BACKEND", "none")
+os.environ.setdefault("GEMINI_RATE_LIMIT_BACKEND", "none")
+os.environ.setdefault("JOB_QUEUE_BACKEND", "none")
+os.environ.setdefault("JOB_WORKER_MODE", "external")
+
+from epub_benchmarks import build_synthetic_epub # noqa: E402
+from firestore_fake import FakeFirestore # noqa: E402
+
+EMPTY_SECTIONS_RESPONSE = '```json\n{"sections": []}\n```'
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self.candidates = [text]
+        self.prompt_feedback = None
+        self.usage_metadata = None
+
+
+class FakeGeminiModel:
+    """Stands in for genai.GenerativeModel. respond(contents) returns the response text (or raises)."""
+
+    def __init__(self, respond=None):
+        self.respond = respond or (lambda contents: EMPTY_SECTIONS_RESPONSE)
+        self.calls = 0
+
+    def generate_content(self, contents, **kwargs):
+        self.calls += 1
+        return FakeResponse(self.respond(contents))
+
+    async def generate_content_async(self, contents, **kwargs):
+        await asyncio.sleep(0)
+        return self.generate_content(contents, **kwargs)
+
+
+@pytest.fixture
+def fake_model():
+    return FakeGeminiModel()
+
+
+@pytest.fixture
+def epub_report(monkeypatch, fake_model):
+    with contextlib.redirect_stdout(io.StringIO()): # Missing credentials are expected locally
+        import epub_report as module
+    monkeypatch.setattr(module, 'genai_initialized', True)
+    monkeypatch.setattr(module, 'db', None)
+    monkeypatch.setattr(module, 'firebase_initialized', False)
+    monkeypatch.setattr(module, 'supabase', None)
+    monkeypatch.setattr(module, 'supabase_initialized', False)
+    monkeypatch.setattr(module, 'book_result_cache', None)
+    monkeypatch.setattr(module, 'chapter_checkpoint_store', None)
+    monkeypatch.setattr(module, 'gemini_rate_limiter', None)
+    monkeypatch.setattr(module, 'job_queue', None)
+    monkeypatch.setattr(module, 'chapter_result_cache', module.ChapterResultCache(100, 3600))
+    monkeypatch.setattr(module, 'gemini_circuit_breaker', module.GeminiCircuitBreaker(
+        module.GEMINI_CIRCUIT_FAILURE_THRESHOLD, module.GEMINI_CIRCUIT_COOLDOWN_SECONDS))
+    monkeypatch.setattr(module, 'model', fake_model, raising=False)
+    monkeypatch.setattr(module, 'filter_models', module.FilterModelProvider(lambda **kwargs: fake_model))
+    return module
+
+
+@pytest.fixture
+def firestore_fake():
+    return FakeFirestore()
+
+
+@pytest.fixture(scope='session')
+def small_epub() -> bytes:
+    return build_synthetic_epub(chapters=3, paragraphs_per_chapter=8)
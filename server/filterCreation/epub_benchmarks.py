@@ -0,0 +1,1234 @@
+"""Local benchmarks for the epub_report processing pipeline.
+
+Run from this directory, e.g.:
+    python epub_benchmarks.py ingest --epub "Fourth Wing.epub"
+    python epub_benchmarks.py extract --synthetic-chapters 300
+    python epub_benchmarks.py extract-modes --synthetic-chapters 200 --workers 4
+    python epub_benchmarks.py prescreen --recorded filtered_output.json --thresholds 1 2 3
+    python epub_benchmarks.py profanity --epub "Fourth Wing.epub" --repeat 5
+    python epub_benchmarks.py filter-artifact --recorded filtered_output.json --repeat 5
+    python epub_benchmarks.py output-mode --recorded filtered_output.json
+    python epub_benchmarks.py prompt-tokens --epub "Fourth Wing.epub" --min-cache-tokens 1024
+    python epub_benchmarks.py concurrency --quota 25 --requests 2000
+    python epub_benchmarks.py pipeline-memory --sizes-mb 1 10 100
+    python epub_benchmarks.py resume --epub "Fourth Wing.epub" --kill-after 10
+    python epub_benchmarks.py status-batch --jobs 300 --missing 10
+
+Each benchmark prints a JSON summary. Nothing here calls Gemini, Firestore or Supabase
+(Gemini and Firestore are simulated where a benchmark needs them).
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import gzip
+import re
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+import zipfile
+
+DEFAULT_EPUB_PATH = "Fourth Wing.epub"
+DEFAULT_RECORDED_OUTPUT_PATH = "filtered_output.json"
+
+
+def load_epub_report():
+    """Imports epub_report without its start-up logging (missing credentials are expected locally)."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        import epub_report
+    return epub_report
+
+
+def read_proc_status_kib(field: str) -> int:
+    """Returns a memory field (e.g. VmRSS, VmHWM) from /proc/self/status in KiB."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+# === Synthetic books ===
+SYNTHETIC_WORDS = (
+    "the dragon rider crossed parapet wind storm quadrant cadet squad leader wing flight scale fire "
+    "night morning battle training gauntlet signet bond venin wards gryphon river mountain letter"
+).split()
+
+def build_synthetic_chapter(rng: random.Random, chapter_index: int, paragraphs: int) -> str:
+    """Returns one XHTML chapter with the kind of markup found in real EPUBs (inline tags, entities, comments)."""
+    body = [f'<h1 class="chapter">Chapter {chapter_index}</h1>']
+    for _ in range(paragraphs):
+        words = [rng.choice(SYNTHETIC_WORDS) for _ in range(rng.randint(40, 120))]
+        words[rng.randrange(len(words))] = f"<i>{rng.choice(SYNTHETIC_WORDS)}</i>"
+        words[rng.randrange(len(words))] = "&#8220;quoted&#8221; &amp; <b>bold</b>&nbsp;text"
+        body.append(f'<p class="calibre">{" ".join(words)}.</p>')
+        if rng.random() < 0.05:
+            body.append('<!-- page break --><br/><span class="x"></span>')
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml"><head>'
+        f'<title>Chapter {chapter_index}</title><style>p {{ margin: 0 }}</style></head>'
+        f'<body>{"".join(body)}</body></html>'
+    )
+
+
+def build_synthetic_epub(chapters: int, paragraphs_per_chapter: int = 60, seed: int = 7) -> bytes:
+    """Builds a valid EPUB (container, OPF spine, XHTML chapters) of roughly chapters * paragraphs * 500 bytes."""
+    rng = random.Random(seed)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as epub:
+        epub.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        epub.writestr('META-INF/container.xml', (
+            '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>'
+        ))
+        manifest = ['<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>']
+        spine = []
+        for i in range(chapters):
+            manifest.append(f'<item id="ch{i}" href="text/chapter_{i:04d}.xhtml" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="ch{i}"/>')
+            epub.writestr(f'OEBPS/text/chapter_{i:04d}.xhtml', build_synthetic_chapter(rng, i + 1, paragraphs_per_chapter))
+        epub.writestr('OEBPS/nav.xhtml', '<html xmlns="http://www.w3.org/1999/xhtml"><body><nav epub:type="toc"><ol><li>Contents</li></ol></nav></body></html>')
+        epub.writestr('OEBPS/content.opf', (
+            '<?xml version="1.0" encoding="utf-8"?><package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Synthetic Book</dc:title><dc:identifier id="id">synthetic</dc:identifier></metadata>'
+            f'<manifest>{"".join(manifest)}</manifest><spine>{"".join(spine)}</spine></package>'
+        ))
+    return buffer.getvalue()
+
+
+def read_epub_documents(epub_bytes: bytes) -> list:
+    """Returns (member name, decoded markup) for every HTML/XHTML member, as extract_epub_chapters sees them."""
+    with zipfile.ZipFile(io.BytesIO(epub_bytes)) as epub:
+        return [
+            (name, epub.read(name).decode('utf-8', errors='ignore'))
+            for name in epub.namelist() if name.endswith(('.xhtml', '.html'))
+        ]
+
+
+# === Ingestion: /tmp round trip vs. in-memory ===
+def run_ingest_mode(mode: str, epub_path: str) -> dict:
+    """Extracts chapters once using the given ingestion mode and reports time and peak RSS."""
+    epub_report = load_epub_report()
+    with open(epub_path, 'rb') as f:
+        epub_bytes = f.read()
+    baseline_kib = read_proc_status_kib('VmRSS')
+    tmpfs_bytes = 0
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if mode == 'tmpfile':
+            # Previous behaviour: write the upload to /tmp and reopen it by path
+            temp_epub_path = os.path.join('/tmp', f"uploaded_book_{uuid.uuid4()}.epub")
+            with open(temp_epub_path, 'wb') as f:
+                f.write(epub_bytes)
+            tmpfs_bytes = len(epub_bytes)
+            try:
+                chapters = epub_report.extract_epub_chapters(temp_epub_path)
+            finally:
+                os.remove(temp_epub_path)
+        else:
+            epub_source = epub_report.open_epub_source(epub_bytes)
+            try:
+                chapters = epub_report.extract_epub_chapters(epub_source)
+            finally:
+                epub_source.close()
+    first_chapter_seconds = time.perf_counter() - start
+
+    return {
+        'mode': mode,
+        'chapters': len(chapters),
+        'time_to_first_chapter_seconds': round(first_chapter_seconds, 4),
+        'peak_rss_delta_kib': read_proc_status_kib('VmHWM') - baseline_kib,
+        # /tmp is RAM-backed on Cloud Run, so the temp file also counts against instance memory
+        'tmpfs_bytes': tmpfs_bytes,
+    }
+
+
+def benchmark_ingest(epub_path: str) -> dict:
+    """Runs every ingestion mode in a fresh interpreter so peak RSS is not shared between modes."""
+    results = []
+    for mode in ('tmpfile', 'memory'):
+        output = subprocess.run(
+            [sys.executable, __file__, '_ingest_worker', '--mode', mode, '--epub', epub_path],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return {'epub': epub_path, 'epub_bytes': os.path.getsize(epub_path), 'results': results}
+
+
+# === HTML-to-text extraction backends ===
+# Markup that exercises the places where a tokenizer can disagree with BeautifulSoup.
+EXTRACTOR_PARITY_CASES = [
+    '<p>Hel<b>lo</b> &amp; &foo; bar&nbsp;baz &#150; &#x41; &#65x</p>',
+    '<html><head><style>p{}</style><script>var a=1<2;</script><title>T</title></head><body><!-- c -->'
+    '<p>a<br/>b<br>c</br>d</p><template><p>t</p></template><ruby>kan<rt>ji</rt></ruby></body></html>',
+    '<!DOCTYPE html><p>x<![CDATA[ cd ]]>y</p>',
+    '<p>unclosed <i>it <b>bold</p> after</i> tail',
+    '<div>  \n  </div><p> lead</p><p>a&ampb &lt;tag&gt; &AMP; &notit;</p>',
+]
+
+def check_extractor_parity(epub_report, documents: list, backend: str) -> list:
+    """Returns the names of documents whose text differs from the bs4 reference extractor."""
+    cases = documents + [(f'parity_case_{i}', markup) for i, markup in enumerate(EXTRACTOR_PARITY_CASES)]
+    extract = epub_report.HTML_TEXT_EXTRACTORS[backend]
+    return [name for name, markup in cases if extract(markup) != epub_report.extract_text_bs4(markup)]
+
+
+def benchmark_extractors(epub_path: str, synthetic_chapters: int) -> dict:
+    """Measures chars/sec of every HTML_TEXT_EXTRACTORS backend and checks parity with bs4."""
+    import warnings
+    warnings.filterwarnings('ignore', module='bs4')
+    epub_report = load_epub_report()
+    with open(epub_path, 'rb') as f:
+        books = {epub_path: f.read()}
+    books[f'synthetic ({synthetic_chapters} chapters)'] = build_synthetic_epub(synthetic_chapters)
+
+    results = []
+    for book_name, epub_bytes in books.items():
+        documents = read_epub_documents(epub_bytes)
+        for backend, extract in epub_report.HTML_TEXT_EXTRACTORS.items():
+            start = time.perf_counter()
+            total_chars = sum(len(extract(markup)) for _, markup in documents)
+            elapsed = time.perf_counter() - start
+            results.append({
+                'book': book_name,
+                'epub_bytes': len(epub_bytes),
+                'backend': backend,
+                'seconds': round(elapsed, 3),
+                'chars_per_second': int(total_chars / elapsed) if elapsed else None,
+                'parity_mismatches': check_extractor_parity(epub_report, documents, backend),
+            })
+    return {'results': results}
+
+
+# === Serial vs. process-pool extraction ===
+def benchmark_extraction_modes(synthetic_chapters: int, workers: int) -> dict:
+    """Measures time to first chapter and to the last chapter for each EXTRACTION_MODE."""
+    epub_report = load_epub_report()
+    epub_bytes = build_synthetic_epub(synthetic_chapters)
+    results = []
+    for mode in ('serial', 'process'):
+        if mode == 'process':
+            # Start the pool's workers outside the timed region, as a warm instance would have them already
+            with contextlib.redirect_stdout(io.StringIO()):
+                pool = epub_report.get_extraction_pool(workers)
+                list(pool.map(epub_report.extract_chapter_from_member, ['warm-up'] * workers, [b''] * workers,
+                              [epub_report.HTML_EXTRACTOR_BACKEND] * workers))
+        first_chapter_seconds = None
+        chapters = 0
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in epub_report.iter_epub_chapters(io.BytesIO(epub_bytes), extraction_mode=mode, workers=workers):
+                chapters += 1
+                if first_chapter_seconds is None:
+                    first_chapter_seconds = time.perf_counter() - start
+        results.append({
+            'mode': mode,
+            'workers': workers if mode == 'process' else 1,
+            'chapters': chapters,
+            'time_to_first_chapter_seconds': round(first_chapter_seconds or 0, 4),
+            'total_seconds': round(time.perf_counter() - start, 3),
+        })
+    epub_report.discard_extraction_pool(epub_report.get_extraction_pool(workers))
+    return {'epub_bytes': len(epub_bytes), 'cpu_count': os.cpu_count(), 'results': results}
+
+
+def label_chapters_from_recorded_output(chapters: list, recorded_output: dict) -> set:
+    """Returns the files of chapters containing a section Gemini flagged in a recorded run."""
+    flagged_files = set()
+    for section in recorded_output.get('sections', []):
+        section_text = ' '.join(section.get('text', '').split())
+        probes = {section_text[:60], section_text[-60:]} - {''}
+        for chapter in chapters:
+            if any(probe in chapter['text'] for probe in probes):
+                flagged_files.add(chapter['file'])
+    return flagged_files
+
+
+def evaluate_prescreen(epub_path: str, recorded_output_path: str, thresholds: list) -> dict:
+    """Precision/recall of the lexical pre-screen against recorded Gemini output, per threshold."""
+    epub_report = load_epub_report()
+    with open(epub_path, 'rb') as f:
+        epub_source = epub_report.open_epub_source(f.read())
+    with open(recorded_output_path) as f:
+        recorded_output = json.load(f)
+    with contextlib.redirect_stdout(io.StringIO()):
+        chapters = epub_report.extract_epub_chapters(epub_source)
+
+    flagged_files = label_chapters_from_recorded_output(chapters, recorded_output)
+    start = time.perf_counter()
+    scores = {chapter['file']: epub_report.prescreen_score(chapter['text']) for chapter in chapters}
+    scoring_seconds = time.perf_counter() - start
+
+    results = []
+    for threshold in thresholds:
+        sent = {file for file, score in scores.items() if threshold <= 0 or score >= threshold}
+        true_positives = len(sent & flagged_files)
+        results.append({
+            'threshold': threshold,
+            'chapters_sent': len(sent),
+            'calls_avoided_fraction': round(1 - len(sent) / len(chapters), 3) if chapters else 0,
+            'precision': round(true_positives / len(sent), 3) if sent else 0,
+            'recall': round(true_positives / len(flagged_files), 3) if flagged_files else 1.0,
+            'missed_chapters': sorted(flagged_files - sent),
+        })
+    return {
+        'chapters': len(chapters),
+        'flagged_chapters': sorted(flagged_files),
+        'scoring_seconds': round(scoring_seconds, 4),
+        'flagged_chapter_scores': {file: scores[file] for file in sorted(flagged_files)},
+        'results': results,
+    }
+
+
+# === Profanity counting ===
+# Tokens where punctuation, case and word boundaries decide whether the old loop counted a word.
+PROFANITY_PARITY_CASES = [
+    "Damn! 'Hell,' he said. DAMN-it, hell's bells, shell hello Hellfire",
+    "ass-hole Ass.Hole asses passes class a$$ f.u.c.k f*ck _damn damn_ damn2 (shit) \"shits\"",
+    "motherfuckers, MOTHERFUCKING... motherfuck\u2014cock bitch\u2019s penus? \u2018damned\u2019 damning.",
+    "hell\u00a0hell\thell\nhell \u2003hell\u2003 hell\u2014hell \u2014hell\u2014",
+]
+
+def legacy_count_swear_words(text: str, swear_words: set) -> dict:
+    """The per-token counter process_epub_from_bytes used before the single-pass ProfanityCounter."""
+    counts = {}
+    for word in text.split():
+        cleaned_word = re.sub(r'\W+', '', word).lower()
+        if cleaned_word in swear_words:
+            counts[cleaned_word] = counts.get(cleaned_word, 0) + 1
+    return counts
+
+
+def benchmark_profanity_counter(epub_path: str, repeat: int) -> dict:
+    """Times the legacy per-token counter against ProfanityCounter and checks that both give identical counts."""
+    epub_report = load_epub_report()
+    counter = epub_report.profanity_counter
+    with open(epub_path, 'rb') as f:
+        epub_source = epub_report.open_epub_source(f.read())
+    with contextlib.redirect_stdout(io.StringIO()):
+        chapters = epub_report.extract_epub_chapters(epub_source)
+    texts = [chapter['text'] for chapter in chapters]
+
+    def time_counter(count) -> tuple:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            per_chapter = [count(text) for text in texts]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        totals = {}
+        for chapter_counts in per_chapter:
+            for word, count in chapter_counts.items():
+                totals[word] = totals.get(word, 0) + count
+        return best, per_chapter, totals
+
+    legacy_seconds, legacy_chapters, legacy_totals = time_counter(lambda text: legacy_count_swear_words(text, counter.words))
+    single_pass_seconds, single_pass_chapters, single_pass_totals = time_counter(counter.count)
+    parity_mismatches = [
+        case for case in PROFANITY_PARITY_CASES if counter.count(case) != legacy_count_swear_words(case, counter.words)
+    ]
+    parity_mismatches += [
+        chapter['file'] for chapter, legacy, single_pass in zip(chapters, legacy_chapters, single_pass_chapters)
+        if legacy != single_pass
+    ]
+    offsets_consistent = all(
+        epub_report.normalize_token(text[start:end]) == word
+        for text in texts for word, spans in counter.scan(text).items() for start, end in spans
+    )
+    total_chars = sum(len(text) for text in texts)
+    return {
+        'epub': epub_path,
+        'chapters': len(texts),
+        'total_chars': total_chars,
+        'lexicon_words': len(counter.words),
+        'legacy_seconds': round(legacy_seconds, 4),
+        'single_pass_seconds': round(single_pass_seconds, 4),
+        'speedup': round(legacy_seconds / single_pass_seconds, 2) if single_pass_seconds else None,
+        'single_pass_chars_per_second': int(total_chars / single_pass_seconds) if single_pass_seconds else None,
+        'total_swear_words': sum(single_pass_totals.values()),
+        'counts_identical': legacy_totals == single_pass_totals and not parity_mismatches,
+        'offsets_consistent': offsets_consistent,
+        'parity_mismatches': parity_mismatches,
+        'counts': dict(sorted(single_pass_totals.items())),
+    }
+
+
+# === Filter artifact vs. {words, phrases, sections} ===
+def normalize_reader_text(text: str) -> str:
+    """Python port of normalizeText in Reader.tsx."""
+    import unicodedata
+    text = re.sub("[\u2018\u2019']", "'", text)
+    text = re.sub('[\u201c\u201d"]', '"', text)
+    return unicodedata.normalize('NFKC', text)
+
+
+def apply_legacy_filters(content: str, filters: dict) -> str:
+    """Python port of applyFilters in Reader.tsx: a regex per section, then per phrase, then per word."""
+    filtered = normalize_reader_text(content)
+    for section in filters['sections']:
+        pattern = re.escape(normalize_reader_text(section['start'])) + r'[\s\S]*?' + re.escape(normalize_reader_text(section['end']))
+        filtered = re.sub(pattern, lambda match: section.get('replacement', ''), filtered, flags=re.IGNORECASE)
+    for phrase in filters['phrases']:
+        filtered = re.sub(normalize_reader_text(phrase), '*' * len(phrase), filtered, flags=re.IGNORECASE)
+    for word in filters['words']:
+        filtered = re.sub(rf'\b{normalize_reader_text(word)}\b', '***', filtered, flags=re.IGNORECASE)
+    return filtered
+
+
+def apply_artifact_item(content: str, item: dict) -> str:
+    """What a client does with the artifact: one left-to-right pass over precomputed, sorted ranges."""
+    cuts = [(start, end, '') for start, end, _ in item['hide']] + [(start, end, '***') for start, end, _, _ in item['words']]
+    pieces = []
+    position = 0
+    for start, end, replacement in sorted(cuts):
+        if start < position:
+            continue # Word hit inside a hidden range
+        pieces.append(content[position:start])
+        pieces.append(replacement)
+        position = end
+    pieces.append(content[position:])
+    return ''.join(pieces)
+
+
+def resolve_cfi_point(soup, steps: str) -> str:
+    """Returns the character a CFI point (the part after '!') addresses in a bs4 DOM, or '' if it does not resolve."""
+    import bs4
+    path, _, offset = steps.rpartition(':')
+    indexes = [int(re.match(r'\d+', step).group()) for step in path.strip('/').split('/')]
+    element = soup.find('html')
+    for index in indexes[:-1]:
+        element = [child for child in element.contents if isinstance(child, bs4.Tag)][index // 2 - 1]
+    chunk, remaining, elements_seen = indexes[-1] // 2, int(offset), 0
+    for child in element.contents:
+        if isinstance(child, bs4.Tag):
+            elements_seen += 1
+        elif elements_seen == chunk and (not isinstance(child, bs4.element.PreformattedString) or isinstance(child, bs4.CData)):
+            if remaining < len(child):
+                return child[remaining]
+            remaining -= len(child)
+    return ''
+
+
+def check_artifact_cfis(epub_bytes: bytes, artifact: dict) -> dict:
+    """Resolves the start of every CFI range and compares the character with the one at the range's start offset."""
+    import bs4
+    import warnings
+    warnings.filterwarnings('ignore', module='bs4')
+    epub_report = load_epub_report()
+    with contextlib.redirect_stdout(io.StringIO()):
+        chapters = {chapter['file']: chapter['text'] for chapter in epub_report.extract_epub_chapters(io.BytesIO(epub_bytes))}
+    checked = mismatched = missing = 0
+    with zipfile.ZipFile(io.BytesIO(epub_bytes)) as epub:
+        for item in artifact['spine']:
+            soup = bs4.BeautifulSoup(epub.read(item['file']).decode('utf-8', errors='ignore'), "html.parser")
+            for start, end, cfi in [(entry[0], entry[1], entry[-1]) for entry in item['hide'] + item['words']]:
+                if cfi is None:
+                    missing += 1
+                    continue
+                parent, start_steps, _ = cfi.split(',')
+                checked += 1
+                if resolve_cfi_point(soup, parent + start_steps) != chapters[item['file']][start]:
+                    mismatched += 1
+    return {'checked': checked, 'mismatched': mismatched, 'missing': missing}
+
+
+def benchmark_filter_artifact(epub_path: str, recorded_output_path: str, repeat: int) -> dict:
+    """Compares artifact size and per-chapter apply time with the {words, phrases, sections} filter JSON."""
+    epub_report = load_epub_report()
+    with open(epub_path, 'rb') as f:
+        epub_bytes = f.read()
+    with open(recorded_output_path) as f:
+        recorded_output = json.load(f)
+    with contextlib.redirect_stdout(io.StringIO()):
+        chapters = epub_report.extract_epub_chapters(io.BytesIO(epub_bytes))
+
+    book_report = epub_report.BookReportAggregator()
+    for chapter_index, chapter in enumerate(chapters):
+        sections = [section for section in recorded_output['sections']
+                    if chapter['file'] in label_chapters_from_recorded_output([chapter], {'sections': [section]})]
+        anchored = epub_report.anchor_flagged_sections(chapter['file'], chapter['text'], sections)
+        book_report.add_chapter(chapter['file'], chapter['text'], anchored, chapter_index=chapter_index, cfi_base=chapter.get('cfi_base'))
+    start = time.perf_counter()
+    artifact = epub_report.build_filter_artifact(io.BytesIO(epub_bytes), book_report)
+    build_seconds = time.perf_counter() - start
+
+    # What the reader loads today: Cloud Run Function.py style sections plus the word list
+    legacy_filters = {
+        'words': sorted(epub_report.profanity_counter.words),
+        'phrases': [],
+        'sections': [{'start': ' '.join(section['text'].split()[:7]), 'end': ' '.join(section['text'].split()[-7:]),
+                      'replacement': ''} for section in recorded_output['sections']],
+    }
+    full_text_sections = {**legacy_filters, 'sections': recorded_output['sections']}
+
+    def size(document) -> dict:
+        encoded = json.dumps(document, separators=(',', ':')).encode('utf-8')
+        return {'json_bytes': len(encoded), 'gzip_bytes': len(gzip.compress(encoded))}
+
+    items = {item['file']: item for item in artifact['spine']}
+
+    def best_time(apply_chapter) -> float:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for chapter in chapters:
+                apply_chapter(chapter)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    legacy_seconds = best_time(lambda chapter: apply_legacy_filters(chapter['text'], legacy_filters))
+    artifact_seconds = best_time(lambda chapter: apply_artifact_item(chapter['text'], items[chapter['file']]) if chapter['file'] in items else chapter['text'])
+    return {
+        'epub': epub_path,
+        'chapters': len(chapters),
+        'artifact_spine_items': len(artifact['spine']),
+        'artifact_hide_ranges': sum(len(item['hide']) for item in artifact['spine']),
+        'artifact_word_hits': sum(len(item['words']) for item in artifact['spine']),
+        'artifact_build_seconds': round(build_seconds, 3),
+        'size': {
+            'filter_start_end_sections': size(legacy_filters),
+            'filter_full_text_sections': size(full_text_sections),
+            'artifact': size(artifact),
+        },
+        'apply_all_chapters_seconds': {
+            'legacy_regex': round(legacy_seconds, 4),
+            'artifact_ranges': round(artifact_seconds, 4),
+            'speedup': round(legacy_seconds / artifact_seconds, 1) if artifact_seconds else None,
+        },
+        'cfi_check': check_artifact_cfis(epub_bytes, artifact),
+    }
+
+
+# === Output mode: full passages vs. start/end anchors ===
+ANCHOR_SNIPPET_WORDS = 10
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))] if ordered else 0.0
+
+
+def recorded_response_sections(sections: list, output_mode: str) -> list:
+    """What Gemini returns for these sections in each output mode."""
+    if output_mode == 'full_text':
+        return [{'chapter': section['chapter'], 'text': section['text'], 'summary': section['summary']} for section in sections]
+    return [{'chapter': section['chapter'], 'start': ' '.join(section['text'].split()[:ANCHOR_SNIPPET_WORDS]),
+             'end': ' '.join(section['text'].split()[-ANCHOR_SNIPPET_WORDS:]), 'summary': section['summary']}
+            for section in sections]
+
+
+def prompt_version_for_output_mode(epub_report, output_mode: str) -> str:
+    """Registered prompt version with the given output mode and the configured instruction placement."""
+    placement = epub_report.PROMPT_VERSION_REGISTRY[epub_report.PROMPT_VERSION]['placement']
+    return epub_report.find_prompt_version(output_mode, placement)
+
+
+def measure_live_output_mode(epub_report, chapters: list, output_mode: str) -> list:
+    """Sends each chapter to Gemini in the given output mode. Returns (latency seconds, output tokens) per chapter."""
+    epub_report.PROMPT_VERSION = prompt_version_for_output_mode(epub_report, output_mode)
+    samples = []
+    for chapter in chapters:
+        start = time.perf_counter()
+        response = epub_report.filter_model().generate_content(epub_report.build_prompt(chapter['text']))
+        samples.append((time.perf_counter() - start, response.usage_metadata.candidates_token_count))
+    return samples
+
+
+def benchmark_output_mode(epub_path: str, recorded_output_path: str, first_token_seconds: float,
+                          prefill_tokens_per_second: float, decode_tokens_per_second: float, live_chapters: int) -> dict:
+    """Compares full_text and anchors output: output tokens, p50/p95 per-chapter latency and report row size.
+
+    Latency comes from a model of Gemini (time to first token + prefill + decode at fixed rates) fed with the
+    responses each mode would produce for the recorded sections, unless live_chapters > 0, in which case that many
+    chapters are sent to Gemini in both modes (needs GEMINI_API_KEY).
+    """
+    epub_report = load_epub_report()
+    with open(epub_path, 'rb') as f:
+        epub_bytes = f.read()
+    with open(recorded_output_path) as f:
+        recorded_output = json.load(f)
+    with contextlib.redirect_stdout(io.StringIO()):
+        chapters = epub_report.extract_epub_chapters(io.BytesIO(epub_bytes))
+
+    results = {}
+    anchored_by_mode = {}
+    for output_mode in ('full_text', 'anchors'):
+        epub_report.PROMPT_VERSION = prompt_version_for_output_mode(epub_report, output_mode)
+        latencies, output_tokens, stored_sections = [], [], []
+        for chapter in chapters:
+            sections = [section for section in recorded_output['sections']
+                        if chapter['file'] in label_chapters_from_recorded_output([chapter], {'sections': [section]})]
+            response_text = '```json\n' + json.dumps({'sections': recorded_response_sections(sections, output_mode)}, indent=2) + '\n```'
+            prompt_tokens = epub_report.estimate_prompt_tokens(epub_report.build_prompt(chapter['text']))
+            chapter_output_tokens = epub_report.estimate_tokens(response_text)
+            output_tokens.append(chapter_output_tokens)
+            latencies.append(first_token_seconds + prompt_tokens / prefill_tokens_per_second + chapter_output_tokens / decode_tokens_per_second)
+            stored_sections.extend(epub_report.anchor_flagged_sections(
+                chapter['file'], chapter['text'], recorded_response_sections(sections, output_mode)))
+        anchored_by_mode[output_mode] = stored_sections
+        results[output_mode] = {
+            'output_tokens': sum(output_tokens),
+            'flagged_chapter_output_tokens': sorted(tokens for tokens in output_tokens if tokens > 20)[::-1],
+            'latency_p50_seconds': round(percentile(latencies, 0.5), 3),
+            'latency_p95_seconds': round(percentile(latencies, 0.95), 3),
+            'latency_max_seconds': round(max(latencies), 3),
+            'all_flagged_sections_bytes': len(json.dumps(stored_sections)),
+            'unmatched_sections': sum(section['match_method'] == 'unmatched' for section in stored_sections),
+        }
+
+    spans = {mode: [(section['file'], section['start_offset'], section['end_offset']) for section in sections]
+             for mode, sections in anchored_by_mode.items()}
+    summary = {
+        'epub': epub_path,
+        'chapters': len(chapters),
+        'recorded_sections': len(recorded_output['sections']),
+        'latency_model': {'first_token_seconds': first_token_seconds, 'prefill_tokens_per_second': prefill_tokens_per_second,
+                          'decode_tokens_per_second': decode_tokens_per_second},
+        'results': results,
+        'reconstructed_spans_identical': spans['full_text'] == spans['anchors'],
+    }
+    if live_chapters > 0:
+        if not epub_report.genai_initialized:
+            sys.exit("Live measurement needs GEMINI_API_KEY.")
+        flagged_first = sorted(chapters, key=lambda chapter: -epub_report.prescreen_score(chapter['text']))[:live_chapters]
+        for output_mode in ('full_text', 'anchors'):
+            samples = measure_live_output_mode(epub_report, flagged_first, output_mode)
+            summary['results'][output_mode]['live'] = {
+                'chapters': len(samples),
+                'output_tokens': sum(tokens or 0 for _, tokens in samples),
+                'latency_p50_seconds': round(percentile([latency for latency, _ in samples], 0.5), 3),
+                'latency_p95_seconds': round(percentile([latency for latency, _ in samples], 0.95), 3),
+            }
+    return summary
+
+
+class SimulatedGeminiResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self.candidates = [text]
+        self.prompt_feedback = None
+
+
+class SimulatedGeminiBackend:
+    """Stands in for the Gemini model: answers after a latency, or fails with 429 above a concurrency quota."""
+
+    def __init__(self, quota: int, latency_seconds: float, rng: random.Random):
+        self.quota = quota
+        self.latency_seconds = latency_seconds
+        self.rng = rng
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    async def generate_content_async(self, messages, **kwargs):
+        from google.api_core import exceptions as google_exceptions
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            if self.in_flight > self.quota:
+                self.rejected += 1
+                await asyncio.sleep(self.latency_seconds * 0.1)
+                raise google_exceptions.ResourceExhausted("429 Quota exceeded (simulated)")
+            await asyncio.sleep(self.latency_seconds * self.rng.uniform(0.8, 1.2))
+            self.accepted += 1
+            return SimulatedGeminiResponse('```json\n{"sections": []}\n```')
+        finally:
+            self.in_flight -= 1
+
+
+# === Prompt tokens: inline instructions vs. system_instruction and cached content ===
+class FakeUsageMetadata:
+    def __init__(self, prompt_token_count: int, cached_content_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.cached_content_token_count = cached_content_token_count
+        self.candidates_token_count = candidates_token_count
+
+
+class FakeCachedContent:
+    """Stands in for genai caching.CachedContent; refuses content below the API's minimum token count."""
+    min_tokens = 1024
+
+    def __init__(self, system_instruction: str, token_count: int):
+        self.system_instruction = system_instruction
+        self.token_count = token_count
+
+    @classmethod
+    def create(cls, model: str, display_name: str = None, system_instruction: str = None, ttl=None):
+        from google.api_core import exceptions as google_exceptions
+        token_count = estimate_text_tokens(system_instruction or "")
+        if token_count < cls.min_tokens:
+            raise google_exceptions.InvalidArgument(
+                f"Cached content is too small. total_token_count={token_count}, min_total_token_count={cls.min_tokens}")
+        return cls(system_instruction, token_count)
+
+
+class FakeGenerativeModel:
+    """Local stand-in for genai.GenerativeModel that reports usage_metadata like the API.
+
+    Prompt tokens are counted with the pipeline's chars/4 estimate: system instruction plus contents, with the
+    cached part (if built from cached content) also reported as cached_content_token_count.
+    """
+
+    def __init__(self, model_name: str = None, system_instruction: str = None, cached_content: FakeCachedContent = None):
+        self.system_instruction = cached_content.system_instruction if cached_content else system_instruction
+        self.cached_tokens = cached_content.token_count if cached_content else 0
+
+    @classmethod
+    def from_cached_content(cls, cached_content: FakeCachedContent):
+        return cls(cached_content=cached_content)
+
+    async def generate_content_async(self, contents, **kwargs):
+        await asyncio.sleep(0)
+        return self.generate_content(contents, **kwargs)
+
+    def generate_content(self, contents, **kwargs):
+        text = "".join(part.get('text', '') for message in contents for part in message.get('parts', []))
+        prompt_tokens = estimate_text_tokens(text) + (estimate_text_tokens(self.system_instruction) if self.system_instruction else 0)
+        response = SimulatedGeminiResponse('```json\n{"sections": []}\n```')
+        response.usage_metadata = FakeUsageMetadata(prompt_tokens, self.cached_tokens, 8)
+        return response
+
+
+def estimate_text_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def benchmark_prompt_tokens(epub_path: str, min_cache_tokens: int) -> dict:
+    """Sends every chapter of a book (no pre-screen) through analyze_chapter_request against FakeGenerativeModel with
+    the instructions inlined (v1), as system_instruction (v2) and as system_instruction from cached content, and
+    reports the prompt tokens each configuration is billed for according to usage_metadata."""
+    epub_report = load_epub_report()
+    FakeCachedContent.min_tokens = min_cache_tokens
+    with open(epub_path, 'rb') as f:
+        with contextlib.redirect_stdout(io.StringIO()):
+            chapters = epub_report.extract_epub_chapters(io.BytesIO(f.read()))
+    requests = list(epub_report.pack_chapter_requests({**chapter, 'index': n} for n, chapter in enumerate(chapters)))
+    epub_report.genai_initialized = True
+    epub_report.gemini_rate_limiter = None
+    epub_report.model = FakeGenerativeModel(epub_report.MODEL)
+
+    configurations = {
+        'inline_instructions': ('v1', False),
+        'system_instruction': ('v2', False),
+        'system_instruction_cached': ('v2', True),
+    }
+    results = {}
+    for name, (prompt_version, use_cache) in configurations.items():
+        epub_report.PROMPT_VERSION = prompt_version
+        epub_report.filter_models = epub_report.FilterModelProvider(
+            FakeGenerativeModel, FakeCachedContent.create if use_cache else None, FakeGenerativeModel.from_cached_content)
+        job_counters = epub_report.JobCounters()
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            for request in requests:
+                epub_report.analyze_chapter_request(request, None, job_counters)
+        usage = epub_report.gemini_token_usage(job_counters)
+        results[name] = {
+            'prompt_version': prompt_version,
+            'instructions_sha256': epub_report.prompt_version_info()['instructions_sha256'][:16],
+            'prompt_tokens': usage['prompt'],
+            'cached_prompt_tokens': usage['cached_prompt'],
+            'uncached_prompt_tokens': usage['prompt'] - usage['cached_prompt'],
+            'prompt_tokens_per_request': round(usage['prompt'] / len(requests)),
+            'caches_created': epub_report.filter_models.caches_created,
+        }
+        if use_cache and not epub_report.filter_models.caches_created:
+            results[name]['cache_refused'] = next((line for line in log.getvalue().splitlines() if 'Cached content unavailable' in line), '')
+
+    before = results['inline_instructions']['uncached_prompt_tokens']
+    return {
+        'epub': epub_path,
+        'chapters': len(chapters),
+        'gemini_requests': len(requests),
+        'instruction_tokens': {version: estimate_text_tokens(entry['instructions'])
+                               for version, entry in epub_report.PROMPT_VERSION_REGISTRY.items()},
+        'min_cache_tokens': min_cache_tokens,
+        'results': results,
+        'uncached_prompt_tokens_saved': {name: before - result['uncached_prompt_tokens'] for name, result in results.items()},
+    }
+
+
+# === Memory: bounded chapter pipeline vs. unbounded dispatch ===
+def write_large_synthetic_epub(path: str, target_bytes: int, paragraphs_per_chapter: int = 60,
+                               distinct_chapters: int = 40, seed: int = 7) -> int:
+    """Writes a synthetic EPUB of at least target_bytes to path, chapter by chapter. Returns the chapter count.
+
+    Chapter bodies cycle through distinct_chapters generated ones; headings differ, so no two chapter texts are equal.
+    """
+    rng = random.Random(seed)
+    bodies = [build_synthetic_chapter(rng, 0, paragraphs_per_chapter) for _ in range(distinct_chapters)]
+    spine_count = 0
+    with open(path, 'wb') as f, zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as epub:
+        epub.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        epub.writestr('META-INF/container.xml', (
+            '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>'
+        ))
+        while f.tell() < target_bytes:
+            body = bodies[spine_count % distinct_chapters].replace('Chapter 0<', f'Chapter {spine_count + 1}<')
+            epub.writestr(f'OEBPS/text/chapter_{spine_count:06d}.xhtml', body)
+            spine_count += 1
+        epub.writestr('OEBPS/content.opf', (
+            '<?xml version="1.0" encoding="utf-8"?><package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Synthetic Book</dc:title><dc:identifier id="id">synthetic</dc:identifier></metadata>'
+            '<manifest>' + ''.join(f'<item id="ch{i}" href="text/chapter_{i:06d}.xhtml" media-type="application/xhtml+xml"/>' for i in range(spine_count)) +
+            '</manifest><spine>' + ''.join(f'<itemref idref="ch{i}"/>' for i in range(spine_count)) + '</spine></package>'
+        ))
+    return spine_count
+
+
+class SlowFakeGenerativeModel(FakeGenerativeModel):
+    """FakeGenerativeModel that takes latency_seconds per request, so requests queue up behind extraction as they do
+    against the real API (seconds per request, far slower than parsing a chapter)."""
+    latency_seconds = 0.2
+
+    async def generate_content_async(self, contents, **kwargs):
+        await asyncio.sleep(SlowFakeGenerativeModel.latency_seconds)
+        return super().generate_content(contents, **kwargs)
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(SlowFakeGenerativeModel.latency_seconds)
+        return super().generate_content(contents, **kwargs)
+
+
+def run_pipeline_memory(epub_path: str, max_chapters_in_flight: int, latency_ms: int) -> dict:
+    """Runs process_epub_from_bytes once against SlowFakeGenerativeModel and reports peak RSS above the loaded upload.
+
+    Concurrency is fixed at MAX_CONCURRENT_CHAPTERS so the fake's throughput stays below the extraction rate.
+    """
+    epub_report = load_epub_report()
+    epub_report.genai_initialized = True
+    epub_report.gemini_rate_limiter = None
+    epub_report.book_result_cache = None # An earlier run's result must not answer this one
+    epub_report.chapter_checkpoint_store = None
+    epub_report.PRESCREEN_THRESHOLD = 0 # Every chapter goes through Gemini: the worst case for memory
+    epub_report.BUILD_FILTER_ARTIFACT = False
+    epub_report.MAX_CHAPTERS_IN_FLIGHT = max_chapters_in_flight
+    epub_report.ADAPTIVE_CONCURRENCY = False
+    SlowFakeGenerativeModel.latency_seconds = latency_ms / 1000
+    epub_report.model = SlowFakeGenerativeModel(epub_report.MODEL)
+    epub_report.filter_models = epub_report.FilterModelProvider(SlowFakeGenerativeModel)
+    with open(epub_path, 'rb') as f:
+        epub_bytes = f.read()
+    baseline_kib = read_proc_status_kib('VmRSS')
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as log, contextlib.redirect_stdout(log): # Per-chapter log lines would grow a StringIO
+        result = epub_report.process_epub_from_bytes(epub_bytes, f"memory-{uuid.uuid4()}", user_id=None, file_name=None)
+    return {
+        'max_chapters_in_flight': max_chapters_in_flight,
+        'chapters': result.get('totalBookChapters'),
+        'text_mib': round(result.get('totalBookCharacters', 0) / 2 ** 20, 1),
+        'peak_rss_mib': round(read_proc_status_kib('VmHWM') / 1024, 1),
+        'peak_rss_above_upload_mib': round((read_proc_status_kib('VmHWM') - baseline_kib) / 1024, 1),
+        'elapsed_seconds': round(time.perf_counter() - start, 1),
+    }
+
+
+def benchmark_pipeline_memory(sizes_mb: list, max_chapters_in_flight: int, include_unbounded: bool, latency_ms: int) -> dict:
+    """Processes synthetic books of each size in a fresh interpreter, bounded and (optionally) unbounded.
+
+    Peak RSS above the upload is what the pipeline itself holds; the upload bytes are held by the caller either way.
+    """
+    bounds = [max_chapters_in_flight] + ([10 ** 9] if include_unbounded else [])
+    results = []
+    for size_mb in sizes_mb:
+        epub_path = os.path.join('/tmp', f"synthetic_{size_mb}mb_{uuid.uuid4().hex[:8]}.epub")
+        try:
+            spine_count = write_large_synthetic_epub(epub_path, size_mb * 2 ** 20)
+            for bound in bounds:
+                output = subprocess.run(
+                    [sys.executable, __file__, '_pipeline_memory_worker', '--epub', epub_path, '--max-in-flight', str(bound),
+                     '--latency-ms', str(latency_ms)],
+                    check=True, capture_output=True, text=True
+                ).stdout
+                results.append({'epub_mib': round(os.path.getsize(epub_path) / 2 ** 20, 1), 'spine_documents': spine_count,
+                                **json.loads(output.strip().splitlines()[-1])})
+        finally:
+            os.remove(epub_path)
+    return {'fake_request_latency_ms': latency_ms, 'results': results}
+
+
+# === Resumable jobs: kill mid-book, resubmit with the same job_id ===
+class FlaggingFakeModel(FakeGenerativeModel):
+    """FakeGenerativeModel that flags the first words of every chapter or segment it is sent after a simulated request
+    latency, and ends the process (like an instance being killed) during request kill_after + 1."""
+    kill_after = -1
+    latency_seconds = 0.05
+    calls = 0
+
+    def _start_request(self) -> bool:
+        FlaggingFakeModel.calls += 1
+        return 0 <= FlaggingFakeModel.kill_after < FlaggingFakeModel.calls
+
+    def _flagged_response(self, contents, **kwargs):
+        text = "".join(part.get('text', '') for message in contents for part in message.get('parts', []))
+        segments = re.findall(r'<<<SEGMENT (\d+)>>>\n(.*?)\n<<<END SEGMENT', text, re.DOTALL)
+        if not segments:
+            segments = [('1', text.split('Chapter:', 1)[-1].strip().strip('"').strip())]
+        sections = [{'chapter': f"Segment {number}", 'text': ' '.join(segment_text.split()[:12]),
+                     'summary': "synthetic", 'segment': int(number)} for number, segment_text in segments]
+        response = super().generate_content(contents, **kwargs)
+        response.text = '```json\n' + json.dumps({'sections': sections}) + '\n```'
+        return response
+
+    async def generate_content_async(self, contents, **kwargs):
+        killed = self._start_request()
+        await asyncio.sleep(FlaggingFakeModel.latency_seconds)
+        if killed:
+            os._exit(137)
+        return self._flagged_response(contents, **kwargs)
+
+    def generate_content(self, contents, **kwargs):
+        killed = self._start_request()
+        time.sleep(FlaggingFakeModel.latency_seconds)
+        if killed:
+            os._exit(137)
+        return self._flagged_response(contents, **kwargs)
+
+
+def run_resume_attempt(epub_path: str, job_id: str, checkpoint_path: str, kill_after: int) -> dict:
+    """One attempt at a job: process_epub_from_bytes with SQLite checkpoints and FlaggingFakeModel."""
+    epub_report = load_epub_report()
+    epub_report.genai_initialized = True
+    epub_report.gemini_rate_limiter = None
+    epub_report.book_result_cache = None # A finished reference run must not answer the resumed one
+    epub_report.chapter_checkpoint_store = epub_report.SQLiteChapterCheckpointStore(checkpoint_path)
+    FlaggingFakeModel.kill_after = kill_after
+    epub_report.model = FlaggingFakeModel(epub_report.MODEL)
+    epub_report.filter_models = epub_report.FilterModelProvider(FlaggingFakeModel)
+    with open(epub_path, 'rb') as f:
+        epub_bytes = f.read()
+    with open(os.devnull, 'w') as log, contextlib.redirect_stdout(log):
+        result = epub_report.process_epub_from_bytes(epub_bytes, job_id, user_id=None, file_name=None)
+    return {
+        'result': result,
+        'gemini_calls': FlaggingFakeModel.calls,
+        'checkpoints_left': len(epub_report.chapter_checkpoint_store.load(job_id)),
+    }
+
+
+def benchmark_resume(epub_path: str, kill_after: int) -> dict:
+    """Runs a job uninterrupted, then runs it again under a new job_id killed after kill_after Gemini requests and
+    resubmitted with the same job_id. Reports recovered vs. recomputed chapters, Gemini calls per attempt and whether
+    the resumed result matches the uninterrupted one."""
+    checkpoint_path = os.path.join('/tmp', f"resume_checkpoints_{uuid.uuid4().hex[:8]}.sqlite3")
+    job_id = f"resume-{uuid.uuid4().hex[:8]}"
+
+    def attempt(attempt_job_id: str, attempt_kill_after: int):
+        completed = subprocess.run(
+            [sys.executable, __file__, '_resume_worker', '--epub', epub_path, '--job-id', attempt_job_id,
+             '--checkpoints', checkpoint_path, '--kill-after', str(attempt_kill_after)],
+            capture_output=True, text=True
+        )
+        lines = completed.stdout.strip().splitlines()
+        return completed.returncode, json.loads(lines[-1]) if completed.returncode == 0 and lines else None
+
+    try:
+        _, reference = attempt(f"reference-{job_id}", -1)
+        killed_returncode, _ = attempt(job_id, kill_after)
+        _, resumed = attempt(job_id, -1)
+    finally:
+        os.remove(checkpoint_path)
+
+    def comparable(result):
+        return {key: value for key, value in result.items() if key not in ('job_id', 'chaptersRecovered', 'chaptersRecomputed')}
+
+    return {
+        'epub': epub_path,
+        'reference_gemini_calls': reference['gemini_calls'],
+        'killed_attempt': {'gemini_calls_before_kill': kill_after, 'returncode': killed_returncode},
+        'resumed_attempt': {
+            'gemini_calls': resumed['gemini_calls'],
+            'chapters_recovered': resumed['result'].get('chaptersRecovered', 0),
+            'chapters_recomputed': resumed['result'].get('chaptersRecomputed'),
+            'checkpoints_left_after_success': resumed['checkpoints_left'],
+        },
+        'resumed_result_matches_reference': comparable(resumed['result']) == comparable(reference['result']),
+    }
+
+
+def simulate_adaptive_concurrency(quota: int, requests: int, initial_limit: int, latency_seconds: float) -> dict:
+    """Drives the AIMD limiter against a simulated backend with a fixed concurrency quota."""
+    epub_report = load_epub_report()
+    backend = SimulatedGeminiBackend(quota, latency_seconds, random.Random(7))
+    epub_report.model = backend
+    epub_report.filter_models = epub_report.FilterModelProvider(lambda **kwargs: backend)
+    epub_report.genai_initialized = True
+    epub_report.RETRY_BASE_DELAY_SECONDS = latency_seconds
+    limiter = epub_report.AdaptiveConcurrencyLimiter(initial_limit, 1, 4 * quota, latency_seconds * 10)
+    limit_samples = []
+
+    async def sample_limit(stop: asyncio.Event):
+        while not stop.is_set():
+            limit_samples.append(limiter.limit)
+            await asyncio.sleep(latency_seconds / 2)
+
+    async def run_all():
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(sample_limit(stop))
+        results = await asyncio.gather(*(
+            epub_report.send_prompt_to_gemini_async([], f"request {n}", None, limiter, deadline_seconds=3600)
+            for n in range(requests)
+        ))
+        stop.set()
+        await sampler
+        return results
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = asyncio.run(run_all())
+    elapsed = time.perf_counter() - start
+    steady_samples = limit_samples[len(limit_samples) // 2:] or limit_samples
+    return {
+        'quota': quota,
+        'requests': requests,
+        'initial_limit': initial_limit,
+        'failed_requests': sum(result is None for result in results),
+        'final_limit': limiter.limit,
+        'peak_limit': limiter.peak_limit,
+        'steady_state_mean_limit': round(sum(steady_samples) / len(steady_samples), 2),
+        'backend_peak_in_flight': backend.peak_in_flight,
+        'rejected_attempts': backend.rejected,
+        'rejected_fraction': round(backend.rejected / (backend.accepted + backend.rejected), 4),
+        'limit_trace': limit_samples[::max(1, len(limit_samples) // 40)],
+        'elapsed_seconds': round(elapsed, 2),
+        'throughput_per_second': round(requests / elapsed, 1),
+    }
+
+
+class SimulatedFirestoreSnapshot:
+    def __init__(self, doc_id: str, data):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class SimulatedFirestoreDocument:
+    def __init__(self, db, doc_id: str):
+        self.db = db
+        self.id = doc_id
+
+    def get(self):
+        self.db.record_round_trip(1)
+        return SimulatedFirestoreSnapshot(self.id, self.db.documents.get(self.id))
+
+
+class SimulatedFirestore:
+    """Stands in for the Firestore client: one collection of documents, counting round trips and document reads."""
+
+    def __init__(self, round_trip_seconds: float):
+        self.round_trip_seconds = round_trip_seconds
+        self.documents = {}
+        self.round_trips = 0
+        self.document_reads = 0
+
+    def record_round_trip(self, documents: int) -> None:
+        self.round_trips += 1
+        self.document_reads += documents
+        time.sleep(self.round_trip_seconds)
+
+    def collection(self, name: str):
+        return self
+
+    def document(self, doc_id: str):
+        return SimulatedFirestoreDocument(self, doc_id)
+
+    def get_all(self, refs, field_paths=None):
+        self.record_round_trip(len(refs))
+        return [SimulatedFirestoreSnapshot(ref.id, self.documents.get(ref.id)) for ref in refs]
+
+
+def build_status_document(job_id: str, progress: int) -> dict:
+    """A status document shaped like the ones process_epub_from_bytes writes."""
+    status = {
+        'status': 'completed' if progress == 100 else 'processing',
+        'progress': progress,
+        'current_step': 'Processing complete.' if progress == 100 else f'Analyzing chapters ({progress}%)',
+        'job_id': job_id,
+        'user_id': str(uuid.uuid4()),
+        'file_name': 'Some Book.epub',
+        'last_updated': datetime.datetime.now(datetime.timezone.utc),
+        'gemini_concurrency_limit': 10,
+        'chapter_cache': {'hits': 3, 'misses': 40, 'gemini_requests': 34},
+    }
+    if progress == 100:
+        status['results_summary'] = {'totalChapters': 43, 'affectedChapterCount': 5, 'swearWordsCount': 212, 'percentageFiltered': 1.8}
+        status['processing_metrics'] = {'total_ms': 48211, 'gemini_ms': 45310, 'status_writes': 9, 'prescreen_skipped': 9}
+    return status
+
+
+def benchmark_status_batch(jobs: int, missing: int, round_trip_seconds: float) -> dict:
+    """Compares per-ID get_epub_status calls with one batch call: response bytes, round trips and document reads."""
+    import firebase_admin
+    from firebase_admin import firestore
+    from flask import Flask, request
+
+    db = SimulatedFirestore(round_trip_seconds)
+    firebase_admin._apps.setdefault('[DEFAULT]', object()) # Skip credential lookup; the simulated client is used instead
+    firestore.client = lambda *args, **kwargs: db
+    with contextlib.redirect_stdout(io.StringIO()):
+        import get_epub_status
+
+    rng = random.Random(7)
+    job_ids = [str(uuid.uuid4()) for _ in range(jobs)]
+    for job_id in job_ids[missing:]:
+        db.documents[job_id] = build_status_document(job_id, rng.choice((10, 40, 70, 100)))
+    app = Flask(__name__)
+    app.add_url_rule('/', 'status', lambda: get_epub_status.get_epub_status(request), methods=['GET', 'POST'])
+    client = app.test_client()
+
+    def measure(send_requests) -> dict:
+        get_epub_status.status_cache = get_epub_status.StatusCache(0) # Every lookup goes to Firestore
+        db.round_trips = db.document_reads = 0
+        start = time.perf_counter()
+        responses = send_requests()
+        return {
+            'http_requests': len(responses),
+            'response_bytes': sum(len(response.get_data()) for response in responses),
+            'firestore_round_trips': db.round_trips,
+            'firestore_document_reads': db.document_reads,
+            'elapsed_seconds': round(time.perf_counter() - start, 3),
+        }
+
+    per_id = measure(lambda: [client.get('/', query_string={'job_id': job_id}) for job_id in job_ids])
+    batch = measure(lambda: [client.post('/', json={'job_ids': job_ids})])
+    batch_response = client.post('/', json={'job_ids': job_ids}).get_json()
+    return {
+        'jobs': jobs,
+        'missing_jobs': missing,
+        'simulated_round_trip_seconds': round_trip_seconds,
+        'per_id': per_id,
+        'batch': batch,
+        'batch_not_found_entries': sum(entry['status'] == 'not_found' for entry in batch_response['jobs'].values()),
+        'response_size_ratio': round(batch['response_bytes'] / per_id['response_bytes'], 3),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the epub_report pipeline.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest_parser = subparsers.add_parser('ingest', help="Compare /tmp round trip and in-memory EPUB ingestion.")
+    ingest_parser.add_argument('--epub', default=DEFAULT_EPUB_PATH)
+
+    extract_parser = subparsers.add_parser('extract', help="Compare HTML-to-text backends (speed and parity with bs4).")
+    extract_parser.add_argument('--epub', default=DEFAULT_EPUB_PATH)
+    extract_parser.add_argument('--synthetic-chapters', type=int, default=300)
+
+    modes_parser = subparsers.add_parser('extract-modes', help="Compare serial and process-pool chapter extraction.")
+    modes_parser.add_argument('--synthetic-chapters', type=int, default=200)
+    modes_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+
+    prescreen_parser = subparsers.add_parser('prescreen', help="Evaluate the lexical pre-screen against recorded Gemini output.")
+    prescreen_parser.add_argument('--epub', default=DEFAULT_EPUB_PATH)
+    prescreen_parser.add_argument('--recorded', default=DEFAULT_RECORDED_OUTPUT_PATH)
+    prescreen_parser.add_argument('--thresholds', type=float, nargs='+', default=[0, 1, 2, 3, 5])
+
+    profanity_parser = subparsers.add_parser('profanity', help="Compare the legacy and single-pass swear word counters.")
+    profanity_parser.add_argument('--epub', default=DEFAULT_EPUB_PATH)
+    profanity_parser.add_argument('--repeat', type=int, default=5, help="Best-of-N timing.")
+
+    artifact_parser = subparsers.add_parser('filter-artifact', help="Compare the filter artifact with the {words, phrases, sections} JSON.")
+    artifact_parser.add_argument('--epub', default=DEFAULT_EPUB_PATH)
+    artifact_parser.add_argument('--recorded', default=DEFAULT_RECORDED_OUTPUT_PATH)
+    artifact_parser.add_argument('--repeat', type=int, default=5, help="Best-of-N timing.")
+
+    output_mode_parser = subparsers.add_parser('output-mode', help="Compare full-text and anchor-only Gemini output.")
+    output_mode_parser.add_argument('--epub', default=DEFAULT_EPUB_PATH)
+    output_mode_parser.add_argument('--recorded', default=DEFAULT_RECORDED_OUTPUT_PATH)
+    output_mode_parser.add_argument('--first-token-seconds', type=float, default=0.6)
+    output_mode_parser.add_argument('--prefill-tps', type=float, default=20000, help="Modelled prompt tokens per second.")
+    output_mode_parser.add_argument('--decode-tps', type=float, default=150, help="Modelled output tokens per second.")
+    output_mode_parser.add_argument('--live-chapters', type=int, default=0, help="Also time this many chapters against Gemini.")
+
+    prompt_tokens_parser = subparsers.add_parser('prompt-tokens', help="Compare prompt tokens per book with inline, system and cached instructions.")
+    prompt_tokens_parser.add_argument('--epub', default=DEFAULT_EPUB_PATH)
+    prompt_tokens_parser.add_argument('--min-cache-tokens', type=int, default=1024, help="Smallest cached content the fake API accepts.")
+
+    concurrency_parser = subparsers.add_parser('concurrency', help="Run the adaptive concurrency limiter against a simulated quota.")
+    concurrency_parser.add_argument('--quota', type=int, default=25)
+    concurrency_parser.add_argument('--requests', type=int, default=2000)
+    concurrency_parser.add_argument('--initial-limit', type=int, default=10)
+    concurrency_parser.add_argument('--latency', type=float, default=0.05, help="Simulated seconds per successful request.")
+
+    status_batch_parser = subparsers.add_parser('status-batch', help="Compare per-ID and batch get_epub_status lookups.")
+    status_batch_parser.add_argument('--jobs', type=int, default=300)
+    status_batch_parser.add_argument('--missing', type=int, default=10)
+    status_batch_parser.add_argument('--round-trip', type=float, default=0.02, help="Simulated seconds per Firestore round trip.")
+
+    pipeline_memory_parser = subparsers.add_parser('pipeline-memory', help="Peak RSS of the chapter pipeline as book size grows.")
+    pipeline_memory_parser.add_argument('--sizes-mb', type=int, nargs='+', default=[1, 10, 100])
+    pipeline_memory_parser.add_argument('--max-in-flight', type=int, default=64, help="MAX_CHAPTERS_IN_FLIGHT for the bounded run.")
+    pipeline_memory_parser.add_argument('--no-unbounded', action='store_true', help="Skip the unbounded comparison runs.")
+    pipeline_memory_parser.add_argument('--latency-ms', type=int, default=200, help="Simulated Gemini latency per request.")
+
+    pipeline_memory_worker_parser = subparsers.add_parser('_pipeline_memory_worker')
+    pipeline_memory_worker_parser.add_argument('--epub', required=True)
+    pipeline_memory_worker_parser.add_argument('--max-in-flight', type=int, required=True)
+    pipeline_memory_worker_parser.add_argument('--latency-ms', type=int, required=True)
+
+    resume_parser = subparsers.add_parser('resume', help="Kill a job mid-book and resume it from chapter checkpoints.")
+    resume_parser.add_argument('--epub', default=DEFAULT_EPUB_PATH)
+    resume_parser.add_argument('--kill-after', type=int, default=10, help="Gemini requests before the first attempt is killed.")
+
+    resume_worker_parser = subparsers.add_parser('_resume_worker')
+    resume_worker_parser.add_argument('--epub', required=True)
+    resume_worker_parser.add_argument('--job-id', required=True)
+    resume_worker_parser.add_argument('--checkpoints', required=True)
+    resume_worker_parser.add_argument('--kill-after', type=int, default=-1)
+
+    ingest_worker_parser = subparsers.add_parser('_ingest_worker')
+    ingest_worker_parser.add_argument('--mode', choices=('tmpfile', 'memory'), required=True)
+    ingest_worker_parser.add_argument('--epub', default=DEFAULT_EPUB_PATH)
+
+    args = parser.parse_args()
+    if args.command == 'ingest':
+        print(json.dumps(benchmark_ingest(args.epub), indent=2))
+    elif args.command == 'extract':
+        summary = benchmark_extractors(args.epub, args.synthetic_chapters)
+        print(json.dumps(summary, indent=2))
+        if any(result['parity_mismatches'] for result in summary['results']):
+            sys.exit("Extractor output differs from the bs4 reference.")
+    elif args.command == 'extract-modes':
+        print(json.dumps(benchmark_extraction_modes(args.synthetic_chapters, args.workers), indent=2))
+    elif args.command == 'prescreen':
+        print(json.dumps(evaluate_prescreen(args.epub, args.recorded, args.thresholds), indent=2))
+    elif args.command == 'profanity':
+        summary = benchmark_profanity_counter(args.epub, args.repeat)
+        print(json.dumps(summary, indent=2))
+        if not summary['counts_identical'] or not summary['offsets_consistent']:
+            sys.exit("Single-pass swear word counts differ from the legacy counter.")
+    elif args.command == 'filter-artifact':
+        summary = benchmark_filter_artifact(args.epub, args.recorded, args.repeat)
+        print(json.dumps(summary, indent=2))
+        if summary['cfi_check']['mismatched']:
+            sys.exit("Some artifact CFIs do not resolve to the text at their offsets.")
+    elif args.command == 'output-mode':
+        print(json.dumps(benchmark_output_mode(args.epub, args.recorded, args.first_token_seconds, args.prefill_tps,
+                                               args.decode_tps, args.live_chapters), indent=2))
+    elif args.command == 'prompt-tokens':
+        print(json.dumps(benchmark_prompt_tokens(args.epub, args.min_cache_tokens), indent=2))
+    elif args.command == 'concurrency':
+        print(json.dumps(simulate_adaptive_concurrency(args.quota, args.requests, args.initial_limit, args.latency), indent=2))
+    elif args.command == 'status-batch':
+        print(json.dumps(benchmark_status_batch(args.jobs, args.missing, args.round_trip), indent=2))
+    elif args.command == 'pipeline-memory':
+        print(json.dumps(benchmark_pipeline_memory(args.sizes_mb, args.max_in_flight, not args.no_unbounded, args.latency_ms), indent=2))
+    elif args.command == '_pipeline_memory_worker':
+        print(json.dumps(run_pipeline_memory(args.epub, args.max_in_flight, args.latency_ms)))
+    elif args.command == 'resume':
+        print(json.dumps(benchmark_resume(args.epub, args.kill_after), indent=2))
+    elif args.command == '_resume_worker':
+        print(json.dumps(run_resume_attempt(args.epub, args.job_id, args.checkpoints, args.kill_after)))
+    elif args.command == '_ingest_worker':
+        print(json.dumps(run_ingest_mode(args.mode, args.epub)))
@@ -2,25 +2,105 @@ import functions_framework
 import requests # Still needed if you keep the URL path, but will be removed for the new file upload path
 import json
 import re
+import io # In-memory EPUB ingestion
+import tempfile # Spooled fallback for very large uploads
 import zipfile
 import bs4
-import os # Need os for file operations and cleanup
-import uuid # To generate unique temporary filenames
-from typing import List, Dict
+import html # Character reference decoding for the streaming extractor
+from html.parser import HTMLParser # Tokenizer for the streaming extractor
+from html.entities import html5 as HTML5_ENTITIES
+import os # Need os for environment configuration
+import uuid # To generate job IDs
+import hashlib # For content-addressed result caching
+import sqlite3 # Local result cache backend
+import threading # Guards shared caches across worker threads
+import asyncio # Async Gemini dispatch
+from typing import List, Dict, Optional, Union, BinaryIO, Callable, Iterable, Tuple
+import queue # Hands chapter events from the processing thread to a streaming response
+from collections import OrderedDict # LRU ordering for the chapter result cache
+import copy # Cached sections are handed out as copies
 import google.generativeai as genai
+from google.generativeai import caching as genai_caching # Explicit cached content for the filter instructions
+import datetime # Cached content TTL
+import textwrap # System instructions are sent without the prompt's source indentation
+from google.api_core import exceptions as google_exceptions # Rate-limit and overload error types
 import time # Added for retry delay
 import random # Added for jitter in retries
-from concurrent.futures import ThreadPoolExecutor, as_completed # Added for parallel processing
+import multiprocessing # Start method for the extraction process pool
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED, ALL_COMPLETED # Added for parallel processing
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque # In-order window over extraction futures
+import itertools
+import difflib # Fuzzy alignment of flagged sections against chapter text
+import posixpath # EPUB member paths are always '/'-separated
+import urllib.parse # OPF hrefs are URL-encoded
+import xml.etree.ElementTree as ET # container.xml and OPF package parsing
 import firebase_admin # Added for Firestore
 from firebase_admin import credentials, firestore # Added for Firestore
 from supabase import create_client, Client # Added for Supabase
+from profanity import init_profanity_counter, normalize_token # Swear-word counting, shared with gemini_filter_CLI
 
 # === CONFIGURATION ===
 MODEL = "gemini-2.5-flash-preview-04-17"
 # GEMINI_API_KEY will come from environment variable in Cloud Run/Cloud Functions
 MAX_API_RETRIES = 3
 RETRY_BASE_DELAY_SECONDS = 5
-MAX_CONCURRENT_CHAPTERS = 10 # Max chapters to process in parallel
+MAX_CONCURRENT_CHAPTERS = 10 # Max chapters to process in parallel (thread dispatch); starting limit for adaptive async dispatch
+MAX_CHAPTERS_IN_FLIGHT = int(os.environ.get("MAX_CHAPTERS_IN_FLIGHT", "64")) # Extracted chapters held per job until aggregated; extraction pauses at this bound
+ADAPTIVE_CONCURRENCY = os.environ.get("ADAPTIVE_CONCURRENCY", "true").lower() == "true" # Async dispatch: grow/shrink the limit with AIMD
+MIN_CONCURRENT_REQUESTS = int(os.environ.get("MIN_CONCURRENT_REQUESTS", "1"))
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "64"))
+CONCURRENCY_LATENCY_TARGET_SECONDS = float(os.environ.get("CONCURRENCY_LATENCY_TARGET_SECONDS", "30")) # Slower successes stop the limit growing
+CONCURRENCY_DECREASE_FACTOR = 0.75 # Multiplicative decrease on rate-limit or deadline errors
+GEMINI_OUTPUT_MODE = os.environ.get("GEMINI_OUTPUT_MODE", "full_text") # full_text (Gemini echoes each passage) or anchors (start/end snippets only)
+GEMINI_SYSTEM_INSTRUCTION = os.environ.get("GEMINI_SYSTEM_INSTRUCTION", "true").lower() == "true" # Static filter instructions go in the model's system_instruction, not every user turn
+GEMINI_CONTEXT_CACHE = os.environ.get("GEMINI_CONTEXT_CACHE", "false").lower() == "true" # Also store them as explicit cached content (model must support caching)
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600")) # Cached content is recreated shortly before this runs out
+PROMPT_VERSION = ("v2" if GEMINI_SYSTEM_INSTRUCTION else "v1") + ("-anchors" if GEMINI_OUTPUT_MODE == "anchors" else "") # Key into PROMPT_VERSION_REGISTRY; register a new version whenever the prompt changes
+BOOK_CACHE_BACKEND = os.environ.get("BOOK_CACHE_BACKEND", "supabase") # supabase (shared report_cache table), firestore, sqlite (this instance only) or none
+BOOK_CACHE_SQLITE_PATH = os.environ.get("BOOK_CACHE_SQLITE_PATH", "/tmp/epub_report_cache.sqlite3") # /tmp is instance memory on Cloud Functions
+BOOK_CACHE_SQLITE_MAX_ENTRIES = int(os.environ.get("BOOK_CACHE_SQLITE_MAX_ENTRIES", "200")) # Oldest entries are evicted beyond this
+CHAPTER_CACHE_MAX_ENTRIES = int(os.environ.get("CHAPTER_CACHE_MAX_ENTRIES", "5000")) # LRU bound for the per-chapter cache
+CHAPTER_CACHE_TTL_SECONDS = int(os.environ.get("CHAPTER_CACHE_TTL_SECONDS", str(7 * 24 * 3600))) # Per-chapter cache entry lifetime
+CHECKPOINT_BACKEND = os.environ.get("CHECKPOINT_BACKEND", "firestore") # firestore (epub_process_status/<job_id>/chapters), sqlite or none
+CHECKPOINT_SQLITE_PATH = os.environ.get("CHECKPOINT_SQLITE_PATH", "/tmp/epub_report_checkpoints.sqlite3")
+EPUB_SPOOL_THRESHOLD_BYTES = int(os.environ.get("EPUB_SPOOL_THRESHOLD_BYTES", str(64 * 1024 * 1024))) # Larger uploads are spooled to a temp file
+HTML_EXTRACTOR_BACKEND = os.environ.get("HTML_EXTRACTOR_BACKEND", "stream") # stream (fast) or bs4 (reference)
+EXTRACTION_MODE = os.environ.get("EXTRACTION_MODE", "serial") # serial, or process to parse chapters across a process pool
+EXTRACTION_WORKERS = int(os.environ.get("EXTRACTION_WORKERS", str(os.cpu_count() or 1))) # Process pool size for EXTRACTION_MODE=process
+EXTRACTION_START_METHOD = os.environ.get("EXTRACTION_START_METHOD", "forkserver") # forkserver or spawn; not fork, which can deadlock children while gRPC/Firestore threads run
+MIN_CHAPTER_CHARS = int(os.environ.get("MIN_CHAPTER_CHARS", "1")) # Shorter documents are skipped; short chapters are packed, not dropped
+GEMINI_REQUEST_TOKEN_BUDGET = int(os.environ.get("GEMINI_REQUEST_TOKEN_BUDGET", "12000")) # Max estimated chapter tokens per Gemini request
+SMALL_CHAPTER_TOKENS = int(os.environ.get("SMALL_CHAPTER_TOKENS", "2000")) # Chapters up to this size are packed together
+CHARS_PER_TOKEN_ESTIMATE = 4 # Rough English average for Gemini tokenizers
+SECTION_ANCHOR_MIN_CONFIDENCE = float(os.environ.get("SECTION_ANCHOR_MIN_CONFIDENCE", "0.6")) # Fuzzy matches below this are left for re-query
+SECTION_ANCHOR_NGRAM_WORDS = 5 # Word n-gram length used to find fuzzy match candidates
+BUILD_FILTER_ARTIFACT = os.environ.get("BUILD_FILTER_ARTIFACT", "true").lower() == "true" # Precomputed hide ranges/CFIs saved with the report
+PROFANITY_LEXICON_PATH = os.environ.get("PROFANITY_LEXICON_PATH", "") # One word per line; empty uses the built-in SWEAR_WORDS
+GEMINI_RATE_LIMIT_BACKEND = os.environ.get("GEMINI_RATE_LIMIT_BACKEND", "memory") # memory, sqlite, firestore or none
+GEMINI_RATE_LIMIT_SQLITE_PATH = os.environ.get("GEMINI_RATE_LIMIT_SQLITE_PATH", "/tmp/epub_report_rate_limit.sqlite3")
+GEMINI_RATE_LIMIT_SHARDS = int(os.environ.get("GEMINI_RATE_LIMIT_SHARDS", "20")) # Firestore backend: bucket documents sharing the limits; keep requests/sec per shard around 1
+GEMINI_RATE_LIMIT_FAIL_OPEN = os.environ.get("GEMINI_RATE_LIMIT_FAIL_OPEN", "true").lower() == "true" # Backend errors: true sends anyway (counted in rate_limit_backend_errors), false waits and retries
+GEMINI_RATE_LIMIT_ERROR_RETRY_SECONDS = float(os.environ.get("GEMINI_RATE_LIMIT_ERROR_RETRY_SECONDS", "1")) # Fail-closed wait before asking the backend again
+GEMINI_REQUESTS_PER_MINUTE = int(os.environ.get("GEMINI_REQUESTS_PER_MINUTE", "1000")) # Shared by every job using the backend
+GEMINI_TOKENS_PER_MINUTE = int(os.environ.get("GEMINI_TOKENS_PER_MINUTE", "1000000")) # Estimated input tokens
+GEMINI_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("GEMINI_CIRCUIT_FAILURE_THRESHOLD", "5")) # Consecutive retryable failures that open the breaker
+GEMINI_CIRCUIT_COOLDOWN_SECONDS = float(os.environ.get("GEMINI_CIRCUIT_COOLDOWN_SECONDS", "60")) # Fail-fast period before a probe request
+JOB_QUEUE_BACKEND = os.environ.get("JOB_QUEUE_BACKEND", "none") # none (Prefer: respond-async is served synchronously), sqlite or filesystem; see Background Job Queue
+JOB_QUEUE_SQLITE_PATH = os.environ.get("JOB_QUEUE_SQLITE_PATH", "/tmp/epub_report_jobs.sqlite3")
+JOB_QUEUE_DIRECTORY = os.environ.get("JOB_QUEUE_DIRECTORY", "/tmp/epub_report_jobs")
+JOB_WORKER_MODE = os.environ.get("JOB_WORKER_MODE", "external") # external: `python epub_report.py worker`; inline: a thread in this instance (local development only)
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "1800")) # A claimed job is handed out again if not acknowledged by then
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+JOB_PARTIAL_RETRY_DELAY_SECONDS = float(os.environ.get("JOB_PARTIAL_RETRY_DELAY_SECONDS", "30")) # A job with failed chapters is handed out again after this
+JOB_POLL_INTERVAL_SECONDS = float(os.environ.get("JOB_POLL_INTERVAL_SECONDS", "2"))
+STATUS_PROGRESS_MIN_INTERVAL_MS = int(os.environ.get("STATUS_PROGRESS_MIN_INTERVAL_MS", "2000")) # Buffered progress is written at most this often...
+STATUS_PROGRESS_MIN_STEP_PERCENT = int(os.environ.get("STATUS_PROGRESS_MIN_STEP_PERCENT", "10")) # ...or as soon as progress moved this far
+GEMINI_DISPATCH_MODE = os.environ.get("GEMINI_DISPATCH_MODE", "async") # "async" (coroutines on one loop thread) or "thread" (ThreadPoolExecutor)
+GEMINI_ATTEMPT_TIMEOUT_SECONDS = 60 # Timeout for a single Gemini call
+GEMINI_REQUEST_DEADLINE_SECONDS = float(os.environ.get("GEMINI_REQUEST_DEADLINE_SECONDS", "180")) # Async path: overall budget per request, retries included
+PRESCREEN_THRESHOLD = float(os.environ.get("PRESCREEN_THRESHOLD", "0")) # Chapters scoring below this skip Gemini; 0 (off) sends every chapter. Validate on labelled books before raising it
+PRESCREEN_WINDOW_CHARS = int(os.environ.get("PRESCREEN_WINDOW_CHARS", "2000")) # Lexicon hits are summed over windows this long
 
 # --- Global/Initialization ---
 # These will run once per instance cold start
@@ -32,7 +112,13 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY") # <--- Use this in production!
 
 genai_initialized = False # Flag to check if Gemini setup succeeded
 
-if not GEMINI_API_KEY:
+# Extraction pool workers (EXTRACTION_MODE=process) import this module only to parse chapters. They skip the service
+# clients below: their gRPC threads would be started once per worker for nothing.
+EXTRACTION_WORKER_PROCESS = multiprocessing.parent_process() is not None
+
+if EXTRACTION_WORKER_PROCESS:
+    pass
+elif not GEMINI_API_KEY:
     print("FATAL: GEMINI_API_KEY environment variable not set. The service will not be able to process requests requiring Gemini.")
     # genai_initialized remains False, and functions relying on it should handle this.
     # For Cloud Run, if Gemini is essential for the service to operate at all,
@@ -59,7 +145,9 @@ supabase_key: str = os.environ.get("SUPABASE_SERVICE_KEY")
 supabase: Client | None = None
 supabase_initialized = False
 
-if supabase_url and supabase_key:
+if EXTRACTION_WORKER_PROCESS:
+    pass
+elif supabase_url and supabase_key:
     try:
         supabase = create_client(supabase_url, supabase_key)
         supabase_initialized = True
@@ -69,205 +157,2303 @@ if supabase_url and supabase_key:
 else:
     print("FATAL: SUPABASE_URL and/or SUPABASE_SERVICE_KEY environment variables not set. Supabase reporting will be disabled.")
 
-try:
-    # Ensure an app is initialized.
-    # In Cloud Run, initialize_app() without args uses the service's identity.
-    if not firebase_admin._apps:
-        firebase_admin.initialize_app()
-        print("Firebase Admin SDK initialized by this instance.")
-    else:
-        print("Firebase Admin SDK was already initialized.")
+if not EXTRACTION_WORKER_PROCESS:
+    try:
+        # Ensure an app is initialized.
+        # In Cloud Run, initialize_app() without args uses the service's identity.
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app()
+            print("Firebase Admin SDK initialized by this instance.")
+        else:
+            print("Firebase Admin SDK was already initialized.")
+
+        # Attempt to get the Firestore client.
+        db = firestore.client()
+        print("Firestore client obtained successfully for epub_report.")
+        firebase_initialized = True # Set flag only if client is obtained
+
+    except Exception as e:
+        print(f"FATAL: Error during Firebase Admin SDK initialization or Firestore client retrieval: {e}")
+        print("Firestore functionality will be unavailable. Check service account permissions and Firebase setup.")
+        # db remains None, firebase_initialized remains False.
+        # The application will continue to run, but Firestore-dependent operations will be affected.
+
+# === Whole-Book Result Cache ===
+# The same EPUB (byte-for-byte) analyzed with the same model and prompt always yields the same report,
+# so finished results are stored under a content hash and replayed instead of re-running Gemini.
+def pipeline_cache_tag() -> str:
+    """Extraction, packing and artifact settings part of the book cache key: they change which chapters are
+    analyzed, how they are grouped into Gemini requests and whether the cached report carries a filter artifact."""
+    return (f"chapters:{MIN_CHAPTER_CHARS}:packing:{GEMINI_REQUEST_TOKEN_BUDGET}:{SMALL_CHAPTER_TOKENS}"
+            f":artifact:{BUILD_FILTER_ARTIFACT}")
+
+
+def compute_book_cache_key(epub_bytes: bytes) -> str:
+    """Returns the cache key for an uploaded EPUB: SHA-256 of the bytes combined with MODEL, the prompt cache tag,
+    the pre-screen settings (they decide which chapters Gemini sees), the extraction/packing/artifact settings and
+    the profanity lexicon (swear word counts are cached too)."""
+    book_digest = hashlib.sha256(epub_bytes).hexdigest()
+    return hashlib.sha256(
+        f"{book_digest}:{MODEL}:{prompt_cache_tag()}:{prescreen_cache_tag()}:{pipeline_cache_tag()}:"
+        f"{profanity_counter.lexicon_digest}".encode("utf-8")
+    ).hexdigest()
+
+
+class SQLiteBookResultCache:
+    """Book result cache backed by a local SQLite file (tests and single-instance deployments).
+
+    Not shared between instances, and on Cloud Functions the file lives in instance memory, so it keeps at
+    most max_entries results and evicts the oldest.
+    """
+
+    def __init__(self, path: str, max_entries: int = None):
+        self.max_entries = max_entries or BOOK_CACHE_SQLITE_MAX_ENTRIES
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS book_results (cache_key TEXT PRIMARY KEY, entry TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS book_results_created_at ON book_results (created_at)")
+        self._conn.commit()
+
+    def get(self, cache_key: str) -> Dict | None:
+        with self._lock:
+            row = self._conn.execute("SELECT entry FROM book_results WHERE cache_key = ?", (cache_key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, cache_key: str, entry: Dict) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO book_results (cache_key, entry, created_at) VALUES (?, ?, ?)",
+                (cache_key, json.dumps(entry), time.time())
+            )
+            self._conn.execute(
+                "DELETE FROM book_results WHERE cache_key NOT IN "
+                "(SELECT cache_key FROM book_results ORDER BY created_at DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM book_results").fetchone()[0]
+
+
+class FirestoreBookResultCache:
+    """Book result cache shared by all instances through a Firestore collection."""
+
+    def __init__(self, firestore_db, collection_name: str = 'epub_report_cache'):
+        self._collection = firestore_db.collection(collection_name)
+
+    def get(self, cache_key: str) -> Dict | None:
+        doc = self._collection.document(cache_key).get()
+        if not doc.exists:
+            return None
+        return json.loads(doc.to_dict()['entry'])
+
+    def put(self, cache_key: str, entry: Dict) -> None:
+        # Stored as a JSON string: flagged sections are free-form and Firestore rejects some nested values
+        self._collection.document(cache_key).set({
+            'entry': json.dumps(entry),
+            'model': MODEL,
+            'prompt_version': PROMPT_VERSION,
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+
+
+class SupabaseBookResultCache:
+    """Book result cache shared by all instances through the Supabase `report_cache` table."""
+
+    def __init__(self, supabase_client: Client, table_name: str = 'report_cache'):
+        self._client = supabase_client
+        self._table_name = table_name
+
+    def get(self, cache_key: str) -> Dict | None:
+        response = self._client.table(self._table_name).select('entry').eq('cache_key', cache_key).limit(1).execute()
+        rows = response.data or []
+        return rows[0]['entry'] if rows else None
+
+    def put(self, cache_key: str, entry: Dict) -> None:
+        self._client.table(self._table_name).upsert({
+            'cache_key': cache_key,
+            'entry': entry,
+            'model': MODEL,
+            'prompt_version': PROMPT_VERSION
+        }).execute()
+
+
+def init_book_result_cache():
+    """Creates the book result cache selected by BOOK_CACHE_BACKEND, or None if caching is disabled/unavailable."""
+    backend = 'none' if EXTRACTION_WORKER_PROCESS else BOOK_CACHE_BACKEND.lower()
+    try:
+        if backend == 'sqlite':
+            return SQLiteBookResultCache(BOOK_CACHE_SQLITE_PATH)
+        if backend == 'firestore' and firebase_initialized and db:
+            return FirestoreBookResultCache(db)
+        if backend == 'supabase' and supabase_initialized and supabase:
+            return SupabaseBookResultCache(supabase)
+        if backend != 'none':
+            print(f"Book result cache backend '{BOOK_CACHE_BACKEND}' is not available. Whole-book caching disabled.")
+    except Exception as e:
+        print(f"Error initializing book result cache ({BOOK_CACHE_BACKEND}): {e}. Whole-book caching disabled.")
+    return None
+
+book_result_cache = init_book_result_cache()
+
+
+def lookup_book_result(cache_key: str, log_prefix: str = "") -> Dict | None:
+    """Returns the cached entry for cache_key, or None on a miss. Cache errors are logged and treated as misses."""
+    if not book_result_cache:
+        return None
+    try:
+        return book_result_cache.get(cache_key)
+    except Exception as e:
+        print(f"{log_prefix}Error reading book result cache: {e}")
+        return None
+
+
+def store_book_result(cache_key: str, entry: Dict, log_prefix: str = "") -> None:
+    """Stores a finished book result. Cache errors are logged and never fail the job."""
+    if not book_result_cache:
+        return
+    try:
+        book_result_cache.put(cache_key, entry)
+        print(f"{log_prefix}Stored book result in cache ({cache_key[:12]}).")
+    except Exception as e:
+        print(f"{log_prefix}Error writing book result cache: {e}")
+
+
+# === Per-Chapter Result Cache ===
+# Re-uploads and other editions of a book share most chapters once whitespace is normalized,
+# so Gemini results are also cached per chapter text and only changed chapters are re-analyzed.
+def compute_chapter_cache_key(chapter_text: str) -> str:
+    """Returns the cache key for a cleaned chapter: SHA-256 of the text combined with MODEL and the prompt cache tag."""
+    return hashlib.sha256(f"{MODEL}:{prompt_cache_tag()}:{chapter_text}".encode("utf-8")).hexdigest()
+
+
+class ChapterResultCache:
+    """Thread-safe in-memory cache of flagged sections per chapter with LRU eviction and a TTL per entry."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries = OrderedDict() # cache_key -> (expires_at, sections), least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, cache_key: str) -> Optional[List[Dict]]:
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            expires_at, sections = entry
+            if expires_at <= self._clock():
+                del self._entries[cache_key]
+                return None
+            self._entries.move_to_end(cache_key)
+            return copy.deepcopy(sections)
+
+    def put(self, cache_key: str, sections: List[Dict]) -> None:
+        with self._lock:
+            self._entries[cache_key] = (self._clock() + self.ttl_seconds, copy.deepcopy(sections))
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+chapter_result_cache = ChapterResultCache(CHAPTER_CACHE_MAX_ENTRIES, CHAPTER_CACHE_TTL_SECONDS)
+
+
+# === Chapter Checkpoints ===
+# Each analyzed chapter's flagged sections are saved under the job_id as soon as the chapter completes, so a job
+# that is retried with the same X-Job-ID (a resubmission, or the job queue handing it to another worker) only
+# sends the chapters that were not finished yet. Checkpoints are cleared once the job completes without failures.
+# Checkpoint stores implement load(job_id) -> {chapter_index: entry}, put(job_id, chapter_index, entry) and clear(job_id).
+class SQLiteChapterCheckpointStore:
+    """Chapter checkpoints in a local SQLite file (tests, and workers sharing a machine or volume)."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chapter_checkpoints (job_id TEXT NOT NULL, chapter_index INTEGER NOT NULL, "
+            "entry TEXT NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (job_id, chapter_index))"
+        )
+        self._conn.commit()
+
+    def load(self, job_id: str) -> Dict[int, Dict]:
+        with self._lock:
+            rows = self._conn.execute("SELECT chapter_index, entry FROM chapter_checkpoints WHERE job_id = ?", (job_id,)).fetchall()
+        return {chapter_index: json.loads(entry) for chapter_index, entry in rows}
+
+    def put(self, job_id: str, chapter_index: int, entry: Dict) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chapter_checkpoints (job_id, chapter_index, entry, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, chapter_index, json.dumps(entry), time.time())
+            )
+            self._conn.commit()
+
+    def clear(self, job_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM chapter_checkpoints WHERE job_id = ?", (job_id,))
+            self._conn.commit()
+
+
+class FirestoreChapterCheckpointStore:
+    """Chapter checkpoints in the `chapters` subcollection of the job's epub_process_status document."""
+
+    def __init__(self, firestore_db, collection_name: str = 'epub_process_status'):
+        self._collection = firestore_db.collection(collection_name)
+
+    def _chapters(self, job_id: str):
+        return self._collection.document(job_id).collection('chapters')
 
-    # Attempt to get the Firestore client.
-    db = firestore.client()
-    print("Firestore client obtained successfully for epub_report.")
-    firebase_initialized = True # Set flag only if client is obtained
+    def load(self, job_id: str) -> Dict[int, Dict]:
+        return {int(doc.id): json.loads(doc.to_dict()['entry']) for doc in self._chapters(job_id).stream()}
+
+    def put(self, job_id: str, chapter_index: int, entry: Dict) -> None:
+        # Stored as a JSON string, like cached book results: flagged sections are free-form
+        self._chapters(job_id).document(str(chapter_index)).set({
+            'entry': json.dumps(entry),
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+
+    def clear(self, job_id: str) -> None:
+        for doc in self._chapters(job_id).stream():
+            doc.reference.delete()
+
+
+def init_chapter_checkpoint_store():
+    """Creates the checkpoint store selected by CHECKPOINT_BACKEND, or None if checkpointing is disabled/unavailable."""
+    backend = 'none' if EXTRACTION_WORKER_PROCESS else CHECKPOINT_BACKEND.lower()
+    try:
+        if backend == 'sqlite':
+            return SQLiteChapterCheckpointStore(CHECKPOINT_SQLITE_PATH)
+        if backend == 'firestore' and firebase_initialized and db:
+            return FirestoreChapterCheckpointStore(db)
+        if backend != 'none':
+            print(f"Chapter checkpoint backend '{CHECKPOINT_BACKEND}' is not available. Resumable jobs disabled.")
+    except Exception as e:
+        print(f"Error initializing chapter checkpoint store ({CHECKPOINT_BACKEND}): {e}. Resumable jobs disabled.")
+    return None
+
+chapter_checkpoint_store = init_chapter_checkpoint_store()
+
+
+def build_chapter_checkpoint(chapter: Dict, flagged_sections: List[Dict]) -> Dict:
+    """Checkpoint entry for a finished chapter. The text digest and prompt tag keep a different book or prompt
+    submitted under the same job_id from reusing it."""
+    return {
+        'file': chapter.get('file'),
+        'text_sha1': hashlib.sha1(chapter['text'].encode('utf-8')).hexdigest(),
+        'prompt': prompt_cache_tag(),
+        'sections': flagged_sections
+    }
+
+
+def recover_checkpointed_sections(entry: Optional[Dict], chapter: Dict) -> Optional[List[Dict]]:
+    """Returns the checkpointed sections if entry was saved for this chapter text and prompt, else None."""
+    if not entry or entry.get('prompt') != prompt_cache_tag():
+        return None
+    if entry.get('text_sha1') != hashlib.sha1(chapter['text'].encode('utf-8')).hexdigest():
+        return None
+    return entry.get('sections') or []
+
+
+def load_chapter_checkpoints(job_id: str, log_prefix: str = "") -> Dict[int, Dict]:
+    """Returns the job's saved checkpoints. Store errors are logged and treated as no checkpoints."""
+    if not chapter_checkpoint_store or not job_id:
+        return {}
+    try:
+        return chapter_checkpoint_store.load(job_id)
+    except Exception as e:
+        print(f"{log_prefix}Error reading chapter checkpoints: {e}")
+        return {}
+
+
+def save_chapter_checkpoint(job_id: str, chapter_index: int, entry: Dict, log_prefix: str = "") -> None:
+    """Saves one chapter's checkpoint. Store errors are logged and never fail the job."""
+    try:
+        chapter_checkpoint_store.put(job_id, chapter_index, entry)
+    except Exception as e:
+        print(f"{log_prefix}Error writing checkpoint for chapter {chapter_index}: {e}")
+
+
+def clear_chapter_checkpoints(job_id: str, log_prefix: str = "") -> None:
+    if not chapter_checkpoint_store or not job_id:
+        return
+    try:
+        chapter_checkpoint_store.clear(job_id)
+    except Exception as e:
+        print(f"{log_prefix}Error clearing chapter checkpoints: {e}")
+
+
+class JobCounters:
+    """Thread-safe named counters collected while a single job is processed."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + amount
+
+    def get(self, name: str) -> int:
+        with self._lock:
+            return self._counts.get(name, 0)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return dict(self._counts)
+
+
+# === Gemini Rate Limiting ===
+# Requests-per-minute and tokens-per-minute token buckets that every Gemini call acquires from,
+# so concurrent jobs on an instance (or every instance, with a shared backend) stay under quota
+# together. Each bucket holds up to one minute of its limit and refills continuously.
+def _take_from_buckets(states: Dict, amounts: Dict, limits_per_minute: Dict, now: float) -> tuple:
+    """Refills bucket states ({name: (level, updated_at)}) and takes amounts from all of them or none.
+
+    An amount larger than its bucket waits for a full bucket instead of forever.
+    Returns (new states, seconds to wait before the take can succeed; 0 if it succeeded). On a wait
+    the stored states need not be written back: refilling is computed from updated_at either way.
+    """
+    new_states = {}
+    wait_seconds = 0.0
+    for name, limit in limits_per_minute.items():
+        amount = min(amounts[name], limit)
+        level, updated_at = states.get(name, (float(limit), now))
+        level = min(float(limit), level + max(0.0, now - updated_at) * limit / 60.0)
+        new_states[name] = (level, now)
+        if level < amount:
+            wait_seconds = max(wait_seconds, (amount - level) * 60.0 / limit)
+    if wait_seconds == 0:
+        new_states = {name: (level - min(amounts[name], limits_per_minute[name]), updated_at)
+                      for name, (level, updated_at) in new_states.items()}
+    return new_states, wait_seconds
+
+
+class InMemoryRateLimitBackend:
+    """Buckets held in this process: coordinates the jobs of one instance."""
+    blocking = False
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def try_take(self, amounts: Dict, limits_per_minute: Dict) -> float:
+        with self._lock:
+            self._states, wait_seconds = _take_from_buckets(self._states, amounts, limits_per_minute, time.monotonic())
+        return wait_seconds
+
+
+class SQLiteRateLimitBackend:
+    """Buckets in a local SQLite file, shared by every process on the machine (tests and local runs)."""
+    blocking = True
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit_buckets (name TEXT PRIMARY KEY, level REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def try_take(self, amounts: Dict, limits_per_minute: Dict) -> float:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE") # Serializes the read-modify-write across processes
+            try:
+                rows = self._conn.execute("SELECT name, level, updated_at FROM rate_limit_buckets").fetchall()
+                states = {name: (level, updated_at) for name, level, updated_at in rows}
+                new_states, wait_seconds = _take_from_buckets(states, amounts, limits_per_minute, time.time())
+                if wait_seconds == 0:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO rate_limit_buckets (name, level, updated_at) VALUES (?, ?, ?)",
+                        [(name, level, updated_at) for name, (level, updated_at) in new_states.items()]
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait_seconds
+
+
+class FirestoreRateLimitBackend:
+    """Buckets shared by all instances, split across shard documents updated in transactions.
+
+    One document can only sustain about one write per second, so each of the `shards` documents holds
+    1/shards of every limit and a take goes to a random shard (and one other if that shard is empty).
+    Only successful takes write.
+    """
+    blocking = True
+
+    def __init__(self, firestore_db, shards: int = None, collection_name: str = 'gemini_rate_limits', document_id: str = 'gemini'):
+        self._db = firestore_db
+        self.shards = max(1, shards or GEMINI_RATE_LIMIT_SHARDS)
+        collection = firestore_db.collection(collection_name)
+        self._doc_refs = [collection.document(f"{document_id}-{shard}") for shard in range(self.shards)]
+
+    def _try_take_from_shard(self, doc_ref, amounts: Dict, limits_per_minute: Dict) -> float:
+        @firestore.transactional
+        def take_in_transaction(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            stored = snapshot.to_dict() if snapshot.exists else {}
+            states = {name: (bucket['level'], bucket['updated_at']) for name, bucket in stored.items()}
+            new_states, wait_seconds = _take_from_buckets(states, amounts, limits_per_minute, time.time())
+            if wait_seconds == 0:
+                transaction.set(doc_ref, {
+                    name: {'level': level, 'updated_at': updated_at} for name, (level, updated_at) in new_states.items()
+                })
+            return wait_seconds
+        return take_in_transaction(self._db.transaction())
+
+    def try_take(self, amounts: Dict, limits_per_minute: Dict) -> float:
+        shard_limits = {name: limit / self.shards for name, limit in limits_per_minute.items()}
+        wait_seconds = float('inf')
+        for doc_ref in random.sample(self._doc_refs, min(2, self.shards)):
+            wait_seconds = min(wait_seconds, self._try_take_from_shard(doc_ref, amounts, shard_limits))
+            if wait_seconds == 0:
+                break
+        return wait_seconds
+
+
+class GeminiRateLimiter:
+    """Blocks (or awaits) until both the request and the token bucket can cover a Gemini call.
+
+    When the backend cannot be reached the call goes ahead (fail_open) or waits error_retry_seconds and
+    asks again; either way it is counted in backend_errors and the job's rate_limit_backend_errors.
+    """
+
+    def __init__(self, backend, requests_per_minute: int, tokens_per_minute: int, fail_open: bool = None,
+                 error_retry_seconds: float = None):
+        self.backend = backend
+        self.limits_per_minute = {'requests': requests_per_minute, 'tokens': tokens_per_minute}
+        self.fail_open = GEMINI_RATE_LIMIT_FAIL_OPEN if fail_open is None else fail_open
+        self.error_retry_seconds = error_retry_seconds or GEMINI_RATE_LIMIT_ERROR_RETRY_SECONDS
+        self.backend_errors = 0
+
+    def _try_take(self, estimated_tokens: int, job_counters: Optional[JobCounters]) -> float:
+        try:
+            return self.backend.try_take({'requests': 1, 'tokens': estimated_tokens}, self.limits_per_minute)
+        except Exception as e:
+            self.backend_errors += 1
+            if job_counters is not None:
+                job_counters.increment('rate_limit_backend_errors')
+            if self.fail_open:
+                print(f"Error reaching Gemini rate limit backend: {e}. Proceeding without waiting (fail-open).")
+                return 0.0
+            print(f"Error reaching Gemini rate limit backend: {e}. Retrying in {self.error_retry_seconds}s.")
+            return self.error_retry_seconds
+
+    def acquire(self, estimated_tokens: int, job_counters: JobCounters = None) -> float:
+        """Waits for capacity and returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            wait_seconds = self._try_take(estimated_tokens, job_counters)
+            if wait_seconds <= 0:
+                return waited
+            time.sleep(wait_seconds)
+            waited += wait_seconds
+
+    async def acquire_async(self, estimated_tokens: int, job_counters: JobCounters = None) -> float:
+        """Awaits capacity without blocking the event loop and returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            if self.backend.blocking:
+                wait_seconds = await asyncio.to_thread(self._try_take, estimated_tokens, job_counters)
+            else:
+                wait_seconds = self._try_take(estimated_tokens, job_counters)
+            if wait_seconds <= 0:
+                return waited
+            await asyncio.sleep(wait_seconds)
+            waited += wait_seconds
+
+
+def init_gemini_rate_limiter():
+    """Creates the limiter selected by GEMINI_RATE_LIMIT_BACKEND, or None if rate limiting is disabled/unavailable."""
+    backend = 'none' if EXTRACTION_WORKER_PROCESS else GEMINI_RATE_LIMIT_BACKEND.lower()
+    if backend == 'none' or GEMINI_REQUESTS_PER_MINUTE <= 0 or GEMINI_TOKENS_PER_MINUTE <= 0:
+        return None
+    try:
+        if backend == 'memory':
+            store = InMemoryRateLimitBackend()
+        elif backend == 'sqlite':
+            store = SQLiteRateLimitBackend(GEMINI_RATE_LIMIT_SQLITE_PATH)
+        elif backend == 'firestore' and firebase_initialized and db:
+            store = FirestoreRateLimitBackend(db)
+        else:
+            print(f"Gemini rate limit backend '{GEMINI_RATE_LIMIT_BACKEND}' is not available. Rate limiting disabled.")
+            return None
+        return GeminiRateLimiter(store, GEMINI_REQUESTS_PER_MINUTE, GEMINI_TOKENS_PER_MINUTE)
+    except Exception as e:
+        print(f"Error initializing Gemini rate limiter ({GEMINI_RATE_LIMIT_BACKEND}): {e}. Rate limiting disabled.")
+    return None
+
+gemini_rate_limiter = init_gemini_rate_limiter()
+
+
+def estimate_prompt_tokens(messages: List[Dict]) -> int:
+    return estimate_tokens("".join(part.get("text", "") for message in messages for part in message.get("parts", [])))
+
+
+def estimate_filter_request_tokens(messages: List[Dict]) -> int:
+    """Estimated input tokens of a filter request, including the system instruction it is sent with."""
+    entry = PROMPT_VERSION_REGISTRY[PROMPT_VERSION]
+    system_tokens = estimate_tokens(entry['instructions']) if entry['placement'] == PROMPT_PLACEMENT_SYSTEM else 0
+    return estimate_prompt_tokens(messages) + system_tokens
+
+
+def record_token_usage(job_counters: Optional[JobCounters], response) -> None:
+    """Adds the token counts Gemini reports in usage_metadata to the job counters."""
+    usage = getattr(response, 'usage_metadata', None)
+    if job_counters is None or usage is None:
+        return
+    job_counters.increment('gemini_prompt_tokens', getattr(usage, 'prompt_token_count', 0) or 0)
+    job_counters.increment('gemini_cached_prompt_tokens', getattr(usage, 'cached_content_token_count', 0) or 0)
+    job_counters.increment('gemini_output_tokens', getattr(usage, 'candidates_token_count', 0) or 0)
+
+
+def gemini_token_usage(job_counters: JobCounters) -> Dict:
+    return {
+        'prompt': job_counters.get('gemini_prompt_tokens'),
+        'cached_prompt': job_counters.get('gemini_cached_prompt_tokens'),
+        'output': job_counters.get('gemini_output_tokens')
+    }
+
+
+def record_rate_limit_wait(job_counters: Optional[JobCounters], wait_seconds: float) -> None:
+    if job_counters is not None and wait_seconds > 0:
+        job_counters.increment('rate_limited_requests')
+        job_counters.increment('rate_limit_wait_ms', int(wait_seconds * 1000))
+
+
+# === Job Status Reporting ===
+class FirestoreProgressReporter:
+    """Buffers job status updates and writes them to Firestore from a background thread.
+
+    progress() updates are merged and written at most every min_interval_ms, or sooner once progress
+    has advanced min_progress_step points since the last write. stage() updates are always written,
+    in order, and finish() additionally waits until everything is written and stops the thread.
+    With no status document every call is a no-op.
+    """
+
+    def __init__(self, status_ref, log_prefix: str = "", min_interval_ms: int = None, min_progress_step: int = None):
+        self._status_ref = status_ref
+        self._log_prefix = log_prefix
+        self._min_interval_seconds = (min_interval_ms or STATUS_PROGRESS_MIN_INTERVAL_MS) / 1000
+        self._min_progress_step = min_progress_step or STATUS_PROGRESS_MIN_STEP_PERCENT
+        self._pending = {}
+        self._force = False
+        self._closed = False
+        self._last_write_at = float('-inf')
+        self._last_written_progress = 0
+        self.writes = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        if status_ref is not None:
+            self._thread = threading.Thread(target=self._run, name="firestore-progress", daemon=True)
+            self._thread.start()
+
+    def progress(self, fields: Dict) -> None:
+        self._submit(fields, force=False)
+
+    def stage(self, fields: Dict) -> None:
+        self._submit(fields, force=True)
+
+    def finish(self, fields: Dict = None) -> None:
+        if fields:
+            self._submit(fields, force=True)
+        self.close()
+
+    def close(self) -> None:
+        """Writes anything still buffered and stops the background thread. Safe to call more than once."""
+        if self._thread is None:
+            return
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self._thread = None
+
+    def _submit(self, fields: Dict, force: bool) -> None:
+        if self._status_ref is None:
+            return
+        with self._condition:
+            if self._closed:
+                return
+            self._pending.update(fields)
+            self._force = self._force or force
+            self._condition.notify()
+
+    def _seconds_until_due(self) -> Optional[float]:
+        """0 if the buffer should be written now, the time left otherwise, or None if there is nothing to write."""
+        if not self._pending:
+            return None
+        if self._force or self._closed:
+            return 0
+        progress = self._pending.get('progress')
+        if progress is not None and progress - self._last_written_progress >= self._min_progress_step:
+            return 0
+        return max(0, self._last_write_at + self._min_interval_seconds - time.monotonic())
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    wait_seconds = self._seconds_until_due()
+                    if wait_seconds == 0:
+                        break
+                    if wait_seconds is None and self._closed:
+                        return
+                    self._condition.wait(wait_seconds)
+                fields, self._pending, self._force = self._pending, {}, False
+            self._write(fields)
+
+    def _write(self, fields: Dict) -> None:
+        try:
+            self._status_ref.update({**fields, 'last_updated': firestore.SERVER_TIMESTAMP})
+        except Exception as e_fs:
+            print(f"{self._log_prefix}Error writing job status to Firestore: {e_fs}")
+        self.writes += 1
+        self._last_write_at = time.monotonic()
+        if 'progress' in fields:
+            self._last_written_progress = fields['progress']
+
+
+# === EPUB Ingestion ===
+def open_epub_source(epub_bytes: bytes) -> BinaryIO:
+    """Returns a seekable file object over the uploaded EPUB for zipfile to read from.
+
+    Uploads up to EPUB_SPOOL_THRESHOLD_BYTES are read directly from the request body: BytesIO
+    shares the bytes buffer instead of copying it, so nothing is written to /tmp (which is
+    RAM-backed on Cloud Run). Larger uploads fall back to a spooled temporary file.
+    """
+    if len(epub_bytes) <= EPUB_SPOOL_THRESHOLD_BYTES:
+        return io.BytesIO(epub_bytes)
+    spooled_file = tempfile.SpooledTemporaryFile(max_size=EPUB_SPOOL_THRESHOLD_BYTES)
+    spooled_file.rollover() # Write straight to the file; otherwise the whole upload is first copied into a BytesIO
+    spooled_file.write(memoryview(epub_bytes))
+    spooled_file.seek(0)
+    return spooled_file
+
+
+# === HTML-to-Text Extraction Backends ===
+# Every backend must produce exactly the text of
+#   re.sub(r'\s+', ' ', BeautifulSoup(html, "html.parser").get_text(separator=' ', strip=True)).strip()
+# which is what chapter caches, reports and flagged-section offsets are based on.
+WHITESPACE_RUN = re.compile(r'\s+')
+
+def extract_text_bs4(content_str: str) -> str:
+    """Reference extractor: builds a full BeautifulSoup tree and flattens it."""
+    soup = bs4.BeautifulSoup(content_str, "html.parser")
+    text = soup.get_text(separator=' ', strip=True)
+    return WHITESPACE_RUN.sub(' ', text).strip()
+
+
+class _StreamingTextParser(HTMLParser):
+    """Collects text straight from html.parser tokens without building a tree.
+
+    Mirrors how BeautifulSoup's html.parser builder splits text into strings: data between two
+    markup events is one string, strings inside script/style/template/rt/rp are not text, and
+    comments, declarations and processing instructions are dropped (CDATA is kept).
+    """
+    NON_TEXT_CONTAINERS = {'script', 'style', 'template', 'rt', 'rp'}
+    VOID_ELEMENTS = {
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta',
+        'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex',
+        'nextid', 'spacer'
+    }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.strings = []
+        self._pending_data = []
+        self._container_stack = []
+        self._closed_void_elements = []
+
+    def _end_string(self) -> None:
+        if self._pending_data:
+            string = ''.join(self._pending_data).strip()
+            self._pending_data = []
+            if string and not self._container_stack:
+                self.strings.append(string)
+
+    def handle_starttag(self, tag, attrs):
+        self._end_string()
+        if tag in self.VOID_ELEMENTS:
+            # A later </tag> for a void element is ignored without ending the current string
+            self._closed_void_elements.append(tag)
+        elif tag in self.NON_TEXT_CONTAINERS:
+            self._container_stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._end_string()
+
+    def handle_endtag(self, tag):
+        if tag in self._closed_void_elements:
+            self._closed_void_elements.remove(tag)
+            return
+        self._end_string()
+        if tag in self._container_stack:
+            while self._container_stack.pop() != tag:
+                pass
+
+    def handle_data(self, data):
+        self._pending_data.append(data)
+
+    def handle_entityref(self, name):
+        character = HTML5_ENTITIES.get(name + ';')
+        self._pending_data.append(character if character is not None else '&' + name)
+
+    def handle_charref(self, name):
+        self._pending_data.append(html.unescape(f'&#{name};'))
+
+    def handle_comment(self, data):
+        self._end_string()
+
+    def handle_decl(self, decl):
+        self._end_string()
+
+    def unknown_decl(self, data):
+        self._end_string()
+        if data.upper().startswith('CDATA[') and not self._container_stack:
+            string = data[len('CDATA['):].strip()
+            if string:
+                self.strings.append(string)
+
+    def handle_pi(self, data):
+        self._end_string()
+
+
+def extract_text_stream(content_str: str) -> str:
+    """Streaming extractor: tokenizes with html.parser and joins text strings directly."""
+    parser = _StreamingTextParser()
+    parser.feed(content_str)
+    parser.close()
+    parser._end_string()
+    return WHITESPACE_RUN.sub(' ', ' '.join(parser.strings)).strip()
+
+
+HTML_TEXT_EXTRACTORS = {
+    'bs4': extract_text_bs4,
+    'stream': extract_text_stream,
+}
+
+if HTML_EXTRACTOR_BACKEND not in HTML_TEXT_EXTRACTORS:
+    print(f"Unknown HTML_EXTRACTOR_BACKEND '{HTML_EXTRACTOR_BACKEND}'. Falling back to 'stream'.")
+    HTML_EXTRACTOR_BACKEND = 'stream'
 
-except Exception as e:
-    print(f"FATAL: Error during Firebase Admin SDK initialization or Firestore client retrieval: {e}")
-    print("Firestore functionality will be unavailable. Check service account permissions and Firebase setup.")
-    # db remains None, firebase_initialized remains False.
-    # The application will continue to run, but Firestore-dependent operations will be affected.
 
 # === EPUB Extraction Function ===
-# Keep your existing extract_epub_chapters function
-def extract_epub_chapters(epub_path: str) -> List[Dict]:
-    """Extracts text content from EPUB chapters."""
-    chapters = []
+CONTAINER_NAMESPACE = '{urn:oasis:names:tc:opendocument:xmlns:container}'
+OPF_NAMESPACE = '{http://www.idpf.org/2007/opf}'
+CHAPTER_MEDIA_TYPES = ('application/xhtml+xml', 'text/html')
+
+def is_chapter_member(file_name: str) -> bool:
+    """Checks for standard EPUB chapter files and avoids table of contents (used when a book has no readable spine)."""
+    return file_name.endswith(('.xhtml', '.html')) and 'toc' not in file_name.lower() and not file_name.startswith('__MACOSX')
+
+
+def read_epub_spine(zip_ref: zipfile.ZipFile) -> Optional[List[Dict]]:
+    """Returns the book's content documents in reading order, or None if it has no usable container.xml/OPF.
+
+    Follows META-INF/container.xml to the OPF package and walks its <spine>. Items marked
+    linear="no", the EPUB 3 nav document (manifest properties="nav"), the EPUB 2 guide's table of
+    contents and non-HTML items are skipped. Each entry is {"file", "idref", "spine_index", "cfi_base"},
+    where cfi_base is the EPUB CFI path of the spine itemref (e.g. "/6/4[chap01]").
+    """
     try:
-        with zipfile.ZipFile(epub_path, 'r') as zip_ref:
-            for file_name in zip_ref.namelist():
-                # Check for standard EPUB chapter files and avoid table of contents
-                if file_name.endswith(('.xhtml', '.html')) and 'toc' not in file_name.lower() and not file_name.startswith('__MACOSX'):
-                    try:
-                        with zip_ref.open(file_name, 'r') as f:
-                            content_bytes = f.read()
-                            try:
-                                content_str = content_bytes.decode("utf-8", errors='ignore')
-                            except Exception as decode_error:
-                                print(f"  → Error decoding content from {file_name}: {decode_error}. Skipping file.")
-                                continue
-
-                            soup = bs4.BeautifulSoup(content_str, "html.parser")
-                            text = soup.get_text(separator=' ', strip=True)
-                            cleaned_text = re.sub(r'\s+', ' ', text).strip()
-                            # Only add if it has significant text content
-                            if len(cleaned_text) > 200:
-                                chapters.append({"file": file_name, "text": cleaned_text})
-                            else:
-                                print(f"Skipping small or empty file: {file_name}")
-                    except Exception as e:
-                        print(f"Error processing file {file_name} in EPUB: {e}")
+        container = ET.fromstring(zip_ref.read('META-INF/container.xml'))
+        opf_path = container.find(f'.//{CONTAINER_NAMESPACE}rootfile').get('full-path')
+        package = ET.fromstring(zip_ref.read(opf_path))
+        spine = package.find(f'{OPF_NAMESPACE}spine')
+        if spine is None:
+            return None
+    except (KeyError, AttributeError, ET.ParseError) as e:
+        print(f"No readable OPF spine ({e}). Falling back to file name ordering.")
+        return None
+
+    opf_dir = posixpath.dirname(opf_path)
+
+    def member_path(href: str) -> str:
+        return posixpath.normpath(posixpath.join(opf_dir, urllib.parse.unquote(href.split('#')[0])))
+
+    manifest = {item.get('id'): item for item in package.iter(f'{OPF_NAMESPACE}item')}
+    guide_toc_files = {
+        member_path(reference.get('href', ''))
+        for reference in package.iter(f'{OPF_NAMESPACE}reference') if reference.get('type', '').lower() == 'toc'
+    }
+    spine_step = (list(package).index(spine) + 1) * 2 # CFI steps count element children in even numbers
+
+    spine_items = []
+    for position, itemref in enumerate(spine.findall(f'{OPF_NAMESPACE}itemref')):
+        idref = itemref.get('idref')
+        item = manifest.get(idref)
+        if item is None or itemref.get('linear', 'yes').lower() == 'no':
+            continue
+        if 'nav' in item.get('properties', '').split() or item.get('media-type') not in CHAPTER_MEDIA_TYPES:
+            continue
+        file_name = member_path(item.get('href', ''))
+        if file_name in guide_toc_files:
+            continue
+        spine_items.append({
+            'file': file_name,
+            'idref': idref,
+            'spine_index': position,
+            'cfi_base': f"/{spine_step}/{(position + 1) * 2}[{idref}]"
+        })
+    return spine_items
+
+
+def extract_chapter_from_member(file_name: str, content_bytes: bytes, extractor_backend: str,
+                                min_chapter_chars: int = MIN_CHAPTER_CHARS) -> tuple:
+    """Extracts one archive member. Returns (chapter dict or None, log message or None).
+
+    Also runs in extraction worker processes, so it returns its log line instead of printing it.
+    """
+    content_str = content_bytes.decode("utf-8", errors='ignore')
+    cleaned_text = HTML_TEXT_EXTRACTORS[extractor_backend](content_str)
+    # Only add if it has text content
+    if len(cleaned_text) >= min_chapter_chars:
+        return {"file": file_name, "text": cleaned_text}, None
+    return None, f"Skipping small or empty file: {file_name}"
+
+
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+
+def get_extraction_pool(workers: int) -> ProcessPoolExecutor:
+    """Returns the instance-wide extraction process pool, creating it on first use."""
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            _extraction_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(EXTRACTION_START_METHOD))
+            print(f"Started extraction process pool with {workers} workers ({EXTRACTION_START_METHOD}).")
+        return _extraction_pool
+
+
+def discard_extraction_pool(pool: ProcessPoolExecutor) -> None:
+    """Drops a broken extraction pool so the next submit starts a fresh one. A pool that was already replaced is
+    left alone, so late failures from the old pool never shut down its healthy successor."""
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is pool:
+            _extraction_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _read_chapter_members(zip_ref: zipfile.ZipFile):
+    """Yields (member info, raw bytes) for content documents in reading order, decompressing each member once.
+
+    Members are read lazily, one at a time, so only the documents currently being parsed are held in memory.
+    """
+    spine_items = read_epub_spine(zip_ref)
+    if spine_items is None:
+        spine_items = [{'file': file_name} for file_name in zip_ref.namelist() if is_chapter_member(file_name)]
+    for member_info in spine_items:
+        try:
+            yield member_info, zip_ref.read(member_info['file'])
+        except Exception as e:
+            print(f"Error processing file {member_info['file']} in EPUB: {e}")
+
+
+def _extract_members_serially(member_contents, extractor_backend: str):
+    for member_info, content_bytes in member_contents:
+        file_name = member_info['file']
+        try:
+            chapter, message = extract_chapter_from_member(file_name, content_bytes, extractor_backend)
+        except Exception as e:
+            chapter, message = None, f"Error processing file {file_name} in EPUB: {e}"
+        yield member_info, chapter, message
+
+
+def _extract_member_in_process(file_name: str, content_bytes: bytes, extractor_backend: str) -> Future:
+    """Extracts one member in this process, wrapped in a finished Future like a pool result."""
+    future = Future()
+    try:
+        future.set_result(extract_chapter_from_member(file_name, content_bytes, extractor_backend))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def _extract_members_in_pool(member_contents, extractor_backend: str, workers: int):
+    """Parses members across the extraction pool and yields results in reading order.
+
+    At most 2 * workers members are in flight, so results stream back while later members
+    are still being decompressed and parsed. If the pool breaks, the affected members are
+    extracted in this process and later members go to a fresh pool.
+    """
+    pending = deque()
+
+    def collect(member_info, content_bytes, pool, future):
+        file_name = member_info['file']
+        try:
+            return (member_info, *future.result())
+        except BrokenProcessPool as e:
+            print(f"Extraction pool failed ({e}). Extracting {file_name} in-process.")
+            discard_extraction_pool(pool)
+            return collect(member_info, content_bytes, None, _extract_member_in_process(file_name, content_bytes, extractor_backend))
+        except Exception as e:
+            return member_info, None, f"Error processing file {file_name} in EPUB: {e}"
+
+    for member_info, content_bytes in member_contents:
+        file_name = member_info['file']
+        pool = get_extraction_pool(workers) # Re-fetched per member: a pool discarded after a failure is replaced
+        try:
+            future = pool.submit(extract_chapter_from_member, file_name, content_bytes, extractor_backend)
+        except Exception as e:
+            # Pool is broken or shut down: finish this member in-process; the next one gets a fresh pool
+            print(f"Extraction pool unavailable ({e}). Extracting {file_name} in-process.")
+            discard_extraction_pool(pool)
+            future = _extract_member_in_process(file_name, content_bytes, extractor_backend)
+        pending.append((member_info, content_bytes, pool, future))
+        if len(pending) >= workers * 2:
+            yield collect(*pending.popleft())
+    while pending:
+        yield collect(*pending.popleft())
+
+
+def iter_epub_chapters(epub_source: Union[str, BinaryIO], extractor_backend: str = None,
+                       extraction_mode: str = None, workers: int = None):
+    """Lazily yields chapters in reading order as soon as each one is extracted.
+
+    Chapters are {"file", "text"} plus the spine metadata from read_epub_spine when the book has
+    a readable OPF; books without one fall back to archive order and the file name heuristic.
+
+    epub_source is a file path or a seekable binary file object (see open_epub_source).
+    extractor_backend selects an entry of HTML_TEXT_EXTRACTORS (defaults to HTML_EXTRACTOR_BACKEND).
+    extraction_mode 'process' parses members across a process pool of `workers` processes
+    (defaults to EXTRACTION_MODE and EXTRACTION_WORKERS); anything else parses in this process.
+    """
+    extractor_backend = extractor_backend or HTML_EXTRACTOR_BACKEND
+    extraction_mode = extraction_mode or EXTRACTION_MODE
+    workers = workers or EXTRACTION_WORKERS
+    source_name = epub_source if isinstance(epub_source, str) else "<in-memory EPUB>"
+    try:
+        zip_ref = zipfile.ZipFile(epub_source, 'r')
     except FileNotFoundError:
-         # This shouldn't happen if the temporary file was written correctly
-         print(f"Error: EPUB file not found at {epub_path}")
-         return []
+         print(f"Error: EPUB file not found at {source_name}")
+         return
     except zipfile.BadZipFile:
-         print(f"Error: Not a valid EPUB file at {epub_path}")
-         return []
+         print(f"Error: Not a valid EPUB file at {source_name}")
+         return
     except Exception as e:
         print(f"An unexpected error occurred while extracting EPUB: {e}")
-        return []
+        return
+
+    with zip_ref:
+        member_contents = _read_chapter_members(zip_ref)
+        if extraction_mode == 'process' and workers > 1:
+            results = _extract_members_in_pool(member_contents, extractor_backend, workers)
+        else:
+            results = _extract_members_serially(member_contents, extractor_backend)
+        for member_info, chapter, message in results:
+            if message:
+                print(message)
+            if chapter:
+                yield {**member_info, **chapter}
+
+
+def count_epub_documents(epub_source: BinaryIO) -> int:
+    """Number of content documents iter_epub_chapters will read: an upper bound on the chapters it yields, known
+    before any chapter is extracted. Returns 0 if the archive cannot be read."""
+    try:
+        with zipfile.ZipFile(epub_source, 'r') as zip_ref:
+            spine_items = read_epub_spine(zip_ref)
+            if spine_items is not None:
+                return len(spine_items)
+            return sum(1 for file_name in zip_ref.namelist() if is_chapter_member(file_name))
+    except Exception:
+        return 0
+    finally:
+        epub_source.seek(0)
+
+
+def extract_epub_chapters(epub_source: Union[str, BinaryIO], extractor_backend: str = None,
+                          extraction_mode: str = None) -> List[Dict]:
+    """Extracts text content from EPUB chapters. See iter_epub_chapters for the arguments."""
+    chapters = list(iter_epub_chapters(epub_source, extractor_backend, extraction_mode))
+    if not chapters:
+        print("Warning: No suitable chapters found in the EPUB.")
+    return chapters
+
+
+# === Build Gemini prompt ===
+# Static filtering instructions shared by every request; the chapter text is appended after them.
+FILTER_PROMPT_INSTRUCTIONS = """
+                You are an AI tasked with identifying and marking **explicit sexual content or erotica** within book chapters for creating a clean reading experience.
+
+                You will be given the text of a single book chapter.
+
+                Your task is to identify and flag sexually explicit dialog, sentences, phrases, or continuous blocks of text that represent **complete scenes or extended passages** containing:
+                    - Explicit descriptions of sex acts (including intercourse, oral sex, etc.)
+                    - Graphic depictions of nudity or sexual arousal
+                    - Reference to sexual acts that invoke strong visual imagery
+                    - Detailed descriptions of sexual organs or bodily functions in a sexual context
+                    - Highly graphic or detailed accounts of physical intimacy that are equivalent to erotica or pornography.
+
+                To accomplish this task effectively, please follow these internal steps before generating the final JSON output:
+                1.  **Scan for Intimate Content:** Read through the chapter and identify any areas describing physical intimacy, kissing, touching, or emotionally intense romantic interactions.
+                2.  **Evaluate Explicitness:** For each identified area, carefully evaluate if it meets the **strict criteria for explicit sexual content or erotica** defined below. Focus *only* on the graphic physical descriptions of sex acts.
+                3.  **Define Scene Boundaries:** If an area *does* meet the explicit criteria, determine the **full, continuous scene or passage** where this explicit content occurs. Identify the natural start and end points of this *entire sequence*, including any immediately surrounding dialogue, internal thoughts, or non-graphic actions that are an integral part of *that specific intimate sequence*, but *excluding* text that occurs clearly before or after the explicit scene has concluded.
+                4.  **Format Output:** For each identified explicit scene/passage, store it under the \'text\' key.
+                5.  **Compile JSON:** Compile all identified explicit scenes/passages into the requested JSON format under the 'sections' key.
+
+                **DO NOT FLAG:**
+                - Romance, affection, or emotional intensity (even if passionate or suggestive)
+                - Kissing, hugging, or cuddling (unless they are the direct beginning or end of an explicit sexual scene you are flagging)
+                - Non-sexual descriptions of bodies or actions (e.g., violence, injury, physical appearance outside of a sexual context)
+                - Non-explicit sexual innuendo or suggestive dialogue (unless it is part of a larger explicit scene)
+                - **Do not flag dialogue or descriptions that happen *before* or *after* the explicit scene concludes, even if they are related to the relationship.**
+
+                Return a JSON object in this format:
+                ```json
+                {
+                "sections": [
+                    {
+                    "chapter": "Chapter title or number",
+                    "text": "entire text of the flagged section",
+                    "summary": "short non-descriptive, non explicit summary of the flagged section",
+                    }
+                    // More sections if found
+                ]
+                }
+                ```
+
+                If no content is flagged, return:
+                { "sections": [] }
+                Be conservative. If you're unsure, include the section.
+
+"""
+
+# Anchor-only output: Gemini returns short start/end snippets instead of echoing whole passages (output tokens
+# dominate latency for long scenes); anchor_flagged_sections places the snippets in the chapter text and fills
+# each section's "text" with the passage between them.
+ANCHOR_OUTPUT_STEP = """4.  **Format Output:** For each identified explicit scene/passage, copy its first 8-12 words exactly under the 'start' key and its last 8-12 words exactly under the 'end' key. Do not copy the rest of the passage."""
+ANCHOR_OUTPUT_FIELDS = """"start": "exact first 8-12 words of the flagged section",
+                    "end": "exact last 8-12 words of the flagged section","""
+FILTER_PROMPT_INSTRUCTIONS_ANCHORS = FILTER_PROMPT_INSTRUCTIONS.replace(
+    """4.  **Format Output:** For each identified explicit scene/passage, store it under the \'text\' key.""", ANCHOR_OUTPUT_STEP
+).replace('"text": "entire text of the flagged section",', ANCHOR_OUTPUT_FIELDS)
+
+
+PACKED_SEGMENTS_INSTRUCTIONS = """
+                The chapter text below contains several consecutive parts of the book. Each part is wrapped in
+                <<<SEGMENT n>>> and <<<END SEGMENT n>>> markers. Treat every segment separately: never flag text
+                that spans two segments, and add "segment": n (the number of the segment the flagged text comes
+                from) to every section you return.
+"""
+
+# === Prompt Versions ===
+# Every prompt the service can send is registered under a version with the exact instruction text, its digest, the
+# output mode and where the instructions are placed. Result cache keys use the version plus the digest and reports
+# record both, so a cached result can always be traced to the instruction text that produced it.
+PROMPT_PLACEMENT_USER_TURN = 'user_turn' # Instructions inlined ahead of the chapter in every request (v1)
+PROMPT_PLACEMENT_SYSTEM = 'system_instruction' # Instructions set once on the model; requests carry only the chapter (v2)
+PROMPT_VERSION_REGISTRY = {} # version -> {instructions, instructions_sha256, output_mode, placement}
+
+def register_prompt_version(version: str, instructions: str, output_mode: str, placement: str) -> None:
+    """Registers a prompt version. Registering an existing version with different text raises ValueError."""
+    digest = hashlib.sha256(instructions.encode("utf-8")).hexdigest()
+    registered = PROMPT_VERSION_REGISTRY.get(version)
+    if registered and registered['instructions_sha256'] != digest:
+        raise ValueError(f"Prompt version {version} is already registered with different instructions.")
+    PROMPT_VERSION_REGISTRY[version] = {
+        'instructions': instructions,
+        'instructions_sha256': digest,
+        'output_mode': output_mode,
+        'placement': placement
+    }
+
+register_prompt_version("v1", FILTER_PROMPT_INSTRUCTIONS, "full_text", PROMPT_PLACEMENT_USER_TURN)
+register_prompt_version("v1-anchors", FILTER_PROMPT_INSTRUCTIONS_ANCHORS, "anchors", PROMPT_PLACEMENT_USER_TURN)
+register_prompt_version("v2", textwrap.dedent(FILTER_PROMPT_INSTRUCTIONS).strip(), "full_text", PROMPT_PLACEMENT_SYSTEM)
+register_prompt_version("v2-anchors", textwrap.dedent(FILTER_PROMPT_INSTRUCTIONS_ANCHORS).strip(), "anchors", PROMPT_PLACEMENT_SYSTEM)
+
+
+def find_prompt_version(output_mode: str, placement: str) -> str:
+    return next(version for version, entry in PROMPT_VERSION_REGISTRY.items()
+                if entry['output_mode'] == output_mode and entry['placement'] == placement)
+
+
+def prompt_version_info(version: str = None) -> Dict:
+    """Registry entry of a prompt version without the instruction text, for reports and cache entries."""
+    version = version or PROMPT_VERSION
+    entry = PROMPT_VERSION_REGISTRY[version]
+    return {'prompt_version': version, 'instructions_sha256': entry['instructions_sha256'],
+            'output_mode': entry['output_mode'], 'placement': entry['placement']}
+
+
+def prompt_cache_tag() -> str:
+    """Prompt part of result cache keys. Includes the digest so edited instructions never reuse old results."""
+    return f"{PROMPT_VERSION}:{PROMPT_VERSION_REGISTRY[PROMPT_VERSION]['instructions_sha256'][:16]}"
+
+
+def _prompt_messages(chapter_text: str, preamble: str = "") -> List[Dict]:
+    """User turn for a filter request: the registered instructions when they are inlined, then the chapter."""
+    entry = PROMPT_VERSION_REGISTRY[PROMPT_VERSION]
+    if entry['placement'] == PROMPT_PLACEMENT_SYSTEM:
+        text = textwrap.dedent(preamble).strip() + "\n\n" if preamble else ""
+        return [{"role": "user", "parts": [{"text": text + f'Chapter:\n"""\n{chapter_text}\n"""'}]}]
+    return [{
+        "role": "user",
+        "parts": [{
+            "text": entry['instructions'] + preamble + f"""                Chapter:
+                \"\"\"
+                {chapter_text}
+                \"\"\"
+            """
+        }]
+    }]
+
+
+def build_prompt(chapter_text: str) -> List[Dict]:
+    return _prompt_messages(chapter_text)
+
+
+def build_packed_prompt(segments: List[Dict]) -> List[Dict]:
+    """Builds one prompt for several short chapters; results carry the 1-based "segment" they came from."""
+    packed_text = "\n".join(
+        f"<<<SEGMENT {n}>>>\n{segment['text']}\n<<<END SEGMENT {n}>>>" for n, segment in enumerate(segments, start=1)
+    )
+    return _prompt_messages(packed_text, PACKED_SEGMENTS_INSTRUCTIONS)
+
+
+# === Filter Model ===
+CONTEXT_CACHE_REFRESH_MARGIN_SECONDS = 300 # Recreate cached content this long before it expires
+
+class FilterModelProvider:
+    """Creates and reuses one Gemini model per prompt version, with the version's instructions as system_instruction.
+
+    With a cache_factory the instructions are also stored as explicit cached content and the model is built from
+    that handle; it is recreated before the TTL runs out. If the API refuses the cache (too few tokens, or a model
+    without caching support) the version falls back to a plain system_instruction model.
+    """
+
+    def __init__(self, model_factory: Callable, cache_factory: Callable = None, cached_model_factory: Callable = None,
+                 cache_ttl_seconds: int = None):
+        self._model_factory = model_factory
+        self._cache_factory = cache_factory
+        self._cached_model_factory = cached_model_factory
+        self._cache_ttl_seconds = cache_ttl_seconds or GEMINI_CONTEXT_CACHE_TTL_SECONDS
+        self._models = {} # version -> (model, refresh_at or None)
+        self._cache_refused = set()
+        self._lock = threading.Lock()
+        self.caches_created = 0
+
+    def get(self, version: str):
+        with self._lock:
+            model_entry = self._models.get(version)
+            if model_entry is None or (model_entry[1] is not None and model_entry[1] <= time.monotonic()):
+                model_entry = self._create(version)
+                self._models[version] = model_entry
+            return model_entry[0]
+
+    def _create(self, version: str) -> tuple:
+        instructions = PROMPT_VERSION_REGISTRY[version]['instructions']
+        if self._cache_factory and version not in self._cache_refused:
+            try:
+                cached_content = self._cache_factory(
+                    model=MODEL, display_name=f"purli-filter-{version}", system_instruction=instructions,
+                    ttl=datetime.timedelta(seconds=self._cache_ttl_seconds)
+                )
+                self.caches_created += 1
+                print(f"Created cached content for prompt {version}.")
+                refresh_at = time.monotonic() + max(0, self._cache_ttl_seconds - CONTEXT_CACHE_REFRESH_MARGIN_SECONDS)
+                return self._cached_model_factory(cached_content=cached_content), refresh_at
+            except Exception as e:
+                print(f"Cached content unavailable for prompt {version}: {e}. Using system_instruction without a cache.")
+                self._cache_refused.add(version)
+        return self._model_factory(model_name=MODEL, system_instruction=instructions), None
+
+filter_models = FilterModelProvider(genai.GenerativeModel, genai_caching.CachedContent.create if GEMINI_CONTEXT_CACHE else None,
+                                    genai.GenerativeModel.from_cached_content)
+
+
+def filter_model():
+    """Model for filter requests: the shared model when instructions are inlined, else the version's own model."""
+    if PROMPT_VERSION_REGISTRY[PROMPT_VERSION]['placement'] == PROMPT_PLACEMENT_SYSTEM:
+        return filter_models.get(PROMPT_VERSION)
+    return model
+
+
+# === Gemini Error Handling ===
+# Every failed call is classified before deciding what to do next:
+#   retryable      - rate limits, overload, timeouts and unknown transient errors: back off and retry
+#   non_retryable  - blocked prompts, auth and invalid requests: give up immediately
+#   repairable     - the model answered but not with valid JSON: re-ask once with only the broken output
+# A per-instance circuit breaker counts consecutive retryable failures and makes further calls
+# fail fast while Gemini is down; affected jobs are marked for deferred retry.
+GEMINI_ERROR_RETRYABLE = 'retryable'
+GEMINI_ERROR_NON_RETRYABLE = 'non_retryable'
+GEMINI_ERROR_REPAIRABLE = 'repairable'
+GEMINI_ERROR_CIRCUIT_OPEN = 'circuit_open'
+GEMINI_ERROR_CLASSES = (GEMINI_ERROR_RETRYABLE, GEMINI_ERROR_NON_RETRYABLE, GEMINI_ERROR_REPAIRABLE, GEMINI_ERROR_CIRCUIT_OPEN)
+
+class GeminiResponseBlocked(Exception):
+    """Gemini returned no candidates (prompt blocked or filtered)."""
+
+
+class GeminiEmptyResponse(Exception):
+    """Gemini returned a candidate without text."""
+
+
+class GeminiMalformedResponse(Exception):
+    """Gemini answered, but the text is not the expected JSON."""
+
+    def __init__(self, message: str, response_text: str):
+        super().__init__(message)
+        self.response_text = response_text
+
+
+NON_RETRYABLE_ERROR_TYPES = (
+    GeminiResponseBlocked,
+    google_exceptions.PermissionDenied,
+    google_exceptions.Unauthenticated,
+    google_exceptions.InvalidArgument,
+    google_exceptions.NotFound,
+)
+
+def classify_gemini_error(error: BaseException) -> str:
+    """Maps an exception from a Gemini call (or from parsing its response) to an error class."""
+    if isinstance(error, GeminiMalformedResponse):
+        return GEMINI_ERROR_REPAIRABLE
+    if isinstance(error, NON_RETRYABLE_ERROR_TYPES):
+        return GEMINI_ERROR_NON_RETRYABLE
+    return GEMINI_ERROR_RETRYABLE
+
+
+class GeminiCircuitBreaker:
+    """Opens after failure_threshold consecutive retryable failures and rejects calls for cooldown_seconds.
+
+    After the cooldown a single probe call is let through; its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, failure_threshold: int, cooldown_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._probe_count = 0 # Identifies the probe in flight, so only its own caller can abandon it
+        self._lock = threading.Lock()
+
+    def admit(self) -> Optional[int]:
+        """Returns None if the call is rejected, 0 if the breaker is closed, or the probe's number if this call is the
+        half-open probe. A probe that ends without record_success/record_failure must be passed to abandon_probe."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            if time.monotonic() - self._opened_at < self.cooldown_seconds or self._probe_in_flight:
+                return None
+            self._probe_in_flight = True
+            self._probe_count += 1
+            return self._probe_count
+
+    def allow_request(self) -> bool:
+        return self.admit() is not None
+
+    def abandon_probe(self, probe: int) -> None:
+        """Lets the next caller probe again if `probe` is still in flight (e.g. its coroutine was cancelled)."""
+        with self._lock:
+            if probe and self._probe_in_flight and self._probe_count == probe:
+                self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._opened_at is not None or self._consecutive_failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f"Gemini circuit breaker opened after {self._consecutive_failures} consecutive failures.")
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def retry_after_seconds(self) -> float:
+        """Seconds until the next probe is allowed (0 if closed)."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self.cooldown_seconds - (time.monotonic() - self._opened_at))
+
+gemini_circuit_breaker = GeminiCircuitBreaker(GEMINI_CIRCUIT_FAILURE_THRESHOLD, GEMINI_CIRCUIT_COOLDOWN_SECONDS)
+
+
+def record_gemini_error(job_counters: Optional[JobCounters], error_class: str) -> None:
+    """Counts the error per class for the job and feeds backend health to the circuit breaker."""
+    if job_counters is not None:
+        job_counters.increment(f'gemini_errors_{error_class}')
+    if error_class == GEMINI_ERROR_RETRYABLE:
+        gemini_circuit_breaker.record_failure()
+    elif error_class != GEMINI_ERROR_CIRCUIT_OPEN:
+        gemini_circuit_breaker.record_success() # Gemini answered; the request itself was the problem
+
+
+JSON_REPAIR_INSTRUCTIONS = """Rewrite the text below as valid JSON of the form {"sections": [{"chapter": "...", "summary": "...", ...}]}.
+Keep every section, its fields (such as "text" or "start"/"end", and any "segment" number) and their text exactly as given. Return only the JSON object.
+
+"""
+
+def build_json_repair_prompt(malformed_text: str) -> List[Dict]:
+    """Re-ask prompt containing only the malformed output, so a repair costs a fraction of the original request."""
+    return [{"role": "user", "parts": [{"text": JSON_REPAIR_INSTRUCTIONS + malformed_text}]}]
+
+
+def repair_gemini_json(malformed_text: str, chapter_file_name: str, job_id: str = None,
+                       job_counters: JobCounters = None) -> Optional[List[Dict]]:
+    """Asks Gemini once to turn its malformed output into valid JSON. Returns the sections or None."""
+    log_prefix = f"[Job {job_id}] " if job_id else ""
+    if not malformed_text.strip() or not gemini_circuit_breaker.allow_request():
+        return None
+    print(f"{log_prefix}  → Re-asking Gemini to repair malformed JSON for chapter {chapter_file_name}.")
+    messages = build_json_repair_prompt(malformed_text)
+    try:
+        if gemini_rate_limiter:
+            record_rate_limit_wait(job_counters, gemini_rate_limiter.acquire(estimate_prompt_tokens(messages), job_counters))
+        response = model.generate_content(messages, generation_config={"temperature": 0}, request_options={'timeout': 60})
+        record_token_usage(job_counters, response)
+        flagged_sections = parse_gemini_response(response, chapter_file_name, log_prefix)
+    except Exception as e:
+        record_gemini_error(job_counters, classify_gemini_error(e))
+        print(f"{log_prefix}  → JSON repair failed for chapter {chapter_file_name}: {e}")
+        return None
+    gemini_circuit_breaker.record_success()
+    if job_counters is not None:
+        job_counters.increment('json_repairs')
+    return flagged_sections
+
+
+# === Send a single chapter to Gemini ===
+def send_chapter_to_gemini(chapter_text: str, chapter_file_name: str = "Unknown Chapter", job_id: str = None,
+                           job_counters: JobCounters = None) -> Optional[List[Dict]]:
+    """Sends a chapter text to the Gemini API for analysis with retries.
+
+    Returns the flagged sections (possibly empty), or None if the chapter could not be analyzed.
+    """
+    return send_prompt_to_gemini(build_prompt(chapter_text), chapter_file_name, job_id, job_counters)
+
+
+def send_prompt_to_gemini(messages: List[Dict], chapter_file_name: str = "Unknown Chapter", job_id: str = None,
+                          job_counters: JobCounters = None) -> Optional[List[Dict]]:
+    """Sends prepared prompt messages to the Gemini API with retries and parses the flagged sections.
+
+    Returns the flagged sections (possibly empty), or None if the request failed.
+    """
+    log_prefix = f"[Job {job_id}] " if job_id else ""
+    if not genai_initialized:
+        print(f"{log_prefix}Gemini API not initialized, cannot send chapter {chapter_file_name}.")
+        return None
+
+    for attempt in range(MAX_API_RETRIES):
+        if not gemini_circuit_breaker.allow_request():
+            print(f"{log_prefix}Gemini circuit breaker is open. Not sending chapter {chapter_file_name}.")
+            record_gemini_error(job_counters, GEMINI_ERROR_CIRCUIT_OPEN)
+            return None
+        try:
+            if gemini_rate_limiter:
+                record_rate_limit_wait(job_counters, gemini_rate_limiter.acquire(estimate_filter_request_tokens(messages), job_counters))
+            print(f"{log_prefix}Attempt {attempt + 1}/{MAX_API_RETRIES} for chapter {chapter_file_name}.")
+            response = filter_model().generate_content(
+                messages,
+                generation_config={"temperature": 0.3},
+                request_options={'timeout': 60} # Added 60-second timeout
+            )
+            record_token_usage(job_counters, response)
+            flagged_sections = parse_gemini_response(response, chapter_file_name, log_prefix)
+            gemini_circuit_breaker.record_success()
+            return flagged_sections
+
+        except Exception as e:
+            error_class = classify_gemini_error(e)
+            record_gemini_error(job_counters, error_class)
+            if error_class == GEMINI_ERROR_REPAIRABLE:
+                return repair_gemini_json(e.response_text, chapter_file_name, job_id, job_counters)
+            if error_class == GEMINI_ERROR_NON_RETRYABLE:
+                print(f"{log_prefix}Non-retryable Gemini error for chapter {chapter_file_name}: {e}")
+                return None
+            print(f"{log_prefix}Error calling Gemini API for chapter {chapter_file_name} (Attempt {attempt + 1}/{MAX_API_RETRIES}): {e}")
+            if attempt < MAX_API_RETRIES - 1:
+                delay = RETRY_BASE_DELAY_SECONDS * (2 ** attempt) + random.uniform(0, 1) # Exponential backoff with jitter
+                print(f"{log_prefix}Retrying in {delay:.2f} seconds...")
+                time.sleep(delay)
+            else:
+                print(f"{log_prefix}Max retries reached for chapter {chapter_file_name}. Giving up.")
+                return None
+    return None # Should be unreachable if loop completes, but as a fallback
+
+
+def parse_gemini_response(response, chapter_file_name: str, log_prefix: str = "") -> List[Dict]:
+    """Extracts the flagged sections from a Gemini response.
+
+    Raises GeminiResponseBlocked, GeminiEmptyResponse or GeminiMalformedResponse, which
+    classify_gemini_error maps to a retry decision.
+    """
+    if not response.candidates:
+        print(f"{log_prefix}  → Gemini returned no candidates for chapter {chapter_file_name}.")
+        if response.prompt_feedback and response.prompt_feedback.block_reason:
+            print(f"{log_prefix}  → Request blocked due to: {response.prompt_feedback.block_reason}")
+        elif response.prompt_feedback and response.prompt_feedback.safety_ratings:
+            print(f"{log_prefix}  → Request blocked due to safety settings: {response.prompt_feedback.safety_ratings}")
+        # Do not retry on block reasons, as it's unlikely to change
+        raise GeminiResponseBlocked(f"No candidates returned for chapter {chapter_file_name}")
+
+    if not hasattr(response, 'text') or not response.text:
+        print(f"{log_prefix}  → Gemini returned empty text content for chapter {chapter_file_name}.")
+        raise GeminiEmptyResponse(f"Empty response for chapter {chapter_file_name}")
+
+    json_match = re.search(r"```json\s*(.*?)\s*```", response.text, re.DOTALL)
+    if json_match:
+        json_string = json_match.group(1)
+    else:
+        json_string = response.text.strip()
+        print(f"{log_prefix}  → Warning: No JSON code block found for chapter {chapter_file_name}. Attempting to parse full response text.")
+        if not json_string.startswith('{') or not json_string.endswith('}'):
+            print(f"{log_prefix}  → Response text does not look like JSON for chapter {chapter_file_name}: {json_string[:100]}...")
+            raise GeminiMalformedResponse("Response is not JSON", response.text)
+
+    try:
+        output = json.loads(json_string)
+    except json.JSONDecodeError as e:
+        print(f"{log_prefix}  → Failed to parse JSON response from text for chapter {chapter_file_name}: {response.text[:500]}...")
+        raise GeminiMalformedResponse(f"Invalid JSON: {e}", response.text)
+    if isinstance(output, dict) and "sections" in output and isinstance(output["sections"], list):
+        return output["sections"]
+    print(f"{log_prefix}  → Gemini response did not match expected JSON structure for chapter {chapter_file_name}: {response.text[:500]}...")
+    raise GeminiMalformedResponse("Unexpected JSON structure", response.text)
+
+
+# === Adaptive Concurrency ===
+OVERLOAD_ERROR_TYPES = (
+    google_exceptions.ResourceExhausted, # 429
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable, # 503
+    google_exceptions.DeadlineExceeded,
+    asyncio.TimeoutError,
+)
+
+def is_overload_error(error: BaseException) -> bool:
+    """True for errors that mean the API wants less traffic (rate limits, overload, deadlines)."""
+    return isinstance(error, OVERLOAD_ERROR_TYPES) or '429' in str(error)
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on in-flight Gemini requests, shared by every job on the dispatch loop.
+
+    Each full window of healthy successes (latency under the target) raises the limit by one;
+    a rate-limit or deadline error multiplies it by CONCURRENCY_DECREASE_FACTOR. Only requests
+    started after the last decrease can trigger another one, so a single burst of 429s from an
+    overshoot shrinks the limit once. With minimum == maximum it is a plain fixed semaphore.
+
+    The limit has to exceed the quota to find it: against a fixed concurrency quota it peaks at
+    quota + 1, and each probe costs the requests that ran while it was over (a handful per cycle),
+    before settling between CONCURRENCY_DECREASE_FACTOR * (quota + 1) and quota + 1.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, latency_target_seconds: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target_seconds = latency_target_seconds
+        self.limit = max(minimum, min(initial, maximum))
+        self.peak_limit = self.limit
+        self.in_flight = 0
+        self._healthy_in_window = 0
+        self._last_decrease_at = float('-inf')
+        self._condition = asyncio.Condition()
+
+    def slot(self) -> "_ConcurrencySlot":
+        """Async context manager holding one request slot; the outcome is read from how the block exits."""
+        return _ConcurrencySlot(self)
+
+    async def _acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def _release(self, started_at: float, error: Optional[BaseException], record_outcome: bool = True) -> None:
+        now = asyncio.get_running_loop().time()
+        if record_outcome and error is None:
+            self._record_success(now - started_at)
+        elif record_outcome and is_overload_error(error):
+            self._record_overload(started_at, now)
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _record_success(self, latency_seconds: float) -> None:
+        if latency_seconds > self.latency_target_seconds or self.in_flight < self.limit:
+            return # Slow, or the current limit is not even in use yet
+        self._healthy_in_window += 1
+        if self._healthy_in_window >= self.limit and self.limit < self.maximum:
+            self.limit += 1
+            self.peak_limit = max(self.peak_limit, self.limit)
+            self._healthy_in_window = 0
+
+    def _record_overload(self, started_at: float, now: float) -> None:
+        if started_at < self._last_decrease_at:
+            return # Already backed off for the burst this request belonged to
+        self.limit = max(self.minimum, int(self.limit * CONCURRENCY_DECREASE_FACTOR))
+        self._healthy_in_window = 0
+        self._last_decrease_at = now
+
+
+class _ConcurrencySlot:
+    def __init__(self, limiter: AdaptiveConcurrencyLimiter):
+        self._limiter = limiter
+        self._started_at = None
+        self._abandoned = False
+
+    def abandon(self) -> None:
+        """The request was not sent after all; release the slot without counting an outcome."""
+        self._abandoned = True
+
+    async def __aenter__(self):
+        await self._limiter._acquire()
+        self._started_at = asyncio.get_running_loop().time()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._limiter._release(self._started_at, exc_value, record_outcome=not self._abandoned)
+        return False
+
+
+_gemini_concurrency_limiter = None
+_gemini_concurrency_limiter_lock = threading.Lock()
+
+def get_gemini_concurrency_limiter() -> AdaptiveConcurrencyLimiter:
+    """Returns the instance-wide limiter for async dispatch (fixed at MAX_CONCURRENT_CHAPTERS unless ADAPTIVE_CONCURRENCY)."""
+    global _gemini_concurrency_limiter
+    with _gemini_concurrency_limiter_lock:
+        if _gemini_concurrency_limiter is None:
+            if ADAPTIVE_CONCURRENCY:
+                _gemini_concurrency_limiter = AdaptiveConcurrencyLimiter(
+                    MAX_CONCURRENT_CHAPTERS, MIN_CONCURRENT_REQUESTS, MAX_CONCURRENT_REQUESTS, CONCURRENCY_LATENCY_TARGET_SECONDS
+                )
+            else:
+                _gemini_concurrency_limiter = AdaptiveConcurrencyLimiter(
+                    MAX_CONCURRENT_CHAPTERS, MAX_CONCURRENT_CHAPTERS, MAX_CONCURRENT_CHAPTERS, CONCURRENCY_LATENCY_TARGET_SECONDS
+                )
+        return _gemini_concurrency_limiter
+
+
+# === Async Gemini Dispatch ===
+# Requests run as coroutines on one long-lived event loop thread. The loop is shared across jobs
+# because the async Gemini client binds to the loop it was first used on.
+_gemini_event_loop = None
+_gemini_event_loop_lock = threading.Lock()
+
+def get_gemini_event_loop() -> asyncio.AbstractEventLoop:
+    """Returns the shared Gemini event loop, starting its thread on first use."""
+    global _gemini_event_loop
+    with _gemini_event_loop_lock:
+        if _gemini_event_loop is None:
+            _gemini_event_loop = asyncio.new_event_loop()
+            threading.Thread(target=_gemini_event_loop.run_forever, name="gemini-dispatch", daemon=True).start()
+            print("Started Gemini async dispatch loop.")
+        return _gemini_event_loop
+
+
+async def send_prompt_to_gemini_async(messages: List[Dict], chapter_file_name: str, job_id: str,
+                                      limiter: AdaptiveConcurrencyLimiter, deadline_seconds: float = None,
+                                      job_counters: JobCounters = None) -> Optional[List[Dict]]:
+    """Async counterpart of send_prompt_to_gemini.
+
+    Only the API call holds a limiter slot; backoff uses asyncio.sleep. Retries stop once the
+    per-request deadline has passed.
+    """
+    log_prefix = f"[Job {job_id}] " if job_id else ""
+    if not genai_initialized:
+        print(f"{log_prefix}Gemini API not initialized, cannot send chapter {chapter_file_name}.")
+        return None
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (deadline_seconds or GEMINI_REQUEST_DEADLINE_SECONDS)
+    for attempt in range(MAX_API_RETRIES):
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            print(f"{log_prefix}Deadline reached for chapter {chapter_file_name}. Giving up.")
+            return None
+        probe = gemini_circuit_breaker.admit()
+        if probe is None:
+            print(f"{log_prefix}Gemini circuit breaker is open. Not sending chapter {chapter_file_name}.")
+            record_gemini_error(job_counters, GEMINI_ERROR_CIRCUIT_OPEN)
+            return None
+        try:
+            if gemini_rate_limiter:
+                record_rate_limit_wait(job_counters, await gemini_rate_limiter.acquire_async(estimate_filter_request_tokens(messages), job_counters))
+            async with limiter.slot() as slot:
+                remaining = deadline - loop.time() # Waiting for the rate limiter and the slot used up part of the budget
+                if remaining <= 0:
+                    slot.abandon()
+                    print(f"{log_prefix}Deadline reached for chapter {chapter_file_name} while waiting to send. Giving up.")
+                    return None
+                print(f"{log_prefix}Attempt {attempt + 1}/{MAX_API_RETRIES} for chapter {chapter_file_name}.")
+                response = await asyncio.wait_for(
+                    filter_model().generate_content_async(
+                        messages,
+                        generation_config={"temperature": 0.3},
+                        request_options={'timeout': min(GEMINI_ATTEMPT_TIMEOUT_SECONDS, remaining)}
+                    ),
+                    timeout=min(GEMINI_ATTEMPT_TIMEOUT_SECONDS, remaining)
+                )
+            record_token_usage(job_counters, response)
+            flagged_sections = parse_gemini_response(response, chapter_file_name, log_prefix)
+            gemini_circuit_breaker.record_success()
+            return flagged_sections
+
+        except Exception as e:
+            error_class = classify_gemini_error(e)
+            record_gemini_error(job_counters, error_class)
+            if error_class == GEMINI_ERROR_REPAIRABLE:
+                return await repair_gemini_json_async(e.response_text, chapter_file_name, job_id, limiter, job_counters)
+            if error_class == GEMINI_ERROR_NON_RETRYABLE:
+                print(f"{log_prefix}Non-retryable Gemini error for chapter {chapter_file_name}: {e!r}")
+                return None
+            print(f"{log_prefix}Error calling Gemini API for chapter {chapter_file_name} (Attempt {attempt + 1}/{MAX_API_RETRIES}): {e!r}")
+            delay = RETRY_BASE_DELAY_SECONDS * (2 ** attempt) + random.uniform(0, 1) # Exponential backoff with jitter
+            if attempt < MAX_API_RETRIES - 1 and loop.time() + delay < deadline:
+                print(f"{log_prefix}Retrying in {delay:.2f} seconds...")
+                await asyncio.sleep(delay)
+            else:
+                print(f"{log_prefix}Max retries or deadline reached for chapter {chapter_file_name}. Giving up.")
+                return None
+        finally:
+            gemini_circuit_breaker.abandon_probe(probe) # No-op once the outcome is recorded; frees a cancelled probe
+    return None
+
+
+async def repair_gemini_json_async(malformed_text: str, chapter_file_name: str, job_id: str,
+                                   limiter: AdaptiveConcurrencyLimiter, job_counters: JobCounters = None) -> Optional[List[Dict]]:
+    """Async counterpart of repair_gemini_json."""
+    log_prefix = f"[Job {job_id}] " if job_id else ""
+    if not malformed_text.strip():
+        return None
+    probe = gemini_circuit_breaker.admit()
+    if probe is None:
+        return None
+    print(f"{log_prefix}  → Re-asking Gemini to repair malformed JSON for chapter {chapter_file_name}.")
+    messages = build_json_repair_prompt(malformed_text)
+    try:
+        if gemini_rate_limiter:
+            record_rate_limit_wait(job_counters, await gemini_rate_limiter.acquire_async(estimate_prompt_tokens(messages), job_counters))
+        async with limiter.slot():
+            response = await asyncio.wait_for(
+                model.generate_content_async(messages, generation_config={"temperature": 0},
+                                             request_options={'timeout': GEMINI_ATTEMPT_TIMEOUT_SECONDS}),
+                timeout=GEMINI_ATTEMPT_TIMEOUT_SECONDS
+            )
+        record_token_usage(job_counters, response)
+        flagged_sections = parse_gemini_response(response, chapter_file_name, log_prefix)
+        gemini_circuit_breaker.record_success()
+    except Exception as e:
+        record_gemini_error(job_counters, classify_gemini_error(e))
+        print(f"{log_prefix}  → JSON repair failed for chapter {chapter_file_name}: {e!r}")
+        return None
+    finally:
+        gemini_circuit_breaker.abandon_probe(probe)
+    if job_counters is not None:
+        job_counters.increment('json_repairs')
+    return flagged_sections
+
+
+class AsyncGeminiDispatcher:
+    """Per-job front end to the shared Gemini event loop, used in place of a ThreadPoolExecutor.
+
+    submit() takes a coroutine and returns a concurrent.futures.Future, so the synchronous
+    processing code keeps using concurrent.futures.wait. Leaving the with-block waits for every submitted request.
+    """
+
+    def __init__(self):
+        self._loop = get_gemini_event_loop()
+        self.limiter = get_gemini_concurrency_limiter()
+        self._futures = set() # Pending requests only, so a long book does not accumulate finished futures
+
+    def submit(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pending = list(self._futures)
+        if exc_type is not None:
+            for future in pending:
+                future.cancel()
+        for future in pending:
+            try:
+                future.result()
+            except BaseException:
+                pass # Already reported through the future by the caller
+        return False
+
+
+# === Local Pre-screen ===
+# Weighted lexicon for the content build_prompt asks Gemini to flag. A chapter's score is the
+# highest weight sum of hits inside any PRESCREEN_WINDOW_CHARS window, since explicit scenes are
+# dense and local while the same words scattered over a long chapter usually are not.
+# Tune weights and PRESCREEN_THRESHOLD with `python epub_benchmarks.py prescreen`.
+PRESCREEN_LEXICON = {
+    r'orgasms?': 3.0,
+    r'clit(?:oris)?': 3.0,
+    r'erections?': 3.0,
+    r'his length': 3.0,
+    r'come for me': 3.0,
+    r'inside me': 3.0,
+    r'my core': 2.0,
+    r'climax(?:es|ed|ing)?': 2.0,
+    r'nipples?': 2.0,
+    r'arous(?:al|ed)': 2.0,
+    r'condoms?': 2.0,
+    r'breasts?': 1.5,
+    r'naked': 1.5,
+    r'nude': 1.5,
+    r'undress(?:es|ed|ing)?': 1.5,
+    r'sex(?:ual|ually|y)?': 1.0,
+    r'moan(?:s|ed|ing)?': 1.0,
+    r'thrust(?:s|ed|ing)?': 1.0,
+    r'cock': 1.0,
+    r'lick(?:s|ed|ing)?': 1.0,
+    r'tongue': 0.5,
+    r'thighs?': 0.5,
+    r'hips': 0.5,
+    r'groan(?:s|ed|ing)?': 0.5,
+    r'kiss(?:es|ed|ing)?': 0.3,
+    r'pants': 0.3,
+    r'shirt': 0.2,
+    r'bed': 0.2,
+}
+PRESCREEN_PATTERN = re.compile(r'\b(?:' + '|'.join(f'({term})' for term in PRESCREEN_LEXICON) + r')\b', re.IGNORECASE)
+PRESCREEN_WEIGHTS = list(PRESCREEN_LEXICON.values())
+PRESCREEN_LEXICON_DIGEST = hashlib.sha256(json.dumps(PRESCREEN_LEXICON, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def prescreen_cache_tag() -> str:
+    """Pre-screen part of the book cache key, so results computed with other settings are not replayed."""
+    if PRESCREEN_THRESHOLD <= 0:
+        return "prescreen-off"
+    return f"prescreen:{PRESCREEN_THRESHOLD}:{PRESCREEN_WINDOW_CHARS}:{PRESCREEN_LEXICON_DIGEST}"
+
+
+def prescreen_score(chapter_text: str, window_chars: int = None) -> float:
+    """Scores how likely a chapter is to contain flaggable content, in one regex pass."""
+    window_chars = window_chars or PRESCREEN_WINDOW_CHARS
+    window_hits = deque()
+    window_score = 0.0
+    best_score = 0.0
+    for match in PRESCREEN_PATTERN.finditer(chapter_text):
+        weight = PRESCREEN_WEIGHTS[match.lastindex - 1]
+        window_hits.append((match.start(), weight))
+        window_score += weight
+        while window_hits[0][0] < match.start() - window_chars:
+            window_score -= window_hits.popleft()[1]
+        best_score = max(best_score, window_score)
+    return round(best_score, 2)
+
+
+def chapter_needs_analysis(chapter_text: str, threshold: float = None) -> bool:
+    """True if the chapter scores at or above the pre-screen threshold and should go to Gemini."""
+    threshold = PRESCREEN_THRESHOLD if threshold is None else threshold
+    return threshold <= 0 or prescreen_score(chapter_text) >= threshold
+
+
+# === Chapter Request Packing ===
+# Gemini requests are sized by an estimated token budget instead of one request per spine item:
+# short adjacent chapters share a request and oversized chapters are split, and every result
+# is mapped back to the chapter it came from.
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?\u2026"\u201d\u2019])\s')
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN_ESTIMATE + 1
+
+
+def split_chapter_text(text: str, max_chars: int) -> List[tuple]:
+    """Splits text into (offset, part) pieces of at most max_chars, cutting after a sentence where possible.
+
+    Extraction collapses whitespace, so sentence ends are the closest remaining paragraph boundaries.
+    """
+    parts = []
+    start = 0
+    while len(text) - start > max_chars:
+        window_end = start + max_chars
+        cut = None
+        for match in SENTENCE_BOUNDARY.finditer(text, start + max_chars // 2, window_end):
+            cut = match.start()
+        if cut is None:
+            cut = text.rfind(' ', start + 1, window_end)
+        if cut <= start:
+            cut = window_end
+        parts.append((start, text[start:cut]))
+        start = cut + 1 if text[cut] == ' ' else cut
+    parts.append((start, text[start:]))
+    return parts
+
+
+def _chapter_segment(chapter: Dict, text: str = None, part: int = 0, part_count: int = 1, offset: int = 0) -> Dict:
+    return {
+        'chapter_index': chapter['index'],
+        'file': chapter.get('file', f"Chapter_{chapter['index']}"),
+        'text': chapter['text'] if text is None else text,
+        'part': part,
+        'part_count': part_count,
+        'offset': offset
+    }
+
+
+def pack_chapter_requests(chapters, token_budget: int = None, small_chapter_tokens: int = None):
+    """Groups chapters (dicts with "index" and "text") into Gemini requests, yielding each one as soon as it is complete.
+
+    Adjacent chapters of at most small_chapter_tokens are packed together up to token_budget,
+    chapters over token_budget are split into parts, and everything else is sent on its own.
+    Each request is {"segments": [...]}; a segment names its chapter_index, part and part_count.
+    """
+    token_budget = token_budget or GEMINI_REQUEST_TOKEN_BUDGET
+    small_chapter_tokens = small_chapter_tokens or SMALL_CHAPTER_TOKENS
+    batch = []
+    batch_tokens = 0
+    for chapter in chapters:
+        chapter_tokens = estimate_tokens(chapter['text'])
+        if chapter_tokens <= small_chapter_tokens:
+            if batch and batch_tokens + chapter_tokens > token_budget:
+                yield {'segments': batch}
+                batch, batch_tokens = [], 0
+            batch.append(_chapter_segment(chapter))
+            batch_tokens += chapter_tokens
+            continue
+
+        if batch:
+            yield {'segments': batch}
+            batch, batch_tokens = [], 0
+        if chapter_tokens <= token_budget:
+            yield {'segments': [_chapter_segment(chapter)]}
+        else:
+            parts = split_chapter_text(chapter['text'], token_budget * CHARS_PER_TOKEN_ESTIMATE)
+            for part, (offset, part_text) in enumerate(parts):
+                yield {'segments': [_chapter_segment(chapter, part_text, part, len(parts), offset)]}
+    if batch:
+        yield {'segments': batch}
+
+
+def describe_chapter_request(request: Dict) -> str:
+    """Human-readable label of a request for logs."""
+    segments = request['segments']
+    if len(segments) == 1 and segments[0]['part_count'] > 1:
+        return f"{segments[0]['file']} (part {segments[0]['part'] + 1}/{segments[0]['part_count']})"
+    return ", ".join(segment['file'] for segment in segments)
+
+
+def assign_sections_to_segments(flagged_sections: List[Dict], segments: List[Dict]) -> List[List[Dict]]:
+    """Maps sections returned for a packed request back to their segments using the "segment" number Gemini echoes.
+
+    Sections with a missing or invalid number are matched by locating their text in a segment. The snippet is
+    shortened until it is found, so a section running past the end of its chapter goes to the one it starts in.
+    """
+    def locate(snippet: str) -> int:
+        for prefix in dict.fromkeys(snippet[:length] for length in (80, 40, 20) if snippet): # Distinct prefixes, longest first
+            position = next((i for i, segment in enumerate(segments) if prefix in segment['text']), None)
+            if position is not None:
+                return position
+        return 0
+
+    sections_per_segment = [[] for _ in segments]
+    for section in flagged_sections:
+        segment_number = section.pop('segment', None)
+        try:
+            position = int(segment_number) - 1
+        except (TypeError, ValueError):
+            position = -1
+        if not 0 <= position < len(segments):
+            position = locate(str(section.get('text') or section.get('start') or ''))
+        sections_per_segment[position].append(section)
+    return sections_per_segment
+
+
+def analyze_chapter_request(request: Dict, job_id: str, job_counters: JobCounters) -> Optional[List[List[Dict]]]:
+    """Sends one packed or split request to Gemini. Returns flagged sections per segment, or None on failure."""
+    segments = request['segments']
+    job_counters.increment('gemini_requests')
+    if len(segments) == 1:
+        flagged_sections = send_chapter_to_gemini(segments[0]['text'], describe_chapter_request(request), job_id, job_counters)
+        return None if flagged_sections is None else [flagged_sections]
+    flagged_sections = send_prompt_to_gemini(build_packed_prompt(segments), describe_chapter_request(request), job_id, job_counters)
+    return None if flagged_sections is None else assign_sections_to_segments(flagged_sections, segments)
+
+
+async def analyze_chapter_request_async(request: Dict, job_id: str, job_counters: JobCounters,
+                                        limiter: AdaptiveConcurrencyLimiter) -> Optional[List[List[Dict]]]:
+    """Async counterpart of analyze_chapter_request, run on the Gemini dispatch loop."""
+    segments = request['segments']
+    job_counters.increment('gemini_requests')
+    messages = build_prompt(segments[0]['text']) if len(segments) == 1 else build_packed_prompt(segments)
+    flagged_sections = await send_prompt_to_gemini_async(messages, describe_chapter_request(request), job_id, limiter,
+                                                         job_counters=job_counters)
+    if flagged_sections is None:
+        return None
+    return [flagged_sections] if len(segments) == 1 else assign_sections_to_segments(flagged_sections, segments)
+
+
+# === Profanity Counting ===
+# The counter lives in profanity.py so the CLI can share it without importing this module's service setup
+profanity_counter = init_profanity_counter(PROFANITY_LEXICON_PATH)
+
+
+# === Section Anchoring ===
+# Gemini echoes flagged passages back with small differences (quotes, whitespace, a dropped word), so each
+# section is located in the extracted chapter text and emitted with character offsets. The reader can then hide
+# ranges directly instead of rebuilding a regex per section on every page.
+ANCHOR_METHOD_EXACT = "exact"
+ANCHOR_METHOD_FUZZY = "fuzzy"
+ANCHOR_METHOD_UNMATCHED = "unmatched"
+ANCHOR_METHODS = (ANCHOR_METHOD_EXACT, ANCHOR_METHOD_FUZZY, ANCHOR_METHOD_UNMATCHED)
+
+def anchor_words(text: str) -> List[tuple]:
+    """Returns (normalized word, start, end) for every whitespace-separated token that has word characters."""
+    words = []
+    for match in re.finditer(r'\S+', text):
+        word = normalize_token(match.group())
+        if word:
+            words.append((word, match.start(), match.end()))
+    return words
+
+
+def fuzzy_anchor_span(section_words: List[str], chapter_words: List[tuple]) -> Optional[tuple]:
+    """Aligns a section's words against the chapter's words. Returns (start word, end word, confidence) or None.
+
+    Word n-grams shared by both vote for an alignment (chapter position minus section position); the densest
+    cluster of votes gives a window, and difflib's ratio over the window's words gives the confidence.
+    """
+    ngram_words = min(SECTION_ANCHOR_NGRAM_WORDS, len(section_words))
+    if ngram_words == 0:
+        return None
+    section_ngrams = {}
+    for i in range(len(section_words) - ngram_words + 1):
+        section_ngrams.setdefault(tuple(section_words[i:i + ngram_words]), []).append(i)
+    chapter_word_list = [word for word, _, _ in chapter_words]
+    hits = [] # (chapter position - section position, section position, chapter position)
+    for position in range(len(chapter_word_list) - ngram_words + 1):
+        for i in section_ngrams.get(tuple(chapter_word_list[position:position + ngram_words]), ()):
+            hits.append((position - i, i, position))
+    if not hits:
+        return None
+
+    hits.sort()
+    tolerance = max(8, len(section_words) // 5) # Dropped or added words shift the alignment a little
+    best_low, best_high, low = 0, 0, 0
+    for high in range(len(hits)):
+        while hits[high][0] - hits[low][0] > tolerance:
+            low += 1
+        if high - low > best_high - best_low:
+            best_low, best_high = low, high
+    cluster = hits[best_low:best_high + 1]
+    first = min(cluster, key=lambda hit: hit[1])
+    last = max(cluster, key=lambda hit: hit[1])
+    window_start = max(0, first[2] - first[1])
+    window_end = min(len(chapter_word_list), last[2] + len(section_words) - last[1])
+    matcher = difflib.SequenceMatcher(None, section_words, chapter_word_list[window_start:window_end], autojunk=False)
+    blocks = [block for block in matcher.get_matching_blocks() if block.size]
+    # Trim to the words that actually matched, so words Gemini added at either end do not widen the span
+    return window_start + blocks[0].b, window_start + blocks[-1].b + blocks[-1].size, matcher.ratio()
+
+
+def locate_passage(passage: str, chapter_text: str, get_chapter_words: Callable[[], List[tuple]],
+                   search_from: int = 0) -> Optional[tuple]:
+    """Finds passage in chapter_text at or after search_from. Returns (start, end, confidence, method) or None.
+
+    Exact search first; otherwise the fuzzy word alignment (over get_chapter_words(), only built when needed),
+    accepted at SECTION_ANCHOR_MIN_CONFIDENCE or above.
+    """
+    start = chapter_text.find(passage, search_from)
+    if start >= 0:
+        return start, start + len(passage), 1.0, ANCHOR_METHOD_EXACT
+    candidate_words = [word for word in get_chapter_words() if word[1] >= search_from]
+    span = fuzzy_anchor_span([word for word, _, _ in anchor_words(passage)], candidate_words)
+    if span is None or span[2] < SECTION_ANCHOR_MIN_CONFIDENCE:
+        return None
+    start_word, end_word, confidence = span
+    return candidate_words[start_word][1], candidate_words[end_word - 1][2], round(confidence, 3), ANCHOR_METHOD_FUZZY
+
+
+def anchor_flagged_sections(chapter_file_name: str, chapter_text: str, flagged_sections: List[Dict],
+                            job_counters: Optional[JobCounters] = None) -> List[Dict]:
+    """Returns copies of the sections with file, start_offset/end_offset into chapter_text and match_confidence.
+
+    A section is placed by its full "text" or, in anchor-only output mode, by its "start" and "end" snippets;
+    those sections get "text" = chapter_text[start_offset:end_offset]. Sections that cannot be placed get
+    match_method "unmatched" and needs_requery so they can be sent again.
+    """
+    anchored_sections = []
+    chapter_words = []
+
+    def get_chapter_words() -> List[tuple]:
+        if not chapter_words:
+            chapter_words.extend(anchor_words(chapter_text))
+        return chapter_words
+
+    for section in flagged_sections:
+        section_text = str(section.get("text") or "").strip()
+        start_snippet = str(section.get("start") or "").strip()
+        end_snippet = str(section.get("end") or "").strip()
+        anchor = {'file': chapter_file_name, 'start_offset': None, 'end_offset': None, 'match_confidence': 0.0,
+                  'match_method': ANCHOR_METHOD_UNMATCHED}
+        if section_text:
+            match = locate_passage(section_text, chapter_text, get_chapter_words)
+            if match is not None:
+                anchor.update(start_offset=match[0], end_offset=match[1], match_confidence=match[2], match_method=match[3])
+        elif start_snippet and end_snippet:
+            start_match = locate_passage(start_snippet, chapter_text, get_chapter_words)
+            end_match = locate_passage(end_snippet, chapter_text, get_chapter_words, start_match[0]) if start_match else None
+            if end_match is not None:
+                exact = start_match[3] == end_match[3] == ANCHOR_METHOD_EXACT
+                anchor.update(start_offset=start_match[0], end_offset=end_match[1],
+                              match_confidence=min(start_match[2], end_match[2]),
+                              match_method=ANCHOR_METHOD_EXACT if exact else ANCHOR_METHOD_FUZZY,
+                              text=chapter_text[start_match[0]:end_match[1]])
+        if anchor['match_method'] == ANCHOR_METHOD_UNMATCHED:
+            anchor['needs_requery'] = True
+        if job_counters is not None:
+            job_counters.increment(f"anchored_sections_{anchor['match_method']}")
+        anchored_sections.append(dict(section, **anchor))
+    return anchored_sections
+
+
+def flagged_section_length(section: Dict) -> int:
+    """Characters a section covers: its anchored span, or the length of its text if it could not be placed."""
+    if section.get('start_offset') is not None:
+        return section['end_offset'] - section['start_offset']
+    return len(section.get("text") or "")
+
+
+# === Book Report Aggregation ===
+
+class BookReportAggregator:
+    """Accumulates per-chapter results into the book-level totals reported to the client, Firestore and Supabase."""
+
+    def __init__(self):
+        self.all_flagged_sections = []
+        self.total_char_count = 0
+        self.chapters_processed_count = 0
+        self.swear_word_count_map = {}
+        self.swear_word_offsets = {} # chapter file -> {word: [(start, end), ...]} in that chapter's text
+        self.chapters = [] # {'file', 'chapter_index', 'cfi_base', 'text_length', 'text_sha1'} per processed chapter
+        self.flagged_chapter_count = 0
+        self.flagged_content_char_count = 0
+        self.flagged_chapter_titles = []
+
+    def add_chapter(self, chapter_file_name: str, chapter_text: str, flagged_sections: List[Dict],
+                    chapter_index: int = None, cfi_base: str = None) -> None:
+        self.total_char_count += len(chapter_text)
+        self.chapters_processed_count += 1
+        self.chapters.append({
+            'file': chapter_file_name,
+            'chapter_index': chapter_index,
+            'cfi_base': cfi_base,
+            'text_length': len(chapter_text),
+            'text_sha1': hashlib.sha1(chapter_text.encode('utf-8')).hexdigest() # Checked when CFIs are computed later
+        })
+
+        # Count swear words in the current chapter
+        chapter_swear_words = profanity_counter.scan(chapter_text)
+        if chapter_swear_words:
+            self.swear_word_offsets[chapter_file_name] = chapter_swear_words
+        for word, spans in chapter_swear_words.items():
+            self.swear_word_count_map[word] = self.swear_word_count_map.get(word, 0) + len(spans)
+
+        if flagged_sections:
+            chapter_title_from_gemini = flagged_sections[0].get("chapter", chapter_file_name)
+            if chapter_title_from_gemini not in self.flagged_chapter_titles:
+                self.flagged_chapter_titles.append(chapter_title_from_gemini)
+            self.all_flagged_sections.extend(flagged_sections)
+            self.flagged_content_char_count += sum(flagged_section_length(section) for section in flagged_sections)
+            self.flagged_chapter_count += 1
+
+    @property
+    def total_swear_word_instances(self) -> int:
+        return sum(self.swear_word_count_map.values())
+
+    @property
+    def percentage_filtered(self) -> float:
+        return round((self.flagged_content_char_count / self.total_char_count) * 100, 1) if self.total_char_count > 0 else 0
+
+
+# === Filter Artifact ===
+# A compact, versioned per-book artifact the reader can apply without searching page text: for every spine item
+# with hits, sorted non-overlapping hide ranges and word hits, each as [start, end] offsets into the extracted
+# chapter text plus an EPUB CFI range relative to the item's cfi_base (epubcfi(<cfi_base>!<cfi>)).
+FILTER_ARTIFACT_VERSION = 1
+CFI_SPECIAL_CHARACTERS = re.compile(r'([\^\[\](),;=])')
+
+def merge_ranges(ranges: Iterable[Tuple[int, int]]) -> List[List[int]]:
+    """Sorts [start, end) ranges and merges overlapping or touching ones."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
 
-    if not chapters:
-        print("Warning: No suitable chapters found in the EPUB.")
-    return chapters
+def _cfi_step(index: int, element=None) -> str:
+    element_id = element.get('id') if element is not None else None
+    if isinstance(element_id, str) and element_id:
+        escaped_id = CFI_SPECIAL_CHARACTERS.sub(r'^\1', element_id)
+        return f"/{index}[{escaped_id}]"
+    return f"/{index}"
 
 
-# === Build Gemini prompt ===
-# Keep your existing build_prompt function
-def build_prompt(chapter_text: str) -> List[Dict]:
-    return [{
-        "role": "user",
-        "parts": [{
-            "text": f"""
-                You are an AI tasked with identifying and marking **explicit sexual content or erotica** within book chapters for creating a clean reading experience.
+class ChapterTextMap:
+    """Rebuilds a chapter's extracted text from its DOM, remembering where every character came from.
 
-                You will be given the text of a single book chapter.
+    Follows extract_text_bs4 (same strings, strip and whitespace collapsing), so offsets into chapter text can be
+    turned into CFI steps: even steps for elements below <html>, an odd step for the text chunk, then ":offset".
+    """
 
-                Your task is to identify and flag sexually explicit dialog, sentences, phrases, or continuous blocks of text that represent **complete scenes or extended passages** containing:
-                    - Explicit descriptions of sex acts (including intercourse, oral sex, etc.)
-                    - Graphic depictions of nudity or sexual arousal
-                    - Reference to sexual acts that invoke strong visual imagery
-                    - Detailed descriptions of sexual organs or bodily functions in a sexual context
-                    - Highly graphic or detailed accounts of physical intimacy that are equivalent to erotica or pornography.
+    def __init__(self, content_str: str):
+        soup = bs4.BeautifulSoup(content_str, "html.parser")
+        self._text_types = soup.interesting_string_types
+        self._strings = [] # (element steps or None outside <html>, chunk step, chunk offset of the string)
+        self._char_strings = [] # per text character: index into _strings, or -1 for a joining space
+        self._char_offsets = [] # per text character: offset within its string
+        self._chars = []
+        self._walk(soup, None)
+        self.text = ''.join(self._chars)
 
-                To accomplish this task effectively, please follow these internal steps before generating the final JSON output:
-                1.  **Scan for Intimate Content:** Read through the chapter and identify any areas describing physical intimacy, kissing, touching, or emotionally intense romantic interactions.
-                2.  **Evaluate Explicitness:** For each identified area, carefully evaluate if it meets the **strict criteria for explicit sexual content or erotica** defined below. Focus *only* on the graphic physical descriptions of sex acts.
-                3.  **Define Scene Boundaries:** If an area *does* meet the explicit criteria, determine the **full, continuous scene or passage** where this explicit content occurs. Identify the natural start and end points of this *entire sequence*, including any immediately surrounding dialogue, internal thoughts, or non-graphic actions that are an integral part of *that specific intimate sequence*, but *excluding* text that occurs clearly before or after the explicit scene has concluded.
-                4.  **Format Output:** For each identified explicit scene/passage, store it under the \'text\' key.
-                5.  **Compile JSON:** Compile all identified explicit scenes/passages into the requested JSON format under the 'sections' key.
+    def _walk(self, element, element_steps: Optional[str]) -> None:
+        element_count = 0
+        chunk_offset = 0 # Characters of DOM text since the previous element child
+        for child in element.contents:
+            if isinstance(child, bs4.Tag):
+                element_count += 1
+                chunk_offset = 0
+                if element_steps is not None:
+                    child_steps = element_steps + _cfi_step(element_count * 2, child)
+                else:
+                    child_steps = '' if child.name == 'html' else None # CFI paths start at the <html> element
+                self._walk(child, child_steps)
+            elif isinstance(child, bs4.NavigableString):
+                if type(child) in self._text_types:
+                    self._add_string(child, element_steps, element_count * 2 + 1, chunk_offset)
+                if not isinstance(child, bs4.element.PreformattedString) or isinstance(child, bs4.CData):
+                    chunk_offset += len(child)
 
-                **DO NOT FLAG:**
-                - Romance, affection, or emotional intensity (even if passionate or suggestive)
-                - Kissing, hugging, or cuddling (unless they are the direct beginning or end of an explicit sexual scene you are flagging)
-                - Non-sexual descriptions of bodies or actions (e.g., violence, injury, physical appearance outside of a sexual context)
-                - Non-explicit sexual innuendo or suggestive dialogue (unless it is part of a larger explicit scene)
-                - **Do not flag dialogue or descriptions that happen *before* or *after* the explicit scene concludes, even if they are related to the relationship.**
+    def _add_string(self, string: str, element_steps: Optional[str], chunk_step: int, chunk_offset: int) -> None:
+        stripped = string.strip()
+        if not stripped:
+            return
+        string_index = len(self._strings)
+        self._strings.append((element_steps, chunk_step, chunk_offset))
+        if self._chars:
+            self._chars.append(' ')
+            self._char_strings.append(-1)
+            self._char_offsets.append(0)
+        leading = len(string) - len(string.lstrip())
+        for position, char in enumerate(stripped):
+            if char.isspace():
+                if self._chars[-1] == ' ':
+                    continue
+                char = ' '
+            self._chars.append(char)
+            self._char_strings.append(string_index)
+            self._char_offsets.append(leading + position)
 
-                Return a JSON object in this format:
-                ```json
-                {{
-                "sections": [
-                    {{
-                    "chapter": "Chapter title or number",
-                    "text": "entire text of the flagged section",
-                    "summary": "short non-descriptive, non explicit summary of the flagged section",
-                    }}
-                    // More sections if found
-                ]
-                }}
-                ```
+    def _point_steps(self, offset: int, after: bool) -> Optional[List[str]]:
+        """CFI steps for the position before text[offset] (or after it, if after=True); joining spaces are skipped."""
+        step = -1 if after else 1
+        while 0 <= offset < len(self._chars) and self._char_strings[offset] == -1:
+            offset += step
+        if not 0 <= offset < len(self._chars):
+            return None
+        element_steps, chunk_step, chunk_offset = self._strings[self._char_strings[offset]]
+        if element_steps is None:
+            return None
+        character_offset = chunk_offset + self._char_offsets[offset] + (1 if after else 0)
+        return re.findall(r'/[^/]+', element_steps) + [f"/{chunk_step}:{character_offset}"]
 
-                If no content is flagged, return:
-                {{ "sections": [] }}
-                Be conservative. If you're unsure, include the section.
+    def range_cfi(self, start: int, end: int) -> Optional[str]:
+        """CFI range ("<parent>,<start>,<end>", relative to the spine item) for text[start:end], or None."""
+        start_steps = self._point_steps(start, after=False)
+        end_steps = self._point_steps(end - 1, after=True)
+        if start_steps is None or end_steps is None:
+            return None
+        common = 0
+        while (common < min(len(start_steps), len(end_steps)) - 1
+               and start_steps[common] == end_steps[common]):
+            common += 1
+        return f"{''.join(start_steps[:common])},{''.join(start_steps[common:])},{''.join(end_steps[common:])}"
 
-                Chapter:
-                \"\"\"
-                {chapter_text}
-                \"\"\"
-            """
-        }]
-    }]
 
+def build_filter_artifact(epub_source: BinaryIO, book_report: BookReportAggregator, log_prefix: str = "") -> Dict:
+    """Builds the versioned filter artifact from anchored sections and swear word offsets.
 
-# === Send a single chapter to Gemini ===
-def send_chapter_to_gemini(chapter_text: str, chapter_file_name: str = "Unknown Chapter", job_id: str = None) -> List[Dict]:
-    """Sends a chapter text to the Gemini API for analysis with retries."""
-    log_prefix = f"[Job {job_id}] " if job_id else ""
-    if not genai_initialized:
-        print(f"{log_prefix}Gemini API not initialized, cannot send chapter {chapter_file_name}.")
-        return []
+    Only spine items with hits are re-parsed (to compute CFIs); if a re-parse does not reproduce the chapter text
+    that offsets refer to, the item keeps its offsets and gets null CFIs.
+    """
+    hide_ranges = {}
+    for section in book_report.all_flagged_sections:
+        if section.get('start_offset') is not None:
+            hide_ranges.setdefault(section.get('file'), []).append((section['start_offset'], section['end_offset']))
 
-    messages = build_prompt(chapter_text)
-    for attempt in range(MAX_API_RETRIES):
-        try:
-            print(f"{log_prefix}Attempt {attempt + 1}/{MAX_API_RETRIES} for chapter {chapter_file_name}.")
-            response = model.generate_content(
-                messages,
-                generation_config={"temperature": 0.3},
-                request_options={'timeout': 60} # Added 60-second timeout
+    spine = []
+    with zipfile.ZipFile(epub_source, 'r') as zip_ref:
+        for chapter in sorted(book_report.chapters, key=lambda chapter: (chapter['chapter_index'] is None, chapter['chapter_index'])):
+            chapter_file_name = chapter['file']
+            ranges = merge_ranges(hide_ranges.get(chapter_file_name, []))
+            word_hits = sorted(
+                (start, end, word) for word, spans in book_report.swear_word_offsets.get(chapter_file_name, {}).items()
+                for start, end in spans
             )
-            if not response.candidates:
-                print(f"{log_prefix}  → Gemini returned no candidates for chapter {chapter_file_name}.")
-                if response.prompt_feedback and response.prompt_feedback.block_reason:
-                    print(f"{log_prefix}  → Request blocked due to: {response.prompt_feedback.block_reason}")
-                elif response.prompt_feedback and response.prompt_feedback.safety_ratings:
-                    print(f"{log_prefix}  → Request blocked due to safety settings: {response.prompt_feedback.safety_ratings}")
-                # Do not retry on block reasons, as it's unlikely to change
-                return []
-
-            if not hasattr(response, 'text') or not response.text:
-                print(f"{log_prefix}  → Gemini returned empty text content for chapter {chapter_file_name}.")
-                return [] # Or retry if this could be transient
-
+            if not ranges and not word_hits:
+                continue
+            text_map = None
             try:
-                json_match = re.search(r"```json\s*(.*?)\s*```", response.text, re.DOTALL)
-                if json_match:
-                    json_string = json_match.group(1)
-                else:
-                    json_string = response.text.strip()
-                    print(f"{log_prefix}  → Warning: No JSON code block found for chapter {chapter_file_name}. Attempting to parse full response text.")
-                    if not json_string.startswith('{') or not json_string.endswith('}'):
-                        print(f"{log_prefix}  → Response text does not look like JSON for chapter {chapter_file_name}: {json_string[:100]}...")
-                        return [] # Unlikely to be parsable
-
-                output = json.loads(json_string)
-                if isinstance(output, dict) and "sections" in output and isinstance(output["sections"], list):
-                    return output["sections"]
-                else:
-                    print(f"{log_prefix}  → Gemini response did not match expected JSON structure for chapter {chapter_file_name}: {response.text[:500]}...")
-                    return []
-            except json.JSONDecodeError:
-                print(f"{log_prefix}  → Failed to parse JSON response from text for chapter {chapter_file_name}: {response.text[:500]}...")
-                return [] # Bad JSON, unlikely to fix on retry
+                text_map = ChapterTextMap(zip_ref.read(chapter_file_name).decode("utf-8", errors='ignore'))
+                if hashlib.sha1(text_map.text.encode('utf-8')).hexdigest() != chapter['text_sha1']:
+                    print(f"{log_prefix}Filter artifact: re-parsed text of {chapter_file_name} differs from the extracted text. CFIs omitted.")
+                    text_map = None
             except Exception as e:
-                print(f"{log_prefix}  → An error occurred while processing Gemini response text for chapter {chapter_file_name}: {e}")
-                return [] # Other processing error
+                print(f"{log_prefix}Filter artifact: could not map {chapter_file_name} to CFIs: {e}")
 
-        except Exception as e:
-            print(f"{log_prefix}Error calling Gemini API for chapter {chapter_file_name} (Attempt {attempt + 1}/{MAX_API_RETRIES}): {e}")
-            if attempt < MAX_API_RETRIES - 1:
-                delay = RETRY_BASE_DELAY_SECONDS * (2 ** attempt) + random.uniform(0, 1) # Exponential backoff with jitter
-                print(f"{log_prefix}Retrying in {delay:.2f} seconds...")
-                time.sleep(delay)
-            else:
-                print(f"{log_prefix}Max retries reached for chapter {chapter_file_name}. Giving up.")
-                return []
-    return [] # Should be unreachable if loop completes, but as a fallback
+            def range_cfi(start, end):
+                return text_map.range_cfi(start, end) if text_map is not None else None
+
+            spine.append({
+                'file': chapter_file_name,
+                'cfi_base': chapter['cfi_base'],
+                'text_length': chapter['text_length'],
+                'hide': [[start, end, range_cfi(start, end)] for start, end in ranges],
+                'words': [[start, end, word, range_cfi(start, end)] for start, end, word in word_hits]
+            })
+    return {
+        'version': FILTER_ARTIFACT_VERSION,
+        'model': MODEL,
+        'prompt_version': PROMPT_VERSION,
+        'lexicon': profanity_counter.lexicon_digest,
+        'spine': spine
+    }
 
 
 # === Run the full processing from file bytes ===
-# Modify process_epub_from_bytes to access the global request for headers
-def process_epub_from_bytes(epub_bytes: bytes, job_id: str = None) -> Dict:
-    """Processes EPUB content received as bytes and returns results."""
-    global current_request # Access the global request object
+def process_epub_from_bytes(epub_bytes: bytes, job_id: Optional[str], user_id: Optional[str], file_name: Optional[str],
+                            on_chapter_complete: Callable[[Dict], None] = None) -> Dict:
+    """Processes EPUB content received as bytes and returns results.
+
+    user_id and file_name are saved with the Supabase report. Callers pass them explicitly (from the request
+    headers or the queued job) because jobs also run on worker and streaming threads outside any request.
+    on_chapter_complete, if given, is called with a "chapter" event as each chapter finishes.
+    """
     log_prefix = f"[Job {job_id}] " if job_id else ""
     firestore_status_ref = None
-    user_id_for_supabase = current_request.headers.get('X-User-ID') if current_request else None
-    file_name_for_supabase = current_request.headers.get('X-File-Name') if current_request else None
+    user_id_for_supabase = user_id
+    file_name_for_supabase = file_name
 
     # --- Function to save report to Supabase ---
     def save_report_to_supabase(report_data):
@@ -275,7 +2461,8 @@ def process_epub_from_bytes(epub_bytes: bytes, job_id: str = None) -> Dict:
             print(f"{log_prefix}Supabase not initialized. Skipping report save.")
             return
         try:
-            data, error = supabase.table('reports').insert(report_data).execute()
+            # A retried job_id (resumed after a crash or a partial result) replaces its earlier row; job_id is UNIQUE
+            data, error = supabase.table('reports').upsert(report_data, on_conflict='job_id').execute()
             if error:
                 print(f"{log_prefix}Error saving report to Supabase: {error}")
             else:
@@ -292,7 +2479,7 @@ def process_epub_from_bytes(epub_bytes: bytes, job_id: str = None) -> Dict:
                     'job_id': job_id,
                     'status': 'initializing',
                     'progress': 0,
-                    'current_step': 'Initializing and saving EPUB file.',
+                    'current_step': 'Initializing and reading EPUB file.',
                     'last_updated': firestore.SERVER_TIMESTAMP
                 })
             except Exception as e_fs_init:
@@ -347,73 +2534,86 @@ def process_epub_from_bytes(epub_bytes: bytes, job_id: str = None) -> Dict:
         })
         return {"error": "Received empty file data.", "job_id": job_id}
 
-    temp_epub_filename = f"uploaded_book_{uuid.uuid4()}.epub"
-    temp_epub_path = os.path.join('/tmp', temp_epub_filename)
-
-    print(f"{log_prefix}Saving EPUB bytes to temporary file: {temp_epub_path}")
-    try:
-        with open(temp_epub_path, "wb") as f:
-            f.write(epub_bytes)
-        print(f"{log_prefix}Successfully saved EPUB to {temp_epub_path}")
+    book_cache_key = compute_book_cache_key(epub_bytes)
+    cached_entry = lookup_book_result(book_cache_key, log_prefix)
+    if cached_entry:
+        print(f"{log_prefix}Book result cache hit ({book_cache_key[:12]}). Skipping extraction and Gemini analysis.")
+        cached_payload = dict(cached_entry['final_result_payload'], job_id=job_id, cached=True)
         if firestore_status_ref: # Check if ref was obtained
             try:
                 firestore_status_ref.update({
-                    'current_step': 'EPUB file saved, starting extraction.',
+                    'status': 'completed',
+                    'progress': 100,
+                    'current_step': 'Processing complete (cached result).',
+                    'total_chapters': cached_payload.get('totalBookChapters', 0),
+                    'results_summary': {
+                        'percentageFiltered': cached_payload.get('percentageFiltered', 0),
+                        'affectedChapterCount': cached_payload.get('affectedChapterCount', 0),
+                        'swearWordsCount': cached_payload.get('swearWordsCount', 0)
+                    },
                     'last_updated': firestore.SERVER_TIMESTAMP
                 })
-            except Exception as e:
-                print(f"{log_prefix}Error updating Firestore status after EPUB save: {e}")
-                # Continue processing, but status update might fail
+            except Exception as e_fs_cached:
+                print(f"{log_prefix}Error writing cached completion status to Firestore: {e_fs_cached}")
+        save_report_to_supabase({
+            **cached_entry['report'],
+            "job_id": job_id,
+            "user_id": user_id_for_supabase,
+            "file_name": file_name_for_supabase,
+            "processing_status": "completed_cached",
+            "processing_metrics": json.dumps({'book_cache_hit': True}),
+            "gemini_model_used": MODEL
+        })
+        return cached_payload
+
+    try:
+        epub_source = open_epub_source(epub_bytes)
+        source_kind = 'memory' if isinstance(epub_source, io.BytesIO) else 'spooled temporary file'
+        print(f"{log_prefix}Reading {len(epub_bytes)} bytes of EPUB data from {source_kind}.")
     except Exception as e:
-        print(f"{log_prefix}Error saving temporary file {temp_epub_path}: {e}")
+        print(f"{log_prefix}Error opening EPUB data: {e}")
         if firestore_status_ref: # Check if ref was obtained
             try:
                 firestore_status_ref.update({
                     'status': 'error',
-                    'error_message': f'Failed to save temporary EPUB file: {str(e)}',
+                    'error_message': f'Failed to open EPUB data: {str(e)}',
                     'progress': 0,
                     'last_updated': firestore.SERVER_TIMESTAMP
                 })
             except Exception as e_fs_err:
-                print(f"{log_prefix}Error writing file save error status to Firestore: {e_fs_err}")
+                print(f"{log_prefix}Error writing file open error status to Firestore: {e_fs_err}")
         save_report_to_supabase({
             "job_id": job_id,
             "user_id": user_id_for_supabase,
             "file_name": file_name_for_supabase,
-            "processing_status": "error_file_save",
-            "error_message": f'Failed to save temporary EPUB file: {str(e)}',
+            "processing_status": "error_file_open",
+            "error_message": f'Failed to open EPUB data: {str(e)}',
             "gemini_model_used": MODEL
         })
-        return {"error": f"Failed to save temporary EPUB file: {e}", "job_id": job_id}
+        return {"error": f"Failed to open EPUB data: {e}", "job_id": job_id}
 
-    chapters_data = []
     total_chapters_for_firestore = 0
+    # Status writes from here on go through the reporter so the processing loop never waits on Firestore
+    progress_reporter = FirestoreProgressReporter(firestore_status_ref, log_prefix)
+    # Checkpoints are written from one background thread for the same reason
+    checkpoint_writer = ThreadPoolExecutor(max_workers=1) if chapter_checkpoint_store and job_id else None
     try:
-        if firestore_status_ref: # Check if ref was obtained
-            firestore_status_ref.update({
-                'current_step': 'Extracting chapters from EPUB...',
-                'last_updated': firestore.SERVER_TIMESTAMP
-            })
-        chapters_data = extract_epub_chapters(temp_epub_path)
-        total_chapters_for_firestore = len(chapters_data)
-        if firestore_status_ref: # Check if ref was obtained
-            firestore_status_ref.update({
-                'total_chapters': total_chapters_for_firestore,
-                'current_step': f'Extracted {total_chapters_for_firestore} chapters. Preparing for analysis.',
-                'last_updated': firestore.SERVER_TIMESTAMP
-            })
+        progress_reporter.stage({
+            'current_step': 'Extracting chapters from EPUB...'
+        })
+        # Chapters are extracted lazily and handed to Gemini as soon as each one is ready; extraction pauses once
+        # MAX_CHAPTERS_IN_FLIGHT chapters are waiting for results, and each chapter's text is released after aggregation
+        expected_chapter_count = count_epub_documents(epub_source)
+        chapter_iterator = iter_epub_chapters(epub_source)
+        first_chapter = next(chapter_iterator, None)
 
-        if not chapters_data:
+        if first_chapter is None:
             print(f"{log_prefix}No chapters to process after extraction.")
-            if firestore_status_ref: # Check if ref was obtained
-                try:
-                    firestore_status_ref.update({
-                        'status': 'completed', # Or 'warning' if you prefer
-                        'message': 'No suitable chapters found in the EPUB.',
-                        'progress': 100 # No processing needed, so 100% of 'nothing'
-                    })
-                except Exception as e_fs_err:
-                    print(f"{log_prefix}Error writing no chapters status to Firestore: {e_fs_err}")
+            progress_reporter.finish({
+                'status': 'completed', # Or 'warning' if you prefer
+                'message': 'No suitable chapters found in the EPUB.',
+                'progress': 100 # No processing needed, so 100% of 'nothing'
+            })
             
             # Save report to Supabase (no chapters found)
             save_report_to_supabase({
@@ -434,144 +2634,292 @@ def process_epub_from_bytes(epub_bytes: bytes, job_id: str = None) -> Dict:
                 "message": "No suitable chapters found in the EPUB."
             }
 
-        # Initialize result aggregation variables
-        all_flagged_sections = []
-        book_total_char_count = 0
-        # book_total_chapter_count is effectively chapters_processed_count now for Firestore
-        chapters_processed_count = 0 
-        book_swear_word_count_map = {}
-        book_flagged_chapter_count = 0
-        book_flagged_content_char_count = 0
-        book_flagged_chapter_titles = []
+        book_report = BookReportAggregator()
+        job_counters = JobCounters()
+        chapter_states = {} # chapter index -> {'chapter', 'part_sections', 'failed'} until the chapter is complete
+        total_chapters_for_firestore = expected_chapter_count # Replaced by the extracted count once extraction ends
+        checkpoints = load_chapter_checkpoints(job_id, log_prefix) if checkpoint_writer else {}
+        if checkpoints:
+            print(f"{log_prefix}Resuming job: found {len(checkpoints)} chapter checkpoint(s).")
 
-        SWEAR_WORDS = {'damn', 'damned', 'damning', 'hell', 'fuck', 'fucking', 'fucked', 'fucks', 'shit', 'shitting', 'shitted', 'shits', 'ass', 'asses', 'asshole', 'bitch', 'cock', 'penus', 'motherfuck', 'motherfucker', 'motherfucking', 'motherfuckers'}
+        def checkpoint_chapter(chapter_index, chapter, flagged_sections):
+            if checkpoint_writer:
+                checkpoint_writer.submit(save_chapter_checkpoint, job_id, chapter_index,
+                                         build_chapter_checkpoint(chapter, flagged_sections), log_prefix)
 
-        print(f"{log_prefix}Starting parallel processing of {total_chapters_for_firestore} chapters with up to {MAX_CONCURRENT_CHAPTERS} workers.")
-        if firestore_status_ref: # Check if ref was obtained
-            firestore_status_ref.update({
-                'current_step': f'Starting analysis of {total_chapters_for_firestore} chapters.',
-                'progress': 5, # Small progress for starting analysis phase
-                'last_updated': firestore.SERVER_TIMESTAMP
-            })
-        
-        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CHAPTERS) as executor:
-            future_to_chapter_info = {
-                executor.submit(send_chapter_to_gemini, chapter["text"], chapter.get('file', f'Chapter_{i}'), job_id): (chapter, i)
-                for i, chapter in enumerate(chapters_data)
-            }
+        def uncached_chapters():
+            """Numbers every extracted chapter; the ones a checkpoint, the cache or the pre-screen can answer are completed right away."""
+            for chapter_index, chapter in enumerate(itertools.chain([first_chapter], chapter_iterator)):
+                chapter_states[chapter_index] = {'chapter': chapter, 'part_sections': {}, 'failed': False}
+                recovered_sections = recover_checkpointed_sections(checkpoints.pop(chapter_index, None), chapter)
+                if recovered_sections is not None:
+                    job_counters.increment('chapters_recovered')
+                    complete_chapter(chapter_index, recovered_sections)
+                    continue
+                cached_sections = chapter_result_cache.get(compute_chapter_cache_key(chapter["text"]))
+                if cached_sections is not None:
+                    job_counters.increment('chapter_cache_hits')
+                    checkpoint_chapter(chapter_index, chapter, cached_sections)
+                    complete_chapter(chapter_index, cached_sections)
+                    continue
+                job_counters.increment('chapter_cache_misses')
+                if not chapter_needs_analysis(chapter["text"]):
+                    job_counters.increment('prescreen_skipped')
+                    complete_chapter(chapter_index, []) # Recorded as clean without a Gemini call
+                    continue
+                yield dict(chapter, index=chapter_index)
+
+        def gemini_error_counts():
+            return {error_class: job_counters.get(f'gemini_errors_{error_class}') for error_class in GEMINI_ERROR_CLASSES}
 
-            for i, future in enumerate(as_completed(future_to_chapter_info)):
-                original_chapter_info, chapter_index = future_to_chapter_info[future]
-                chapter_file_name = original_chapter_info.get('file', f'Chapter_{chapter_index}')
-                chapter_text = original_chapter_info["text"]
-                
-                book_total_char_count += len(chapter_text) # Added this line to accumulate total characters
-
-                chapters_processed_count += 1
-                print(f"{log_prefix}Completed processing for chapter {chapters_processed_count}/{total_chapters_for_firestore} ({chapter_file_name}).")
-                
-                if firestore_status_ref: # Check if ref was obtained
-                    progress_percent = int((chapters_processed_count / total_chapters_for_firestore) * 100) if total_chapters_for_firestore > 0 else 0
-                    try: # Add try-except for individual update
-                        firestore_status_ref.update({
-                            'chapters_processed': chapters_processed_count,
-                            'progress': progress_percent,
-                            'current_step': f'Analysis in progress: {chapters_processed_count} of {total_chapters_for_firestore} chapters analyzed.', # Changed this line
-                            'last_updated': firestore.SERVER_TIMESTAMP
-                        })
-                    except Exception as e_fs_progress:
-                        print(f"{log_prefix}Error updating Firestore progress for chapter {chapter_file_name}: {e_fs_progress}")
-
-                # Count swear words in the current chapter
-                current_chapter_swear_counts = {}
-                for word in chapter_text.split():
-                    cleaned_word = re.sub(r'\W+', '', word).lower()
-                    if cleaned_word in SWEAR_WORDS:
-                        current_chapter_swear_counts[cleaned_word] = current_chapter_swear_counts.get(cleaned_word, 0) + 1
-                
-                # Add current chapter's swear counts to book total
-                for word, count in current_chapter_swear_counts.items():
-                    book_swear_word_count_map[word] = book_swear_word_count_map.get(word, 0) + count
+        def section_anchor_counts():
+            return {method: job_counters.get(f'anchored_sections_{method}') for method in ANCHOR_METHODS}
+
+        def complete_chapter(chapter_index, flagged_sections_for_chapter):
+            chapter = chapter_states.pop(chapter_index)['chapter']
+            chapter_file_name = chapter.get('file', f'Chapter_{chapter_index}')
+            flagged_sections_for_chapter = anchor_flagged_sections(chapter_file_name, chapter["text"], flagged_sections_for_chapter, job_counters)
+            book_report.add_chapter(chapter_file_name, chapter["text"], flagged_sections_for_chapter,
+                                    chapter_index=chapter_index, cfi_base=chapter.get('cfi_base'))
+            chapters_processed_count = book_report.chapters_processed_count
+            print(f"{log_prefix}Completed processing for chapter {chapters_processed_count}/{total_chapters_for_firestore} ({chapter_file_name}).")
+            if flagged_sections_for_chapter:
+                print(f"{log_prefix}  → Chapter {chapter_file_name} had {len(flagged_sections_for_chapter)} section(s) flagged.")
+            else:
+                print(f"{log_prefix}  → Chapter {chapter_file_name} had no sections flagged.")
 
+            progress_percent = min(int((chapters_processed_count / total_chapters_for_firestore) * 100), 100) if total_chapters_for_firestore > 0 else 0
+            if on_chapter_complete:
                 try:
-                    flagged_sections_for_chapter = future.result()
-                    if flagged_sections_for_chapter:
-                        print(f"{log_prefix}  → Chapter {chapter_file_name} had {len(flagged_sections_for_chapter)} section(s) flagged.")
-                        first_flagged_section = flagged_sections_for_chapter[0]
-                        chapter_title_from_gemini = first_flagged_section.get("chapter", chapter_file_name)
-                        if chapter_title_from_gemini not in book_flagged_chapter_titles :
-                             book_flagged_chapter_titles.append(chapter_title_from_gemini)
-                        all_flagged_sections.extend(flagged_sections_for_chapter)
-                        book_flagged_content_char_count += sum(len(section["text"]) for section in flagged_sections_for_chapter)
-                        book_flagged_chapter_count +=1
-                    else:
-                        print(f"{log_prefix}  → Chapter {chapter_file_name} had no sections flagged.")
-                except Exception as exc:
-                    print(f"{log_prefix}Chapter {chapter_file_name} generated an exception during future.result(): {exc}")
-                    # Optionally log this specific chapter error to Firestore if needed
-
-        total_swear_word_instances = sum(book_swear_word_count_map.values())
-        book_percent_filtered = round((book_flagged_content_char_count / book_total_char_count) * 100, 1) if book_total_char_count > 0 else 0
-        
+                    on_chapter_complete({
+                        "type": "chapter",
+                        "job_id": job_id,
+                        "chapterIndex": chapter_index, # Reading order
+                        "chapterFile": chapter_file_name,
+                        "flaggedSections": flagged_sections_for_chapter,
+                        "chaptersProcessed": chapters_processed_count,
+                        "totalChapters": total_chapters_for_firestore,
+                        "progress": progress_percent,
+                        "totalFilteredCharacters": book_report.flagged_content_char_count,
+                        "affectedChapterCount": book_report.flagged_chapter_count,
+                        "swearWordsCount": book_report.total_swear_word_instances
+                    })
+                except Exception as e_callback:
+                    print(f"{log_prefix}Error delivering chapter event for {chapter_file_name}: {e_callback}")
+
+            progress_reporter.progress({
+                'chapters_processed': chapters_processed_count,
+                'progress': progress_percent,
+                'current_step': f'Analysis in progress: {chapters_processed_count} of {total_chapters_for_firestore} chapters analyzed.',
+                'chapter_cache': {
+                    'hits': job_counters.get('chapter_cache_hits'),
+                    'misses': job_counters.get('chapter_cache_misses')
+                },
+                'gemini_requests': job_counters.get('gemini_requests'),
+                'prescreen_skipped': job_counters.get('prescreen_skipped'),
+                'gemini_concurrency_limit': current_concurrency_limit(),
+                'rate_limit_wait_seconds': job_counters.get('rate_limit_wait_ms') / 1000,
+                'rate_limit_backend_errors': job_counters.get('rate_limit_backend_errors'),
+                'gemini_errors': gemini_error_counts()
+            })
+
+        if GEMINI_DISPATCH_MODE == "async":
+            dispatcher = AsyncGeminiDispatcher()
+            def submit_chapter_request(chapter_request):
+                return dispatcher.submit(analyze_chapter_request_async(chapter_request, job_id, job_counters, dispatcher.limiter))
+            def current_concurrency_limit():
+                return dispatcher.limiter.limit
+        else:
+            dispatcher = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CHAPTERS)
+            def submit_chapter_request(chapter_request):
+                return dispatcher.submit(analyze_chapter_request, chapter_request, job_id, job_counters)
+            def current_concurrency_limit():
+                return MAX_CONCURRENT_CHAPTERS
+        print(f"{log_prefix}Starting parallel processing of chapters ({GEMINI_DISPATCH_MODE} dispatch, concurrency limit {current_concurrency_limit()}) while extraction continues.")
+
+        def finish_chapter_request(chapter_request, future):
+            try:
+                sections_per_segment = future.result()
+            except Exception as exc:
+                print(f"{log_prefix}Request for {describe_chapter_request(chapter_request)} generated an exception during future.result(): {exc}")
+                sections_per_segment = None
+
+            for position, segment in enumerate(chapter_request['segments']):
+                state = chapter_states[segment['chapter_index']]
+                if sections_per_segment is None:
+                    state['failed'] = True
+                state['part_sections'][segment['part']] = sections_per_segment[position] if sections_per_segment else []
+                if len(state['part_sections']) < segment['part_count']:
+                    continue # Other parts of this chapter are still in flight
+                flagged_sections_for_chapter = [
+                    section for part in sorted(state['part_sections']) for section in state['part_sections'][part]
+                ]
+                if state['failed']:
+                    job_counters.increment('failed_chapters')
+                else:
+                    job_counters.increment('chapters_recomputed')
+                    chapter_result_cache.put(compute_chapter_cache_key(state['chapter']["text"]), flagged_sections_for_chapter)
+                    checkpoint_chapter(segment['chapter_index'], state['chapter'], flagged_sections_for_chapter)
+                complete_chapter(segment['chapter_index'], flagged_sections_for_chapter)
+
+        progress_reporter.stage({
+            'total_chapters': total_chapters_for_firestore,
+            'current_step': 'Analysis in progress while chapters are extracted.',
+            'progress': 5 # Small progress for starting analysis phase
+        })
+        with dispatcher:
+            in_flight = {} # future -> chapter request; its chapters stay in chapter_states until it finishes
+            gemini_request_count = 0
+
+            def collect_finished_requests(return_when, timeout=None):
+                done, _ = wait(list(in_flight), timeout=timeout, return_when=return_when)
+                for future in done:
+                    finish_chapter_request(in_flight.pop(future), future)
+
+            for chapter_request in pack_chapter_requests(uncached_chapters()):
+                in_flight[submit_chapter_request(chapter_request)] = chapter_request
+                gemini_request_count += 1
+                collect_finished_requests(FIRST_COMPLETED, timeout=0) # Checkpoint finished chapters without waiting for extraction to end
+                while in_flight and len(chapter_states) >= MAX_CHAPTERS_IN_FLIGHT:
+                    collect_finished_requests(FIRST_COMPLETED) # Backpressure: extraction resumes once chapters are released
+
+            total_chapters_for_firestore = book_report.chapters_processed_count + len(chapter_states)
+            print(f"{log_prefix}Extracted {total_chapters_for_firestore} chapters into {gemini_request_count} Gemini request(s).")
+            progress_reporter.stage({
+                'total_chapters': total_chapters_for_firestore,
+                'current_step': f'Extracted {total_chapters_for_firestore} chapters. Analysis in progress.'
+            })
+            collect_finished_requests(ALL_COMPLETED)
+
+        chapters_processed_count = book_report.chapters_processed_count
+        book_flagged_chapter_count = book_report.flagged_chapter_count
+        book_percent_filtered = book_report.percentage_filtered
+        total_swear_word_instances = book_report.total_swear_word_instances
+
         print(f"{log_prefix}Finished processing all chapters. Aggregating results.")
+        chapter_cache_summary = {
+            'hits': job_counters.get('chapter_cache_hits'),
+            'misses': job_counters.get('chapter_cache_misses')
+        }
+        print(f"{log_prefix}Chapter cache: {chapter_cache_summary['hits']} hit(s), {chapter_cache_summary['misses']} miss(es). Gemini requests: {job_counters.get('gemini_requests')}. Skipped by pre-screen: {job_counters.get('prescreen_skipped')}.")
         final_result_payload = {
             "job_id": job_id,
-            "totalBookCharacters": book_total_char_count,
+            "totalBookCharacters": book_report.total_char_count,
             "totalBookChapters": chapters_processed_count, # Use actual processed count
-            "totalFilteredCharacters": book_flagged_content_char_count, 
+            "totalFilteredCharacters": book_report.flagged_content_char_count,
             "percentageFiltered": book_percent_filtered,
-            "affectedChapterCount": book_flagged_chapter_count, 
-            "affectedChapterNames": book_flagged_chapter_titles,
-            "swearWordsCount": total_swear_word_instances, 
+            "affectedChapterCount": book_flagged_chapter_count,
+            "affectedChapterNames": book_report.flagged_chapter_titles,
+            "swearWordsCount": total_swear_word_instances,
             "message": "EPUB processing completed."
         }
-        if firestore_status_ref: # Check if ref was obtained
+        failed_chapter_count = job_counters.get('failed_chapters')
+        # Chapters rejected by the open circuit breaker should be re-run once Gemini recovers
+        deferred_retry = job_counters.get(f'gemini_errors_{GEMINI_ERROR_CIRCUIT_OPEN}') > 0
+        if failed_chapter_count:
+            final_result_payload["failedChapters"] = failed_chapter_count
+            final_result_payload["deferredRetry"] = deferred_retry
+            final_result_payload["message"] = f"EPUB processing completed with {failed_chapter_count} chapter(s) not analyzed."
+            print(f"{log_prefix}{failed_chapter_count} chapter(s) could not be analyzed. Deferred retry: {deferred_retry}.")
+        checkpoint_summary = {
+            'recovered': job_counters.get('chapters_recovered'),
+            'recomputed': job_counters.get('chapters_recomputed')
+        }
+        if checkpoint_summary['recovered']:
+            final_result_payload["chaptersRecovered"] = checkpoint_summary['recovered']
+            final_result_payload["chaptersRecomputed"] = checkpoint_summary['recomputed']
+            print(f"{log_prefix}Resumed job: {checkpoint_summary['recovered']} chapter(s) recovered from checkpoints, {checkpoint_summary['recomputed']} recomputed.")
+        anchor_counts = section_anchor_counts()
+        print(f"{log_prefix}Section anchoring: {anchor_counts[ANCHOR_METHOD_EXACT]} exact, {anchor_counts[ANCHOR_METHOD_FUZZY]} fuzzy, {anchor_counts[ANCHOR_METHOD_UNMATCHED]} unmatched.")
+        if anchor_counts[ANCHOR_METHOD_UNMATCHED]:
+            final_result_payload["sectionsNeedingRequery"] = anchor_counts[ANCHOR_METHOD_UNMATCHED]
+        completion_update = {
+            'status': 'completed',
+            'progress': 100,
+            'current_step': 'Processing complete.',
+            'results_summary': { # Storing a summary, not the full flagged sections
+                'percentageFiltered': book_percent_filtered,
+                'affectedChapterCount': book_flagged_chapter_count,
+                'swearWordsCount': total_swear_word_instances
+            },
+            'chapter_cache': chapter_cache_summary,
+            'gemini_errors': gemini_error_counts(),
+            'failed_chapters': failed_chapter_count,
+            'deferred_retry': deferred_retry,
+            'checkpoints': checkpoint_summary
+        }
+        if deferred_retry:
+            completion_update['retry_after_seconds'] = max(gemini_circuit_breaker.retry_after_seconds(), 1.0)
+        progress_reporter.finish(completion_update)
+        print(f"{log_prefix}Wrote job status to Firestore {progress_reporter.writes} time(s) during processing.")
+
+        filter_artifact = None
+        filter_artifact_start = time.perf_counter()
+        if BUILD_FILTER_ARTIFACT:
             try:
-                firestore_status_ref.update({
-                    'status': 'completed',
-                    'progress': 100,
-                    'current_step': 'Processing complete.',
-                    'results_summary': { # Storing a summary, not the full flagged sections
-                        'percentageFiltered': book_percent_filtered,
-                        'affectedChapterCount': book_flagged_chapter_count,
-                        'swearWordsCount': total_swear_word_instances
-                    },
-                    'last_updated': firestore.SERVER_TIMESTAMP
-                })
-            except Exception as e_fs_complete:
-                print(f"{log_prefix}Error writing completion status to Firestore: {e_fs_complete}")
+                filter_artifact = build_filter_artifact(epub_source, book_report, log_prefix)
+            except Exception as e_artifact:
+                print(f"{log_prefix}Error building filter artifact: {e_artifact}")
+        filter_artifact_ms = int((time.perf_counter() - filter_artifact_start) * 1000)
         
         # Save successful report to Supabase
         report_to_save = {
             "job_id": job_id,
             "user_id": user_id_for_supabase,
             "file_name": file_name_for_supabase,
-            "total_book_characters": book_total_char_count,
+            "total_book_characters": book_report.total_char_count,
             "total_book_chapters": chapters_processed_count,
-            "total_filtered_characters": book_flagged_content_char_count,
+            "total_filtered_characters": book_report.flagged_content_char_count,
             "percentage_filtered": book_percent_filtered,
             "affected_chapter_count": book_flagged_chapter_count,
-            "affected_chapter_names": json.dumps(book_flagged_chapter_titles), # Ensure JSONB compatibility
+            "affected_chapter_names": json.dumps(book_report.flagged_chapter_titles), # Ensure JSONB compatibility
             "total_swear_word_instances": total_swear_word_instances,
-            "swear_word_map": json.dumps(book_swear_word_count_map), # Ensure JSONB compatibility
-            "all_flagged_sections": json.dumps(all_flagged_sections), # Ensure JSONB compatibility
-            "processing_status": "completed",
+            "swear_word_map": json.dumps(book_report.swear_word_count_map), # Ensure JSONB compatibility
+            "all_flagged_sections": json.dumps(book_report.all_flagged_sections), # Ensure JSONB compatibility
+            "filter_artifact": json.dumps(filter_artifact) if filter_artifact is not None else None,
+            "processing_status": "completed_partial" if failed_chapter_count else "completed",
+            "processing_metrics": json.dumps({
+                'book_cache_hit': False,
+                'chapter_cache': chapter_cache_summary,
+                'gemini_requests': job_counters.get('gemini_requests'),
+                'prescreen_skipped': job_counters.get('prescreen_skipped'),
+                'gemini_concurrency_limit': current_concurrency_limit(),
+                'rate_limited_requests': job_counters.get('rate_limited_requests'),
+                'rate_limit_wait_seconds': job_counters.get('rate_limit_wait_ms') / 1000,
+                'rate_limit_backend_errors': job_counters.get('rate_limit_backend_errors'),
+                'gemini_errors': gemini_error_counts(),
+                'json_repairs': job_counters.get('json_repairs'),
+                'gemini_tokens': gemini_token_usage(job_counters),
+                'prompt': prompt_version_info(),
+                'section_anchors': anchor_counts,
+                'checkpoints': checkpoint_summary,
+                'filter_artifact_ms': filter_artifact_ms,
+                'failed_chapters': failed_chapter_count,
+                'deferred_retry': deferred_retry,
+                'status_writes': progress_reporter.writes
+            }),
             "gemini_model_used": MODEL
         }
         save_report_to_supabase(report_to_save)
+        if failed_chapter_count:
+            return final_result_payload # Incomplete results are not cached; checkpoints are kept for the retry
+        if checkpoint_writer:
+            checkpoint_writer.shutdown(wait=True) # Pending writes must not recreate checkpoints after they are cleared
+            clear_chapter_checkpoints(job_id, log_prefix)
+        # Per-upload fields are filled in again on a cache hit
+        store_book_result(book_cache_key, {
+            'final_result_payload': {k: v for k, v in final_result_payload.items() if k != 'job_id'},
+            'prompt': prompt_version_info(),
+            'report': {k: v for k, v in report_to_save.items() if k not in ('job_id', 'user_id', 'file_name', 'processing_status', 'processing_metrics')}
+        }, log_prefix)
         return final_result_payload
 
     except Exception as e_main_proc:
         print(f"{log_prefix}An error occurred during main EPUB processing: {e_main_proc}")
-        if firestore_status_ref: # Check if ref was obtained
-            try:
-                firestore_status_ref.update({
-                    'status': 'error',
-                    'error_message': f'An error occurred during EPUB processing: {str(e_main_proc)}',
-                    'last_updated': firestore.SERVER_TIMESTAMP
-                })
-            except Exception as e_fs_err_main:
-                print(f"{log_prefix}Error writing main processing error to Firestore: {e_fs_err_main}")
+        progress_reporter.finish({
+            'status': 'error',
+            'error_message': f'An error occurred during EPUB processing: {str(e_main_proc)}'
+        })
         
         # Save error report to Supabase
         save_report_to_supabase({
@@ -584,105 +2932,482 @@ def process_epub_from_bytes(epub_bytes: bytes, job_id: str = None) -> Dict:
         })
         return {"error": f"An error occurred during EPUB processing: {str(e_main_proc)}", "job_id": job_id}
     finally:
-        if os.path.exists(temp_epub_path):
+        progress_reporter.close()
+        if checkpoint_writer:
+            checkpoint_writer.shutdown(wait=True)
+        epub_source.close() # Releases the spooled temporary file, if one was used
+
+# === Background Job Queue ===
+# In async job mode the HTTP request only validates and enqueues the upload and returns 202 with the
+# job_id; a worker claims jobs and runs process_epub_from_bytes, and clients follow progress through
+# get_epub_status as before. Claimed jobs carry a lease so a crashed worker's job is handed out again.
+# Queue backends implement enqueue(job) -> False if the job_id is already queued or claimed, claim() -> job or None,
+# ack(job_id) and release(job_id, error, delay_seconds) (handed out again once the delay has passed).
+#
+# Deployment: async job mode is off by default (JOB_QUEUE_BACKEND=none), and "Prefer: respond-async" requests
+# are then processed synchronously. Only enable it where the queue outlives the instance that accepted the job
+# and a worker keeps running after the 202 is sent: point JOB_QUEUE_SQLITE_PATH / JOB_QUEUE_DIRECTORY at storage
+# shared with a `python epub_report.py worker` process (e.g. a Cloud Run service with CPU always allocated and the
+# same volume mounted). On Cloud Functions, /tmp is per-instance memory and CPU is throttled once the response is
+# sent, so a queue there (or JOB_WORKER_MODE=inline) silently loses accepted jobs when the instance is recycled.
+class SQLiteJobQueue:
+    """Job queue in a local SQLite file (tests, and workers sharing a machine or volume)."""
+
+    def __init__(self, path: str, lease_seconds: int = JOB_LEASE_SECONDS):
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS epub_jobs (job_id TEXT PRIMARY KEY, user_id TEXT, file_name TEXT, epub_bytes BLOB NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, enqueued_at REAL NOT NULL, claimed_at REAL)"
+        )
+
+    def enqueue(self, job: Dict) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO epub_jobs (job_id, user_id, file_name, epub_bytes, enqueued_at) VALUES (?, ?, ?, ?, ?)",
+                (job['job_id'], job.get('user_id'), job.get('file_name'), job['epub_bytes'], time.time())
+            )
+        return cursor.rowcount == 1 # 0: a job with this job_id is still queued or claimed
+
+    def claim(self) -> Optional[Dict]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT job_id, user_id, file_name, epub_bytes, attempts FROM epub_jobs "
+                    "WHERE claimed_at IS NULL OR claimed_at < ? ORDER BY enqueued_at LIMIT 1",
+                    (time.time() - self.lease_seconds,)
+                ).fetchone()
+                if row:
+                    self._conn.execute(
+                        "UPDATE epub_jobs SET claimed_at = ?, attempts = attempts + 1 WHERE job_id = ?", (time.time(), row[0])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        return {'job_id': row[0], 'user_id': row[1], 'file_name': row[2], 'epub_bytes': bytes(row[3]), 'attempts': row[4] + 1}
+
+    def ack(self, job_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM epub_jobs WHERE job_id = ?", (job_id,))
+
+    def release(self, job_id: str, error: str = None, delay_seconds: float = 0) -> None:
+        # A delayed job keeps its claim, backdated so the lease runs out once the delay has passed
+        claimed_at = time.time() - self.lease_seconds + delay_seconds if delay_seconds > 0 else None
+        with self._lock:
+            self._conn.execute("UPDATE epub_jobs SET claimed_at = ? WHERE job_id = ?", (claimed_at, job_id))
+
+
+class FilesystemJobQueue:
+    """Job queue in a directory: queued/ and claimed/ hold <job_id>.json (metadata) plus <job_id>.epub.
+
+    Claiming is an atomic rename of the metadata file, so several worker processes can share the directory.
+    """
+
+    def __init__(self, directory: str, lease_seconds: int = JOB_LEASE_SECONDS):
+        self.lease_seconds = lease_seconds
+        self._queued_dir = os.path.join(directory, 'queued')
+        self._claimed_dir = os.path.join(directory, 'claimed')
+        self._payload_dir = os.path.join(directory, 'payloads')
+        for path in (self._queued_dir, self._claimed_dir, self._payload_dir):
+            os.makedirs(path, exist_ok=True)
+
+    def enqueue(self, job: Dict) -> bool:
+        job_id = job['job_id']
+        try:
+            with open(os.path.join(self._payload_dir, f"{job_id}.epub"), 'xb') as f: # The payload reserves the job_id until ack
+                f.write(job['epub_bytes'])
+        except FileExistsError:
+            return False # A job with this job_id is still queued or claimed
+        metadata = {'job_id': job_id, 'user_id': job.get('user_id'), 'file_name': job.get('file_name'),
+                    'attempts': 0, 'enqueued_at': time.time()}
+        temp_path = os.path.join(self._queued_dir, f".{job_id}.tmp")
+        with open(temp_path, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(temp_path, os.path.join(self._queued_dir, f"{job_id}.json")) # Visible to workers only once complete
+        return True
+
+    def _requeue_expired_claims(self) -> None:
+        for name in os.listdir(self._claimed_dir):
+            claimed_path = os.path.join(self._claimed_dir, name)
+            try:
+                if time.time() - os.path.getmtime(claimed_path) > self.lease_seconds:
+                    os.rename(claimed_path, os.path.join(self._queued_dir, name))
+            except FileNotFoundError:
+                pass # Acknowledged or re-queued by another worker
+
+    def claim(self) -> Optional[Dict]:
+        self._requeue_expired_claims()
+        queued = []
+        for name in os.listdir(self._queued_dir):
+            if name.endswith('.json'):
+                try:
+                    queued.append((os.path.getmtime(os.path.join(self._queued_dir, name)), name))
+                except FileNotFoundError:
+                    pass # Claimed by another worker meanwhile
+        for _, name in sorted(queued): # Oldest first
+            claimed_path = os.path.join(self._claimed_dir, name)
             try:
-                os.remove(temp_epub_path)
-                print(f"{log_prefix}Cleaned up temporary file: {temp_epub_path}")
-            except OSError as e:
-                print(f"{log_prefix}Error removing temporary file {temp_epub_path}: {e}")
+                os.rename(os.path.join(self._queued_dir, name), claimed_path)
+            except FileNotFoundError:
+                continue # Another worker claimed it first
+            os.utime(claimed_path) # Lease starts now
+            with open(claimed_path) as f:
+                metadata = json.load(f)
+            metadata['attempts'] += 1
+            with open(claimed_path, 'w') as f:
+                json.dump(metadata, f)
+            with open(os.path.join(self._payload_dir, f"{metadata['job_id']}.epub"), 'rb') as f:
+                metadata['epub_bytes'] = f.read()
+            return metadata
+        return None
+
+    def ack(self, job_id: str) -> None:
+        for path in (os.path.join(self._claimed_dir, f"{job_id}.json"), os.path.join(self._payload_dir, f"{job_id}.epub")):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def release(self, job_id: str, error: str = None, delay_seconds: float = 0) -> None:
+        claimed_path = os.path.join(self._claimed_dir, f"{job_id}.json")
+        try:
+            if delay_seconds > 0:
+                # A delayed job stays claimed, backdated so the lease runs out once the delay has passed
+                lease_start = time.time() - self.lease_seconds + delay_seconds
+                os.utime(claimed_path, (lease_start, lease_start))
+            else:
+                os.rename(claimed_path, os.path.join(self._queued_dir, f"{job_id}.json"))
+        except FileNotFoundError:
+            pass
+
+
+def init_job_queue():
+    """Creates the queue selected by JOB_QUEUE_BACKEND, or None if async job mode is disabled/unavailable."""
+    backend = 'none' if EXTRACTION_WORKER_PROCESS else JOB_QUEUE_BACKEND.lower()
+    if backend != 'none' and JOB_WORKER_MODE == 'inline':
+        print("Warning: JOB_WORKER_MODE=inline runs jobs on a thread of this instance; queued jobs are lost if it is "
+              "throttled or recycled. Use it for local development only.")
+    try:
+        if backend == 'sqlite':
+            return SQLiteJobQueue(JOB_QUEUE_SQLITE_PATH)
+        if backend == 'filesystem':
+            return FilesystemJobQueue(JOB_QUEUE_DIRECTORY)
+        if backend != 'none':
+            print(f"Job queue backend '{JOB_QUEUE_BACKEND}' is not available. Async job mode disabled.")
+    except Exception as e:
+        print(f"Error initializing job queue ({JOB_QUEUE_BACKEND}): {e}. Async job mode disabled.")
+    return None
+
+job_queue = init_job_queue()
+
+
+def wants_async_job(request) -> bool:
+    """True if the client asked for async job mode ("Prefer: respond-async", RFC 7240)."""
+    return 'respond-async' in (request.headers.get('Prefer') or '').lower()
+
+
+def validate_epub_upload(epub_bytes: bytes) -> Optional[str]:
+    """Cheap checks run before a job is accepted. Returns an error message, or None if the upload looks valid."""
+    if not epub_bytes:
+        return "No EPUB file data received. Please upload the file directly."
+    if not zipfile.is_zipfile(io.BytesIO(epub_bytes)):
+        return "Uploaded file is not a valid EPUB (ZIP) archive."
+    return None
+
+
+def enqueue_epub_job(job_queue, epub_bytes: bytes, job_id: str, user_id: str = None, file_name: str = None) -> bool:
+    """Queues a job and records it as queued in Firestore so get_epub_status can see it immediately.
+
+    Returns False, and leaves the existing job and its status alone, if job_id is already queued or running.
+    """
+    if not job_queue.enqueue({'job_id': job_id, 'user_id': user_id, 'file_name': file_name, 'epub_bytes': epub_bytes}):
+        print(f"[Job {job_id}] A job with this ID is already queued or running; not queued again.")
+        return False
+    if job_id and firebase_initialized and db:
+        try:
+            db.collection('epub_process_status').document(job_id).set({
+                'job_id': job_id,
+                'status': 'queued',
+                'progress': 0,
+                'current_step': 'Waiting for a worker.',
+                'last_updated': firestore.SERVER_TIMESTAMP
+            })
+        except Exception as e_fs_queue:
+            print(f"[Job {job_id}] Error writing queued status to Firestore: {e_fs_queue}")
+    if JOB_WORKER_MODE == 'inline':
+        ensure_inline_job_worker(job_queue)
+    return True
+
+
+def mark_job_failed(job_id: str, error_message: str) -> None:
+    """Records a job the worker gave up on as errored in Firestore, so clients polling its status stop waiting."""
+    if job_id and firebase_initialized and db:
+        try:
+            db.collection('epub_process_status').document(job_id).set({
+                'job_id': job_id,
+                'status': 'error',
+                'error_message': error_message,
+                'last_updated': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+        except Exception as e_fs_failed:
+            print(f"[Job {job_id}] Error writing failed status to Firestore: {e_fs_failed}")
+
+
+def mark_job_retrying(job_id: str, failed_chapters: int, delay_seconds: float) -> None:
+    """Records a partial result that will be retried as queued again, so clients keep polling for the full report."""
+    if job_id and firebase_initialized and db:
+        try:
+            db.collection('epub_process_status').document(job_id).set({
+                'status': 'queued',
+                'current_step': f'{failed_chapters} chapter(s) not analyzed yet. Retrying in {int(delay_seconds)} seconds.',
+                'retry_after_seconds': delay_seconds,
+                'last_updated': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+        except Exception as e_fs_retry:
+            print(f"[Job {job_id}] Error writing retry status to Firestore: {e_fs_retry}")
+
+
+def run_next_job(job_queue) -> bool:
+    """Claims and processes one job. Returns False if the queue was empty."""
+    job = job_queue.claim()
+    if job is None:
+        return False
+    job_id = job['job_id']
+    log_prefix = f"[Job {job_id}] "
+    print(f"{log_prefix}Worker claimed job (attempt {job['attempts']}/{JOB_MAX_ATTEMPTS}).")
+    try:
+        result = process_epub_from_bytes(job['epub_bytes'], job_id, user_id=job.get('user_id'), file_name=job.get('file_name'))
+    except Exception as e:
+        # process_epub_from_bytes reports its own errors; this only catches crashes around it
+        print(f"{log_prefix}Worker failed to process job: {e}")
+        if job['attempts'] < JOB_MAX_ATTEMPTS:
+            job_queue.release(job_id, str(e))
+        else:
+            print(f"{log_prefix}Giving up after {job['attempts']} attempts.")
+            mark_job_failed(job_id, f"EPUB processing failed after {job['attempts']} attempts: {e}")
+            job_queue.ack(job_id)
+        return True
+    if result.get('failedChapters') and job['attempts'] < JOB_MAX_ATTEMPTS:
+        # Checkpoints and the chapter cache keep the analyzed chapters, so the retry only re-runs the failed ones
+        delay_seconds = JOB_PARTIAL_RETRY_DELAY_SECONDS
+        if result.get('deferredRetry'):
+            delay_seconds = max(gemini_circuit_breaker.retry_after_seconds(), 1.0) # Once the breaker lets a probe through
+        print(f"{log_prefix}{result['failedChapters']} chapter(s) not analyzed. Retrying the job in {delay_seconds:.0f}s.")
+        job_queue.release(job_id, result.get('message'), delay_seconds)
+        mark_job_retrying(job_id, result['failedChapters'], delay_seconds)
+        return True
+    job_queue.ack(job_id)
+    print(f"{log_prefix}Worker finished job{' with error: ' + result['error'] if 'error' in result else '.'}")
+    return True
+
+
+def run_job_worker(job_queue, stop_event: threading.Event = None, poll_interval: float = None, exit_when_idle: bool = False) -> None:
+    """Drains the queue until stop_event is set (or, with exit_when_idle, until it is empty)."""
+    poll_interval = poll_interval or JOB_POLL_INTERVAL_SECONDS
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        try:
+            if run_next_job(job_queue):
+                continue
+        except Exception as e:
+            print(f"Job worker error: {e}")
+        if exit_when_idle:
+            return
+        stop_event.wait(poll_interval)
+
+
+_inline_job_worker = None
+_inline_job_worker_lock = threading.Lock()
+
+def ensure_inline_job_worker(job_queue) -> None:
+    """Starts the in-instance worker thread once (JOB_WORKER_MODE=inline)."""
+    global _inline_job_worker
+    with _inline_job_worker_lock:
+        if _inline_job_worker is None or not _inline_job_worker.is_alive():
+            _inline_job_worker = threading.Thread(target=run_job_worker, args=(job_queue,), name="epub-job-worker", daemon=True)
+            _inline_job_worker.start()
+            print("Started inline job worker.")
+
+
+# === Streaming Responses ===
+# Clients that send "Accept: application/x-ndjson" or "Accept: text/event-stream" get one event per
+# completed chapter as soon as it is analyzed, followed by a "summary" event carrying the same fields
+# as the regular JSON response (or an "error" event).
+STREAMING_MEDIA_TYPES = {'application/x-ndjson': 'ndjson', 'text/event-stream': 'sse'}
+
+def select_streaming_format(accept_header: Optional[str]) -> Optional[str]:
+    """Returns 'ndjson' or 'sse' if the Accept header asks for a streaming response, else None."""
+    accept_header = (accept_header or '').lower()
+    for media_type, stream_format in STREAMING_MEDIA_TYPES.items():
+        if media_type in accept_header:
+            return stream_format
+    return None
+
+
+def format_stream_event(event: Dict, stream_format: str) -> str:
+    if stream_format == 'sse':
+        return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    return json.dumps(event) + "\n"
+
+
+def stream_epub_report(epub_bytes: bytes, job_id: str, user_id: str, file_name: str, stream_format: str):
+    """Runs processing on a background thread and yields formatted events as chapters complete.
+
+    Processing continues (and the report is still saved) if the client disconnects mid-stream.
+    """
+    events = queue.Queue()
+
+    def run_processing():
+        try:
+            result = process_epub_from_bytes(epub_bytes, job_id, user_id=user_id, file_name=file_name,
+                                             on_chapter_complete=events.put)
+        except Exception as e:
+            result = {"error": f"Internal Server Error: {e}"}
+        result["job_id"] = job_id
+        events.put({"type": "error" if "error" in result else "summary", **result})
+        events.put(None)
+
+    threading.Thread(target=run_processing, name=f"epub-report-{job_id}", daemon=True).start()
+    while True:
+        event = events.get()
+        if event is None:
+            return
+        yield format_stream_event(event, stream_format)
+
 
 # === HTTP Cloud Function Entry Point ===
 @functions_framework.http
 def epub_report(request):
     """HTTP Cloud Function to filter EPUB content using Gemini."""
-    # Make request available globally within this function's scope for Supabase helper
-    # This is a simplification. In a class-based structure, request could be passed differently.
-    global current_request 
-    current_request = request
+    from flask import make_response, jsonify, Response
 
-    try:
-        from flask import make_response, jsonify
+    job_id = request.headers.get('X-Job-ID') # Get job_id from header
+    if not job_id:
+        job_id = str(uuid.uuid4()) # Generate a job_id if not provided
+        print(f"No X-Job-ID header found. Generated Job ID: {job_id}")
+    else:
+        print(f"Received request with X-Job-ID: {job_id}")
 
-        job_id = request.headers.get('X-Job-ID') # Get job_id from header
-        if not job_id:
-            job_id = str(uuid.uuid4()) # Generate a job_id if not provided
-            print(f"No X-Job-ID header found. Generated Job ID: {job_id}")
-        else:
-            print(f"Received request with X-Job-ID: {job_id}")
+    log_prefix = f"[Job {job_id}] " if job_id else ""
 
-        log_prefix = f"[Job {job_id}] " if job_id else ""
+    # Ensure Gemini API is initialized
+    if not genai_initialized:
+        print(f"{log_prefix}Received request, but Gemini API initialization failed.")
+        response_data = {"error": "Service backend initialization failed.", "job_id": job_id}
+        response = make_response(jsonify(response_data))
+        response.status_code = 500
+        response.headers.set('Access-Control-Allow-Origin', '*')
+        return response
 
-        # Ensure Gemini API is initialized
-        if not genai_initialized:
-            print(f"{log_prefix}Received request, but Gemini API initialization failed.")
-            response_data = {"error": "Service backend initialization failed.", "job_id": job_id}
-            response = make_response(jsonify(response_data))
-            response.status_code = 500
-            response.headers.set('Access-Control-Allow-Origin', '*')
-            return response
+    # Handle CORS preflight request (OPTIONS method)
+    if request.method == 'OPTIONS':
+        print(f"{log_prefix}Handling CORS preflight request.")
+        response = make_response()
+        response.headers.set('Access-Control-Allow-Origin', '*')
+        response.headers.set('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        # Add X-User-ID and X-File-Name to allowed headers
+        response.headers.set('Access-Control-Allow-Headers', 'Content-Type, Accept, Prefer, X-Job-ID, X-User-ID, X-File-Name') 
+        response.headers.set('Access-Control-Max-Age', '3600')
+        return response
 
-        # Handle CORS preflight request (OPTIONS method)
-        if request.method == 'OPTIONS':
-            print(f"{log_prefix}Handling CORS preflight request.")
-            response = make_response()
-            response.headers.set('Access-Control-Allow-Origin', '*')
-            response.headers.set('Access-Control-Allow-Methods', 'POST, OPTIONS')
-            # Add X-User-ID and X-File-Name to allowed headers
-            response.headers.set('Access-Control-Allow-Headers', 'Content-Type, X-Job-ID, X-User-ID, X-File-Name') 
-            response.headers.set('Access-Control-Max-Age', '3600')
-            return response
+    # Handle POST request - expecting file data
+    if request.method == 'POST':
+        print(f"{log_prefix}Received POST request.")
+        try:
+            # Get the raw binary data from the request body
+            # This assumes the client sends the ArrayBuffer directly as the request body
+            epub_data = request.data # type: bytes
 
-        # Handle POST request - expecting file data
-        if request.method == 'POST':
-            print(f"{log_prefix}Received POST request.")
-            try:
-                # Get the raw binary data from the request body
-                # This assumes the client sends the ArrayBuffer directly as the request body
-                epub_data = request.data # type: bytes
-
-                if not epub_data:
-                    print(f"{log_prefix}Error: No file data received in request body.")
-                    response_data = {"error": "No EPUB file data received. Please upload the file directly.", "job_id": job_id}
-                    response = make_response(jsonify(response_data))
-                    response.status_code = 400
-                    response.headers.set('Access-Control-Allow-Origin', '*')
-                    return response
+            if not epub_data:
+                print(f"{log_prefix}Error: No file data received in request body.")
+                response_data = {"error": "No EPUB file data received. Please upload the file directly.", "job_id": job_id}
+                response = make_response(jsonify(response_data))
+                response.status_code = 400
+                response.headers.set('Access-Control-Allow-Origin', '*')
+                return response
+
+            print(f"{log_prefix}Received {len(epub_data)} bytes of EPUB data.")
 
-                print(f"{log_prefix}Received {len(epub_data)} bytes of EPUB data.")
-                
-                # Start processing and pass job_id
-                print(f"{log_prefix}Starting EPUB processing.")
-                result = process_epub_from_bytes(epub_data, job_id)
-                result["job_id"] = job_id # Ensure job_id is in the final response
-
-                if "error" in result:
-                    print(f"{log_prefix}Error during processing: {result['error']}")
-                    response = make_response(jsonify(result))
-                    response.status_code = 500 # Or appropriate error code based on result['error']
+            if wants_async_job(request) and job_queue:
+                validation_error = validate_epub_upload(epub_data)
+                if validation_error:
+                    print(f"{log_prefix}Rejected upload: {validation_error}")
+                    response = make_response(jsonify({"error": validation_error, "job_id": job_id}))
+                    response.status_code = 400
                     response.headers.set('Access-Control-Allow-Origin', '*')
                     return response
+                if enqueue_epub_job(job_queue, epub_data, job_id, request.headers.get('X-User-ID'), request.headers.get('X-File-Name')):
+                    print(f"{log_prefix}Queued EPUB for background processing.")
+                    message = "EPUB accepted for processing."
+                else:
+                    message = "A job with this ID is already queued or running." # Retried submission: same 202, same job
+                response = make_response(jsonify({"job_id": job_id, "status": "queued", "message": message}))
+                response.status_code = 202
+                response.headers.set('Preference-Applied', 'respond-async')
+                response.headers.set('Access-Control-Allow-Origin', '*')
+                response.headers.set('Access-Control-Expose-Headers', 'Preference-Applied')
+                return response
 
-                response = make_response(jsonify(result))
-                response.headers.set('Content-Type', 'application/json')
+            stream_format = select_streaming_format(request.headers.get('Accept'))
+            if stream_format:
+                print(f"{log_prefix}Starting EPUB processing with {stream_format} streaming response.")
+                response = Response(
+                    stream_epub_report(epub_data, job_id, request.headers.get('X-User-ID'), request.headers.get('X-File-Name'), stream_format),
+                    mimetype='text/event-stream' if stream_format == 'sse' else 'application/x-ndjson'
+                )
+                response.headers.set('Cache-Control', 'no-cache')
+                response.headers.set('X-Accel-Buffering', 'no') # Ask proxies not to buffer the stream
                 response.headers.set('Access-Control-Allow-Origin', '*')
-                print(f"{log_prefix}Request processed successfully.")
                 return response
 
-            except Exception as e:
-                print(f"{log_prefix}An unhandled error occurred during request processing: {e}")
-                response_data = {"error": f"Internal Server Error: {e}", "job_id": job_id}
-                response = make_response(jsonify(response_data))
-                response.status_code = 500
+            # Start processing and pass job_id
+            print(f"{log_prefix}Starting EPUB processing.")
+            result = process_epub_from_bytes(epub_data, job_id, request.headers.get('X-User-ID'), request.headers.get('X-File-Name'))
+            result["job_id"] = job_id # Ensure job_id is in the final response
+
+            if "error" in result:
+                print(f"{log_prefix}Error during processing: {result['error']}")
+                response = make_response(jsonify(result))
+                response.status_code = 500 # Or appropriate error code based on result['error']
                 response.headers.set('Access-Control-Allow-Origin', '*')
                 return response
-        else:
-            print(f"{log_prefix}Received unsupported method: {request.method}")
-            response_data = {"error": f"Method {request.method} not allowed", "job_id": job_id}
+
+            response = make_response(jsonify(result))
+            response.headers.set('Content-Type', 'application/json')
+            response.headers.set('Access-Control-Allow-Origin', '*')
+            print(f"{log_prefix}Request processed successfully.")
+            return response
+
+        except Exception as e:
+            print(f"{log_prefix}An unhandled error occurred during request processing: {e}")
+            response_data = {"error": f"Internal Server Error: {e}", "job_id": job_id}
             response = make_response(jsonify(response_data))
-            response.status_code = 405
-            response.headers.set('Access-Control-Allow-Methods', 'POST, OPTIONS')
+            response.status_code = 500
             response.headers.set('Access-Control-Allow-Origin', '*')
             return response
-    finally:
-        # Clean up global request object
-        current_request = None
\ No newline at end of file
+    else:
+        print(f"{log_prefix}Received unsupported method: {request.method}")
+        response_data = {"error": f"Method {request.method} not allowed", "job_id": job_id}
+        response = make_response(jsonify(response_data))
+        response.status_code = 405
+        response.headers.set('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        response.headers.set('Access-Control-Allow-Origin', '*')
+        return response
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="EPUB report background job worker.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help="Drain the job queue configured by JOB_QUEUE_BACKEND.")
+    worker_parser.add_argument('--exit-when-idle', action='store_true', help="Stop once the queue is empty.")
+    args = parser.parse_args()
+    if not job_queue:
+        raise SystemExit("No job queue configured (JOB_QUEUE_BACKEND).")
+    print(f"Job worker started ({JOB_QUEUE_BACKEND} queue).")
+    run_job_worker(job_queue, exit_when_idle=args.exit_when_idle)
@@ -0,0 +1,184 @@
+"""In-memory stand-in for the Firestore client, used by the tests.
+
+Supports the calls epub_report and get_epub_status make: collection/document (and sub-collections), get, set (with
+merge), update, delete, get_all, on_snapshot and transactions (run through firestore.transactional). SERVER_TIMESTAMP values become the current UTC time. Snapshot
+callbacks are delivered in order on a background thread, like the real client's watch stream.
+"""
+import datetime
+import queue
+import threading
+
+from firebase_admin import firestore
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, doc_id: str, data):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeWatch:
+    def __init__(self, document, callback):
+        self.document = document
+        self.callback = callback
+
+    def unsubscribe(self) -> None:
+        self.document.client._remove_watch(self)
+
+
+class FakeTransaction:
+    """Holds the client's lock from begin to commit/rollback, so transactions run one at a time; writes are
+    buffered and applied on commit. Implements the private hooks firestore.transactional calls."""
+    _read_only = False
+    _max_attempts = 5
+
+    def __init__(self, client):
+        self.client = client
+        self._id = None
+        self._writes = []
+
+    def set(self, document, data: dict, merge: bool = False) -> None:
+        self._writes.append((document.path, data, merge))
+
+    def update(self, document, data: dict) -> None:
+        self._writes.append((document.path, data, True))
+
+    def _clean_up(self) -> None:
+        self._writes = []
+
+    def _begin(self, retry_id=None) -> None:
+        self.client._lock.acquire()
+        self._id = b'fake-transaction'
+
+    def _commit(self) -> None:
+        try:
+            for path, data, merge in self._writes:
+                self.client._write(path, data, merge=merge)
+        finally:
+            self._writes = []
+            self._id = None
+            self.client._lock.release()
+
+    def _rollback(self) -> None:
+        self._writes = []
+        if self._id is not None:
+            self._id = None
+            self.client._lock.release()
+
+
+class FakeDocumentReference:
+    def __init__(self, client, path: str):
+        self.client = client
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name: str) -> 'FakeCollectionReference':
+        return FakeCollectionReference(self.client, f"{self.path}/{name}")
+
+    def get(self, transaction=None) -> FakeDocumentSnapshot:
+        return self.client._read(self.path)
+
+    def set(self, data: dict, merge: bool = False) -> None:
+        self.client._write(self.path, data, merge=merge)
+
+    def update(self, data: dict) -> None:
+        if self.client._read(self.path, count=False)._data is None:
+            raise KeyError(f"No document to update: {self.path}")
+        self.client._write(self.path, data, merge=True)
+
+    def delete(self) -> None:
+        self.client._write(self.path, None)
+
+    def on_snapshot(self, callback) -> FakeWatch:
+        return self.client._add_watch(self, callback)
+
+
+class FakeCollectionReference:
+    def __init__(self, client, path: str):
+        self.client = client
+        self.path = path
+
+    def document(self, doc_id: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self.client, f"{self.path}/{doc_id}")
+
+    def stream(self):
+        prefix = self.path + '/'
+        with self.client._lock:
+            paths = [path for path in self.client.documents if path.startswith(prefix) and '/' not in path[len(prefix):]]
+        return [self.client._read(path, count=False) for path in sorted(paths)]
+
+
+class FakeFirestore:
+    """Documents live in `documents` ({path: dict}); `reads` and `writes` count document reads and writes,
+    `get_all_calls` counts batched read round trips and `watches` lists live listeners."""
+
+    def __init__(self):
+        self.documents = {}
+        self.reads = 0
+        self.writes = 0
+        self.get_all_calls = 0
+        self.listeners_started = 0
+        self.watches = []
+        self._lock = threading.RLock()
+        self._events = queue.Queue()
+        threading.Thread(target=self._deliver_events, name="fake-firestore-watch", daemon=True).start()
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def transaction(self) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    def get_all(self, references, field_paths=None):
+        self.get_all_calls += 1
+        for reference in references:
+            yield reference.get()
+
+    def active_watches(self, path: str) -> int:
+        with self._lock:
+            return sum(1 for watch in self.watches if watch.document.path == path)
+
+    def _read(self, path: str, count: bool = True) -> FakeDocumentSnapshot:
+        with self._lock:
+            if count:
+                self.reads += 1
+            data = self.documents.get(path)
+            return FakeDocumentSnapshot(path.rsplit('/', 1)[-1], dict(data) if data is not None else None)
+
+    def _write(self, path: str, data, merge: bool = False) -> None:
+        with self._lock:
+            self.writes += 1
+            if data is None:
+                self.documents.pop(path, None)
+            else:
+                now = datetime.datetime.now(datetime.timezone.utc)
+                data = {key: now if value is firestore.SERVER_TIMESTAMP else value for key, value in data.items()}
+                self.documents[path] = dict(self.documents.get(path) or {}, **data) if merge else data
+            for watch in self.watches:
+                if watch.document.path == path:
+                    self._events.put((watch, self._read(path, count=False)))
+
+    def _add_watch(self, document: FakeDocumentReference, callback) -> FakeWatch:
+        watch = FakeWatch(document, callback)
+        with self._lock:
+            self.watches.append(watch)
+            self.listeners_started += 1
+            self._events.put((watch, self._read(document.path, count=False))) # Initial snapshot
+        return watch
+
+    def _remove_watch(self, watch: FakeWatch) -> None:
+        with self._lock:
+            if watch in self.watches:
+                self.watches.remove(watch)
+
+    def _deliver_events(self) -> None:
+        while True:
+            watch, snapshot = self._events.get()
+            with self._lock:
+                active = watch in self.watches
+            if active:
+                watch.callback([snapshot], [], datetime.datetime.now(datetime.timezone.utc))
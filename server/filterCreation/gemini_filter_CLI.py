@@ -6,6 +6,7 @@ import bs4
 from typing import List, Dict
 # Removed google.cloud.aiplatform_v1 and google.oauth2.service_account
 import google.generativeai as genai # New import
+from profanity import ProfanityCounter, init_profanity_counter
 
 # === CONFIGURATION === gemini-2.0-flash
 MODEL = "gemini-2.5-flash-preview-04-17" # Model name is the same  
@@ -224,6 +225,20 @@ def send_chapter_to_gemini(chapter_text: str) -> List[Dict]:
         print(f"Error calling Gemini API for chapter: {e}")
         return []
     
+# === Count swear words ===
+# Same word list and counting rule as epub_report (PROFANITY_LEXICON_PATH, falling back to the built-in SWEAR_WORDS)
+profanity_counter = None
+
+def get_profanity_counter() -> ProfanityCounter:
+    """Builds the counter on first use, so a bad lexicon path is reported when counting starts, not at import."""
+    global profanity_counter
+    if profanity_counter is None:
+        profanity_counter = init_profanity_counter(os.environ.get("PROFANITY_LEXICON_PATH", ""))
+    return profanity_counter
+
+def count_swear_words(text: str) -> Dict[str, int]:
+    return get_profanity_counter().count(text)
+
     #=== Run the full process ===
 #This function remains unchanged as it uses the standard chapter and flagged_sections structures
 def process_book(epub_path: str) -> Dict:
@@ -239,8 +254,6 @@ def process_book(epub_path: str) -> Dict:
         }
     all_flagged = []
     flagged_words = [] # /*/ Array to track total flagged words and amounts
-    # Define a set of swear words to check against
-    SWEAR_WORDS = {'damn', 'damned', 'damning', 'hell', 'fuck', 'fucking', 'fucked', 'fucks', 'shit', 'shitting', 'shitted', 'shits', 'ass', 'asses', 'asshole', 'bitch', 'cock', 'penus', 'motherfuck', 'motherfucker', 'motherfucking', 'motherfuckers'}  # Replace with actual swear words
 
     book_total_word_count = {}    # Initialize a dictionary to track total counts of swear words across the book
 
@@ -249,11 +262,7 @@ def process_book(epub_path: str) -> Dict:
         flagged = send_chapter_to_gemini(chapter["text"])
 
         # Count swear words in the chapter
-        word_count = {}
-        for word in chapter["text"].split():
-            cleaned_word = re.sub(r'\W+', '', word).lower()  # Remove punctuation and convert to lowercase
-            if cleaned_word in SWEAR_WORDS:
-                word_count[cleaned_word] = word_count.get(cleaned_word, 0) + 1
+        word_count = count_swear_words(chapter["text"])
 
         # Add chapter counts to the book total
         for word, count in word_count.items():
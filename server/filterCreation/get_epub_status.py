@@ -1,7 +1,24 @@
 import functions_framework
-from flask import jsonify, make_response
+from flask import jsonify, make_response, Response
 import firebase_admin
 from firebase_admin import credentials, firestore
+import os
+import json
+import time
+import hashlib # ETags derived from last_updated
+import threading # Shared snapshot listeners and the status cache
+from collections import OrderedDict
+
+# --- Configuration ---
+STATUS_CACHE_TTL_SECONDS = float(os.environ.get("STATUS_CACHE_TTL_SECONDS", "1.0")) # Short: progress changes every few seconds
+STATUS_CACHE_MAX_ENTRIES = int(os.environ.get("STATUS_CACHE_MAX_ENTRIES", "10000")) # Oldest entries are dropped beyond this
+STATUS_MAX_WAIT_SECONDS = float(os.environ.get("STATUS_MAX_WAIT_SECONDS", "25")) # Upper bound for long-poll ?wait=
+MAX_BATCH_JOB_IDS = int(os.environ.get("MAX_BATCH_JOB_IDS", "300"))
+BATCH_STATUS_FIELDS = ('status', 'progress', 'current_step', 'results_summary', 'error_message') # Compact per-job entry
+STATUS_STREAM_MAX_SECONDS = float(os.environ.get("STATUS_STREAM_MAX_SECONDS", "500")) # Keep under the function timeout; EventSource reconnects
+STATUS_STREAM_HEARTBEAT_SECONDS = float(os.environ.get("STATUS_STREAM_HEARTBEAT_SECONDS", "15")) # Comment lines keep proxies from idling the stream out
+STATUS_STREAM_NOT_FOUND_SECONDS = float(os.environ.get("STATUS_STREAM_NOT_FOUND_SECONDS", "30")) # Grace for a job whose status doc is not written yet
+TERMINAL_JOB_STATUSES = ('completed', 'error')
 
 # --- Firebase Initialization ---
 if not firebase_admin._apps:
@@ -13,48 +30,346 @@ if not firebase_admin._apps:
 
 db = firestore.client()
 
+# --- Status Cache ---
+class StatusCache:
+    """In-process cache of status documents (None = not found) so frequent polls share one Firestore read.
+
+    Entries are kept in the order they were written; with one TTL for all of them that is also expiry order, so
+    put() drops expired entries (job ids nobody polls any more) from the front, and the oldest beyond max_entries.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int = STATUS_CACHE_MAX_ENTRIES, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict() # job_id -> (expires_at, status_data), oldest write first
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, job_id: str):
+        """Returns (hit, status_data)."""
+        with self._lock:
+            entry = self._entries.get(job_id)
+            if entry is None or entry[0] < self._clock():
+                self._entries.pop(job_id, None)
+                return False, None
+            return True, entry[1]
+
+    def put(self, job_id: str, status_data) -> None:
+        with self._lock:
+            now = self._clock()
+            self._entries[job_id] = (now + self.ttl_seconds, status_data)
+            self._entries.move_to_end(job_id)
+            while self._entries:
+                oldest_job_id, (expires_at, _) = next(iter(self._entries.items()))
+                if expires_at >= now and len(self._entries) <= self.max_entries:
+                    break
+                del self._entries[oldest_job_id]
+
+status_cache = StatusCache(STATUS_CACHE_TTL_SECONDS)
+
+
+def read_status(job_id: str):
+    """Returns the status document as a dict, or None if it does not exist. Served from the cache when fresh."""
+    hit, status_data = status_cache.get(job_id)
+    if hit:
+        return status_data
+    status_doc = db.collection('epub_process_status').document(job_id).get()
+    status_data = status_doc.to_dict() if status_doc.exists else None
+    status_cache.put(job_id, status_data)
+    return status_data
+
+
+def read_statuses(job_ids: list) -> dict:
+    """Returns {job_id: status dict or None} for many jobs, fetching every uncached one in a single get_all round trip."""
+    statuses = {}
+    uncached_refs = []
+    for job_id in job_ids:
+        hit, status_data = status_cache.get(job_id)
+        if hit:
+            statuses[job_id] = status_data
+        else:
+            uncached_refs.append(db.collection('epub_process_status').document(job_id))
+    if uncached_refs:
+        for status_doc in db.get_all(uncached_refs):
+            status_data = status_doc.to_dict() if status_doc.exists else None
+            status_cache.put(status_doc.id, status_data)
+            statuses[status_doc.id] = status_data
+    return statuses
+
+
+def compact_status(status_data) -> dict:
+    if status_data is None:
+        return {'status': 'not_found'}
+    return {field: status_data[field] for field in BATCH_STATUS_FIELDS if field in status_data}
+
+
+def get_batch_status(request, headers):
+    """Batch lookup: job IDs from a JSON body {"job_ids": [...]} (POST) or ?job_ids=a,b,c (GET).
+
+    Returns {"jobs": {job_id: compact status}}; unknown IDs get {"status": "not_found"} instead of failing the batch.
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        job_ids = body.get('job_ids')
+    else:
+        job_ids = [job_id for job_id in request.args.get('job_ids', '').split(',') if job_id]
+    if not isinstance(job_ids, list) or not job_ids or not all(isinstance(job_id, str) and job_id for job_id in job_ids):
+        error_response = jsonify({"error": "job_ids must be a non-empty list of job IDs."})
+        return make_response(error_response, 400, headers)
+    job_ids = list(dict.fromkeys(job_ids)) # De-duplicate, keep order
+    if len(job_ids) > MAX_BATCH_JOB_IDS:
+        error_response = jsonify({"error": f"At most {MAX_BATCH_JOB_IDS} job_ids can be requested at once."})
+        return make_response(error_response, 400, headers)
+
+    try:
+        statuses = read_statuses(job_ids)
+    except Exception as e:
+        print(f"Error fetching batch status for {len(job_ids)} job_ids: {e}")
+        error_response = jsonify({"error": f"An internal error occurred while fetching status: {str(e)}"})
+        return make_response(error_response, 500, headers)
+    return make_response(jsonify({"jobs": {job_id: compact_status(statuses.get(job_id)) for job_id in job_ids}}), 200, headers)
+
+
+def status_etag(job_id: str, status_data) -> str:
+    """ETag for a status document: changes whenever last_updated does (or the content, if it has none)."""
+    last_updated = (status_data or {}).get('last_updated')
+    if hasattr(last_updated, 'isoformat'):
+        marker = last_updated.isoformat()
+    else:
+        marker = json.dumps(status_data, sort_keys=True, default=str)
+    return hashlib.sha1(f"{job_id}:{marker}".encode("utf-8")).hexdigest()
+
+
+# --- Snapshot Listeners ---
+class JobStatusWatcher:
+    """One Firestore snapshot listener on a job's status document, shared by every request waiting on it."""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.status_data = None
+        self.version = 0 # Number of snapshots received; 0 until the listener's first snapshot arrives
+        self.subscribers = 0
+        self._condition = threading.Condition()
+        self._watch = db.collection('epub_process_status').document(job_id).on_snapshot(self._on_snapshot)
+
+    def _on_snapshot(self, doc_snapshots, changes, read_time):
+        doc = doc_snapshots[0] if doc_snapshots else None
+        status_data = doc.to_dict() if doc is not None and doc.exists else None
+        status_cache.put(self.job_id, status_data) # Polling readers benefit from the push too
+        with self._condition:
+            self.status_data = status_data
+            self.version += 1
+            self._condition.notify_all()
+
+    def wait_for(self, predicate, timeout: float) -> bool:
+        """Blocks until predicate(status_data) holds for a received snapshot, or timeout. Returns the predicate's result."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self.version > 0 and predicate(self.status_data), timeout)
+
+    def wait_for_change(self, after_version: int, timeout: float):
+        """Blocks until a snapshot newer than after_version arrives, or timeout. Returns (version, status_data)."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.version > after_version, timeout)
+            return self.version, self.status_data
+
+    def close(self) -> None:
+        try:
+            self._watch.unsubscribe()
+        except Exception as e:
+            print(f"Error closing status listener for job_id {self.job_id}: {e}")
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+def acquire_watcher(job_id: str) -> JobStatusWatcher:
+    """Returns the job's shared watcher, starting its snapshot listener for the first subscriber."""
+    with _watchers_lock:
+        watcher = _watchers.get(job_id)
+        if watcher is None:
+            watcher = JobStatusWatcher(job_id)
+            _watchers[job_id] = watcher
+        watcher.subscribers += 1
+        return watcher
+
+
+def release_watcher(watcher: JobStatusWatcher) -> None:
+    """Drops a subscription; the listener is closed when its last subscriber leaves."""
+    with _watchers_lock:
+        watcher.subscribers -= 1
+        if watcher.subscribers > 0:
+            return
+        _watchers.pop(watcher.job_id, None)
+    watcher.close()
+
+
 @functions_framework.http
 def get_epub_status(request):
-    """HTTP Cloud Function to get the status of EPUB processing."""
-    
+    """HTTP Cloud Function to get the status of EPUB processing.
+
+    Responses carry an ETag; a request with a matching If-None-Match gets 304. With ?wait=<seconds>
+    such a request is held until the status document changes (or the wait runs out, giving 304).
+    POST {"job_ids": [...]} or GET ?job_ids=a,b,c returns a compact status map for many jobs.
+    """
+
     if request.method == 'OPTIONS':
         headers = {
             'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'GET, OPTIONS',
-            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
             'Access-Control-Max-Age': '3600'
         }
         return ('', 204, headers)
 
     headers = {
-        'Access-Control-Allow-Origin': '*'
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'Cache-Control': 'no-cache'
     }
 
+    if request.method == 'POST' or 'job_ids' in request.args:
+        if not firebase_admin._apps:
+            error_response = jsonify({"error": "Service backend (Firestore) not initialized."})
+            return make_response(error_response, 500, headers)
+        return get_batch_status(request, headers)
+
     job_id = request.args.get('job_id')
 
     if not job_id:
         error_response = jsonify({"error": "job_id query parameter is required."})
         return make_response(error_response, 400, headers)
 
-    if not firebase_admin._apps: 
+    try:
+        wait_seconds = min(max(float(request.args.get('wait', 0)), 0), STATUS_MAX_WAIT_SECONDS)
+    except ValueError:
+        error_response = jsonify({"error": "wait must be a number of seconds.", "job_id": job_id})
+        return make_response(error_response, 400, headers)
+
+    if not firebase_admin._apps:
         error_response = jsonify({"error": "Service backend (Firestore) not initialized."})
         return make_response(error_response, 500, headers)
 
     try:
-        status_ref = db.collection('epub_process_status').document(job_id)
-        status_doc = status_ref.get()
+        status_data = read_status(job_id)
+        client_etags = request.if_none_match
+
+        if wait_seconds and status_data is not None and client_etags.contains(status_etag(job_id, status_data)):
+            # Long poll: the client already has this version, so hold the request until the document changes
+            watcher = acquire_watcher(job_id)
+            try:
+                watcher.wait_for(lambda data: not client_etags.contains(status_etag(job_id, data)), wait_seconds)
+                if watcher.version > 0:
+                    status_data = watcher.status_data
+            finally:
+                release_watcher(watcher)
 
-        if not status_doc.exists:
+        if status_data is None:
             error_response = jsonify({"error": "Processing status not found for the given job_id.", "job_id": job_id, "status": "not_found"})
             return make_response(error_response, 404, headers)
-        
-        status_data = status_doc.to_dict()
-        status_data['job_id'] = job_id 
-        
-        return make_response(jsonify(status_data), 200, headers)
+
+        etag = status_etag(job_id, status_data)
+        if client_etags.contains(etag):
+            response = make_response('', 304, headers)
+            response.set_etag(etag)
+            return response
+
+        status_data = dict(status_data)
+        status_data['job_id'] = job_id
+
+        response = make_response(jsonify(status_data), 200, headers)
+        response.set_etag(etag)
+        return response
 
     except Exception as e:
         print(f"Error fetching status for job_id {job_id}: {e}")
         error_response = jsonify({"error": f"An internal error occurred while fetching status: {str(e)}", "job_id": job_id})
         return make_response(error_response, 500, headers)
 
+
+# --- Server-Sent Events ---
+def format_status_event(event_type: str, data: dict, event_id: str = None) -> str:
+    lines = [f"event: {event_type}"]
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data, default=str)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def stream_status_events(job_id: str, last_event_id: str = None):
+    """Yields an SSE event for every change to the job's status document until it reaches a terminal status.
+
+    Subscribers to the same job share one snapshot listener. A reconnecting EventSource sends Last-Event-ID
+    (the status ETag), so an unchanged status is not re-sent.
+    """
+    watcher = acquire_watcher(job_id)
+    try:
+        started = time.monotonic()
+        last_heartbeat = started
+        version = 0
+        sent_etag = last_event_id
+        while True:
+            now = time.monotonic()
+            remaining = STATUS_STREAM_MAX_SECONDS - (now - started)
+            if remaining <= 0:
+                return # The client's EventSource reconnects with Last-Event-ID
+            version, status_data = watcher.wait_for_change(version, min(remaining, STATUS_STREAM_HEARTBEAT_SECONDS))
+
+            if version and status_data is None:
+                if time.monotonic() - started >= STATUS_STREAM_NOT_FOUND_SECONDS:
+                    yield format_status_event('not_found', {"error": "Processing status not found for the given job_id.", "job_id": job_id, "status": "not_found"})
+                    return
+            elif status_data is not None:
+                etag = status_etag(job_id, status_data)
+                if etag != sent_etag:
+                    sent_etag = etag
+                    last_heartbeat = time.monotonic()
+                    yield format_status_event('status', dict(status_data, job_id=job_id), etag)
+                if status_data.get('status') in TERMINAL_JOB_STATUSES:
+                    yield format_status_event('end', {"job_id": job_id, "status": status_data.get('status')})
+                    return
+
+            if time.monotonic() - last_heartbeat >= STATUS_STREAM_HEARTBEAT_SECONDS:
+                last_heartbeat = time.monotonic()
+                yield ": keep-alive\n\n"
+    finally:
+        release_watcher(watcher) # Also runs when the client disconnects and the generator is closed
+
+
+@functions_framework.http
+def stream_epub_status(request):
+    """HTTP Cloud Function streaming a job's status as Server-Sent Events (text/event-stream).
+
+    Sends a "status" event per status change and an "end" event once the job is completed or errored.
+    """
+
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type, Last-Event-ID',
+            'Access-Control-Max-Age': '3600'
+        }
+        return ('', 204, headers)
+
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no' # Don't let proxies buffer the stream
+    }
+
+    job_id = request.args.get('job_id')
+
+    if not job_id:
+        error_response = jsonify({"error": "job_id query parameter is required."})
+        return make_response(error_response, 400, headers)
+
+    if not firebase_admin._apps:
+        error_response = jsonify({"error": "Service backend (Firestore) not initialized."})
+        return make_response(error_response, 500, headers)
+
+    last_event_id = request.headers.get('Last-Event-ID')
+    print(f"Opening status stream for job_id {job_id}")
+    return Response(stream_status_events(job_id, last_event_id), mimetype='text/event-stream', headers=headers)
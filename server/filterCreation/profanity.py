@@ -0,0 +1,95 @@
+"""Single-pass profanity counting shared by epub_report and gemini_filter_CLI.
+
+No service clients and no work at import: callers build a counter with init_profanity_counter().
+"""
+import hashlib
+import re
+from typing import Dict, Iterable, List, Tuple
+
+
+SWEAR_WORDS = {'damn', 'damned', 'damning', 'hell', 'fuck', 'fucking', 'fucked', 'fucks', 'shit', 'shitting', 'shitted', 'shits', 'ass', 'asses', 'asshole', 'bitch', 'cock', 'penus', 'motherfuck', 'motherfucker', 'motherfucking', 'motherfuckers'}
+TOKEN_PUNCTUATION = r'[^\w\s]*' # Non-word, non-space characters; dropped when a token is normalized
+
+def normalize_token(token: str) -> str:
+    """The counting rule's normalization: word characters only, lowercased ('Ass-hole!' -> 'asshole')."""
+    return re.sub(r'\W+', '', token).lower()
+
+
+def load_profanity_lexicon(path: str) -> set:
+    """Reads a lexicon file: one word per line, '#' starts a comment. Words are normalized like tokens."""
+    words = set()
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            word = normalize_token(line.split('#', 1)[0])
+            if word:
+                words.add(word)
+    return words
+
+
+def build_lexicon_pattern(words: Iterable[str]) -> str:
+    """Regex alternation for the lexicon, factored into a prefix trie so each text position fails fast.
+
+    Punctuation may sit between letters ('f.u.c.k' normalizes to 'fuck'); longer words are preferred and the
+    caller's boundary checks backtrack to shorter ones.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node: Dict, separator: str) -> str:
+        branches = [separator + re.escape(char) + build(child, TOKEN_PUNCTUATION)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if '' in node else body
+
+    return build(trie, '')
+
+
+class ProfanityCounter:
+    """Counts lexicon words with one regex scan per text.
+
+    A whitespace-separated token counts when normalize_token() turns it into a lexicon word, exactly as the
+    old split-and-re.sub loop did, so counts are unchanged; 'Damn!' and 'ass-hole' count, 'hell's' does not.
+    """
+
+    def __init__(self, words: Iterable[str]):
+        self.words = frozenset(normalize_token(word) for word in words) - {''}
+        self.lexicon_digest = hashlib.sha256("\n".join(sorted(self.words)).encode("utf-8")).hexdigest()[:16]
+        self._pattern = None
+        if self.words:
+            self._pattern = re.compile(
+                rf'(?<!\S){TOKEN_PUNCTUATION}({build_lexicon_pattern(self.words)}){TOKEN_PUNCTUATION}(?!\S)',
+                re.IGNORECASE
+            )
+
+    def scan(self, text: str) -> Dict[str, List[Tuple[int, int]]]:
+        """Returns {word: [(start, end), ...]}: character offsets of every counted word in text, without the
+        punctuation around it ('"Damn!"' -> the span of 'Damn')."""
+        offsets = {}
+        if self._pattern is None:
+            return offsets
+        for match in self._pattern.finditer(text):
+            word = normalize_token(match.group(1))
+            if word in self.words: # IGNORECASE and str.lower() disagree on a few exotic characters
+                offsets.setdefault(word, []).append(match.span(1))
+        return offsets
+
+    def count(self, text: str) -> Dict[str, int]:
+        return {word: len(spans) for word, spans in self.scan(text).items()}
+
+
+def init_profanity_counter(lexicon_path: str) -> ProfanityCounter:
+    """Builds the counter from the lexicon file at lexicon_path, falling back to SWEAR_WORDS if it is empty or unreadable."""
+    if lexicon_path:
+        try:
+            words = load_profanity_lexicon(lexicon_path)
+            print(f"Loaded {len(words)} profanity lexicon words from {lexicon_path}.")
+            return ProfanityCounter(words)
+        except Exception as e:
+            print(f"Error loading profanity lexicon {lexicon_path}: {e}. Using the built-in word list.")
+    return ProfanityCounter(SWEAR_WORDS)
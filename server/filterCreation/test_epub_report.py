@@ -0,0 +1,1175 @@
+"""Tests for epub_report. Gemini, Firestore and Supabase are faked (see conftest.py)."""
+import asyncio
+import io
+import json
+import time
+import zipfile
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from flask import Flask, request
+from google.api_core import exceptions as google_exceptions
+
+from conftest import EMPTY_SECTIONS_RESPONSE
+from epub_benchmarks import build_synthetic_epub, check_extractor_parity, read_epub_documents
+from profanity import ProfanityCounter
+
+
+# --- Background job queue ---
+def test_run_next_job_processes_queued_job_outside_a_request(epub_report, small_epub, tmp_path, capsys):
+    job_queue = epub_report.SQLiteJobQueue(str(tmp_path / 'jobs.sqlite3'))
+    job_queue.enqueue({'job_id': 'queued-1', 'user_id': 'user-1', 'file_name': 'book.epub', 'epub_bytes': small_epub})
+
+    assert epub_report.run_next_job(job_queue) is True
+
+    output = capsys.readouterr().out
+    assert "Worker failed" not in output
+    assert "[Job queued-1] Worker finished job." in output
+    assert job_queue.claim() is None # Acknowledged
+    assert epub_report.run_next_job(job_queue) is False
+
+
+def test_run_next_job_records_error_status_when_giving_up(epub_report, firestore_fake, small_epub, tmp_path, monkeypatch):
+    monkeypatch.setattr(epub_report, 'db', firestore_fake)
+    monkeypatch.setattr(epub_report, 'firebase_initialized', True)
+    monkeypatch.setattr(epub_report, 'JOB_MAX_ATTEMPTS', 2)
+
+    def crash(*args, **kwargs):
+        raise RuntimeError("worker crashed")
+    monkeypatch.setattr(epub_report, 'process_epub_from_bytes', crash)
+    job_queue = epub_report.SQLiteJobQueue(str(tmp_path / 'jobs.sqlite3'))
+    epub_report.enqueue_epub_job(job_queue, small_epub, 'queued-2')
+    assert firestore_fake.documents['epub_process_status/queued-2']['status'] == 'queued'
+
+    assert epub_report.run_next_job(job_queue) is True # Attempt 1: released for a retry
+    assert firestore_fake.documents['epub_process_status/queued-2']['status'] == 'queued'
+    assert epub_report.run_next_job(job_queue) is True # Attempt 2: gives up
+
+    status = firestore_fake.documents['epub_process_status/queued-2']
+    assert status['status'] == 'error'
+    assert "worker crashed" in status['error_message']
+    assert job_queue.claim() is None
+
+
+def test_respond_async_is_served_synchronously_without_a_job_queue(epub_report, small_epub):
+    app = Flask(__name__)
+    app.add_url_rule('/', 'epub_report', lambda: epub_report.epub_report(request), methods=['POST'])
+
+    response = app.test_client().post('/', data=small_epub, headers={'X-Job-ID': 'sync-1', 'Prefer': 'respond-async'})
+
+    assert response.status_code == 200
+    assert 'Preference-Applied' not in response.headers
+    assert response.get_json()['totalBookChapters'] == 3
+
+
+@pytest.fixture(params=['sqlite', 'filesystem'])
+def job_queue(request, epub_report, tmp_path):
+    if request.param == 'sqlite':
+        return epub_report.SQLiteJobQueue(str(tmp_path / 'jobs.sqlite3'))
+    return epub_report.FilesystemJobQueue(str(tmp_path / 'jobs'))
+
+
+def test_duplicate_job_id_does_not_replace_a_claimed_job(job_queue):
+    assert job_queue.enqueue({'job_id': 'dup-1', 'epub_bytes': b'first'}) is True
+    assert job_queue.enqueue({'job_id': 'dup-1', 'epub_bytes': b'second'}) is False # Still queued
+    claimed = job_queue.claim()
+    assert job_queue.enqueue({'job_id': 'dup-1', 'epub_bytes': b'third'}) is False # Claimed by a worker
+
+    assert (claimed['epub_bytes'], claimed['attempts']) == (b'first', 1)
+    assert job_queue.claim() is None
+    job_queue.ack('dup-1')
+    assert job_queue.enqueue({'job_id': 'dup-1', 'epub_bytes': b'fourth'}) is True # Finished jobs free their id
+
+
+def test_resubmitted_async_job_gets_202_for_the_existing_job(epub_report, job_queue, firestore_fake, small_epub, monkeypatch):
+    monkeypatch.setattr(epub_report, 'job_queue', job_queue)
+    monkeypatch.setattr(epub_report, 'db', firestore_fake)
+    monkeypatch.setattr(epub_report, 'firebase_initialized', True)
+    app = Flask(__name__)
+    app.add_url_rule('/', 'epub_report', lambda: epub_report.epub_report(request), methods=['POST'])
+    client = app.test_client()
+    headers = {'X-Job-ID': 'async-1', 'Prefer': 'respond-async'}
+
+    first = client.post('/', data=small_epub, headers=headers)
+    job_queue.claim()
+    firestore_fake.documents['epub_process_status/async-1']['status'] = 'processing'
+    second = client.post('/', data=small_epub, headers=headers)
+
+    assert (first.status_code, second.status_code) == (202, 202)
+    assert second.get_json()['job_id'] == 'async-1'
+    assert firestore_fake.documents['epub_process_status/async-1']['status'] == 'processing' # Not reset to queued
+    assert job_queue.claim() is None
+
+
+def test_partial_result_is_released_for_a_delayed_retry(epub_report, job_queue, fake_model, firestore_fake, small_epub, monkeypatch):
+    monkeypatch.setattr(epub_report, 'db', firestore_fake)
+    monkeypatch.setattr(epub_report, 'firebase_initialized', True)
+    monkeypatch.setattr(epub_report, 'JOB_PARTIAL_RETRY_DELAY_SECONDS', 0.3)
+
+    def fail_first_request(contents):
+        if fake_model.calls == 1:
+            raise google_exceptions.InvalidArgument("rejected")
+        return EMPTY_SECTIONS_RESPONSE
+    fake_model.respond = fail_first_request
+    epub_report.enqueue_epub_job(job_queue, small_epub, 'partial-1')
+
+    assert epub_report.run_next_job(job_queue) is True
+    status = firestore_fake.documents['epub_process_status/partial-1']
+    assert (status['status'], status['retry_after_seconds']) == ('queued', 0.3)
+    assert job_queue.claim() is None # Not handed out again before the delay
+
+    time.sleep(0.4)
+    assert epub_report.run_next_job(job_queue) is True
+    assert firestore_fake.documents['epub_process_status/partial-1']['status'] == 'completed'
+    assert fake_model.calls == 2
+    assert job_queue.claim() is None # Acknowledged once every chapter was analyzed
+
+
+# --- Job status reporting ---
+class RecordingStatusDocument:
+    """Status document that records when each write happened and what it wrote."""
+
+    def __init__(self, document):
+        self.document = document
+        self.writes = [] # (monotonic time, fields)
+
+    def update(self, fields):
+        self.writes.append((time.monotonic(), fields))
+        self.document.update(fields)
+
+
+@pytest.fixture
+def status_document(firestore_fake):
+    document = firestore_fake.collection('epub_process_status').document('job-1')
+    document.set({'status': 'processing', 'progress': 0})
+    return RecordingStatusDocument(document)
+
+
+def test_progress_is_written_at_most_once_per_interval(epub_report, status_document, firestore_fake):
+    reporter = epub_report.FirestoreProgressReporter(status_document, min_interval_ms=100, min_progress_step=100)
+    started = time.monotonic()
+    progress = 0
+    while time.monotonic() - started < 0.45:
+        progress = min(progress + 1, 99)
+        reporter.progress({'progress': progress})
+        time.sleep(0.005)
+    reporter.close()
+
+    progress_writes = [written_at for written_at, _ in status_document.writes]
+    assert 3 <= len(progress_writes) <= 6 # About one per 100 ms, plus the flush on close
+    assert all(later - earlier >= 0.095 for earlier, later in zip(progress_writes, progress_writes[1:-1]))
+    assert firestore_fake.documents['epub_process_status/job-1']['progress'] == progress # Last update not lost
+
+
+def test_finish_writes_the_final_state_immediately(epub_report, status_document, firestore_fake):
+    reporter = epub_report.FirestoreProgressReporter(status_document, min_interval_ms=60000, min_progress_step=100)
+    reporter.progress({'progress': 10})
+    reporter.progress({'progress': 40, 'current_step': "Analyzing chapters"})
+    reporter.finish({'status': 'completed', 'progress': 100, 'current_step': "Processing complete."})
+
+    status = firestore_fake.documents['epub_process_status/job-1']
+    assert (status['status'], status['progress'], status['current_step']) == ('completed', 100, "Processing complete.")
+    assert reporter.writes <= 2
+    reporter.progress({'progress': 50}) # After finish: ignored
+    reporter.close()
+    assert firestore_fake.documents['epub_process_status/job-1']['progress'] == 100
+
+
+def test_stage_updates_are_written_in_order(epub_report, status_document):
+    reporter = epub_report.FirestoreProgressReporter(status_document, min_interval_ms=60000, min_progress_step=100)
+    for step in ("Extracting chapters", "Analyzing chapters", "Saving results"):
+        reporter.stage({'current_step': step})
+        time.sleep(0.02)
+    reporter.close()
+
+    assert [fields['current_step'] for _, fields in status_document.writes] == [
+        "Extracting chapters", "Analyzing chapters", "Saving results"]
+
+
+def test_progress_reporter_without_a_status_document_is_a_no_op(epub_report):
+    reporter = epub_report.FirestoreProgressReporter(None)
+    reporter.progress({'progress': 10})
+    reporter.finish({'status': 'completed'})
+    assert reporter.writes == 0
+
+
+# --- Resumable jobs ---
+class SimulatedKill(BaseException):
+    """Stands in for the instance dying: not an Exception, so nothing in the pipeline handles it."""
+
+
+@pytest.fixture
+def resumable(epub_report, tmp_path, monkeypatch):
+    monkeypatch.setattr(epub_report, 'chapter_checkpoint_store', epub_report.SQLiteChapterCheckpointStore(str(tmp_path / 'checkpoints.sqlite3')))
+    monkeypatch.setattr(epub_report, 'SMALL_CHAPTER_TOKENS', 1) # One request per chapter
+    monkeypatch.setattr(epub_report, 'BUILD_FILTER_ARTIFACT', False)
+    return epub_report
+
+
+def kill_after(chapters: int):
+    """on_chapter_complete callback that kills the run once `chapters` chapters are done (and checkpointed)."""
+    def on_chapter_complete(event):
+        if event['chaptersProcessed'] >= chapters:
+            raise SimulatedKill()
+    return on_chapter_complete
+
+
+def test_killed_job_resumes_from_its_checkpoints(resumable, fake_model, monkeypatch):
+    epub_bytes = build_synthetic_epub(chapters=5, paragraphs_per_chapter=4)
+    with pytest.raises(SimulatedKill):
+        resumable.process_epub_from_bytes(epub_bytes, 'resume-1', None, None, on_chapter_complete=kill_after(2))
+    assert len(resumable.chapter_checkpoint_store.load('resume-1')) == 2
+
+    monkeypatch.setattr(resumable, 'chapter_result_cache', resumable.ChapterResultCache(100, 3600)) # A fresh instance
+    fake_model.calls = 0
+    result = resumable.process_epub_from_bytes(epub_bytes, 'resume-1', None, None)
+
+    assert (result['chaptersRecovered'], result['chaptersRecomputed']) == (2, 3)
+    assert fake_model.calls == 3
+    assert result['totalBookChapters'] == 5 and 'failedChapters' not in result
+    assert resumable.chapter_checkpoint_store.load('resume-1') == {} # Cleared once the job succeeds
+
+
+def test_checkpoints_for_a_different_book_are_not_reused(resumable, fake_model, monkeypatch):
+    with pytest.raises(SimulatedKill):
+        resumable.process_epub_from_bytes(build_synthetic_epub(chapters=5, paragraphs_per_chapter=4), 'resume-2', None, None,
+                                          on_chapter_complete=kill_after(2))
+
+    monkeypatch.setattr(resumable, 'chapter_result_cache', resumable.ChapterResultCache(100, 3600))
+    fake_model.calls = 0
+    other_book = build_synthetic_epub(chapters=5, paragraphs_per_chapter=5) # Same job_id, different chapter text
+    result = resumable.process_epub_from_bytes(other_book, 'resume-2', None, None)
+
+    assert 'chaptersRecovered' not in result
+    assert fake_model.calls == 5
+
+
+def test_checkpoints_for_a_different_prompt_are_not_reused(resumable, fake_model, monkeypatch):
+    epub_bytes = build_synthetic_epub(chapters=5, paragraphs_per_chapter=4)
+    with pytest.raises(SimulatedKill):
+        resumable.process_epub_from_bytes(epub_bytes, 'resume-3', None, None, on_chapter_complete=kill_after(2))
+
+    monkeypatch.setattr(resumable, 'chapter_result_cache', resumable.ChapterResultCache(100, 3600))
+    monkeypatch.setattr(resumable, 'prompt_cache_tag', lambda: 'prompt-v-next')
+    fake_model.calls = 0
+    result = resumable.process_epub_from_bytes(epub_bytes, 'resume-3', None, None)
+
+    assert 'chaptersRecovered' not in result
+    assert fake_model.calls == 5
+
+
+def test_checkpoint_entries_are_checked_against_the_chapter_and_prompt(epub_report):
+    chapter = {'file': 'ch1.xhtml', 'text': "A quiet chapter."}
+    entry = epub_report.build_chapter_checkpoint(chapter, [{'text': "quiet"}])
+
+    assert epub_report.recover_checkpointed_sections(entry, chapter) == [{'text': "quiet"}]
+    assert epub_report.recover_checkpointed_sections(entry, dict(chapter, text="A different chapter.")) is None
+    assert epub_report.recover_checkpointed_sections(dict(entry, prompt='old-prompt'), chapter) is None
+    assert epub_report.recover_checkpointed_sections(None, chapter) is None
+
+
+# --- Chapter extraction ---
+def extracted_chapters(epub_report, epub_bytes, **kwargs):
+    return [(chapter['file'], chapter['text']) for chapter in epub_report.iter_epub_chapters(io.BytesIO(epub_bytes), **kwargs)]
+
+
+def test_stream_extractor_matches_bs4(epub_report):
+    documents = read_epub_documents(build_synthetic_epub(chapters=4, paragraphs_per_chapter=12))
+    assert documents
+    assert check_extractor_parity(epub_report, documents, 'stream') == []
+
+
+def test_stream_extractor_yields_the_same_chapters_as_bs4(epub_report, small_epub):
+    stream_chapters = extracted_chapters(epub_report, small_epub, extractor_backend='stream', extraction_mode='serial')
+    assert len(stream_chapters) == 3
+    assert stream_chapters == extracted_chapters(epub_report, small_epub, extractor_backend='bs4', extraction_mode='serial')
+
+
+def test_process_pool_extraction_uses_a_non_fork_start_method(epub_report, small_epub):
+    pool = epub_report.get_extraction_pool(2)
+    try:
+        assert pool._mp_context.get_start_method() == epub_report.EXTRACTION_START_METHOD != 'fork'
+        assert (extracted_chapters(epub_report, small_epub, extraction_mode='process', workers=2)
+                == extracted_chapters(epub_report, small_epub, extraction_mode='serial'))
+    finally:
+        epub_report.discard_extraction_pool(pool)
+
+
+CONTAINER_XML = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>"""
+
+SPINE_OPF = """<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0">
+  <metadata/>
+  <manifest>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+    <item id="contents" href="text/contents.xhtml" media-type="application/xhtml+xml"/>
+    <item id="cover" href="text/cover.xhtml" media-type="application/xhtml+xml"/>
+    <item id="ch1" href="text/one.xhtml" media-type="application/xhtml+xml"/>
+    <item id="ch2" href="text/two%20b.xhtml" media-type="application/xhtml+xml"/>
+    <item id="ch3" href="text/three.xhtml" media-type="application/xhtml+xml"/>
+    <item id="style" href="style.css" media-type="text/css"/>
+  </manifest>
+  <spine>
+    <itemref idref="nav"/>
+    <itemref idref="cover" linear="no"/>
+    <itemref idref="contents"/>
+    <itemref idref="ch1"/>
+    <itemref idref="ch2"/>
+    <itemref idref="style"/>
+    <itemref idref="ch3"/>
+  </spine>
+  <guide><reference type="toc" title="Contents" href="text/contents.xhtml"/></guide>
+</package>"""
+
+
+def build_spine_epub(with_opf: bool = True) -> bytes:
+    """A small EPUB whose archive order (three, two, one) differs from its spine order (one, two, three)."""
+    documents = {
+        'OEBPS/text/three.xhtml': "Third chapter", 'OEBPS/text/two b.xhtml': "Second chapter",
+        'OEBPS/text/one.xhtml': "First chapter", 'OEBPS/text/contents.xhtml': "Contents",
+        'OEBPS/text/cover.xhtml': "Cover", 'OEBPS/nav.xhtml': "Navigation", 'OEBPS/toc.xhtml': "Old contents",
+    }
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zip_ref:
+        zip_ref.writestr('mimetype', 'application/epub+zip')
+        if with_opf:
+            zip_ref.writestr('META-INF/container.xml', CONTAINER_XML)
+            zip_ref.writestr('OEBPS/content.opf', SPINE_OPF)
+        for name, text in documents.items():
+            zip_ref.writestr(name, f"<html><body><p>{text}.</p></body></html>")
+    return buffer.getvalue()
+
+
+def test_spine_gives_reading_order_and_skips_non_linear_and_toc_documents(epub_report):
+    with zipfile.ZipFile(io.BytesIO(build_spine_epub())) as zip_ref:
+        spine_items = epub_report.read_epub_spine(zip_ref)
+
+    assert spine_items == [
+        {'file': 'OEBPS/text/one.xhtml', 'idref': 'ch1', 'spine_index': 3, 'cfi_base': "/6/8[ch1]"},
+        {'file': 'OEBPS/text/two b.xhtml', 'idref': 'ch2', 'spine_index': 4, 'cfi_base': "/6/10[ch2]"},
+        {'file': 'OEBPS/text/three.xhtml', 'idref': 'ch3', 'spine_index': 6, 'cfi_base': "/6/14[ch3]"},
+    ]
+
+
+def test_chapters_are_extracted_in_spine_order(epub_report):
+    chapters = extracted_chapters(epub_report, build_spine_epub(), extraction_mode='serial')
+    assert chapters == [('OEBPS/text/one.xhtml', "First chapter."), ('OEBPS/text/two b.xhtml', "Second chapter."),
+                        ('OEBPS/text/three.xhtml', "Third chapter.")]
+
+
+def test_book_without_an_opf_falls_back_to_archive_order(epub_report):
+    epub_bytes = build_spine_epub(with_opf=False)
+    with zipfile.ZipFile(io.BytesIO(epub_bytes)) as zip_ref:
+        assert epub_report.read_epub_spine(zip_ref) is None
+
+    assert [file_name for file_name, _ in extracted_chapters(epub_report, epub_bytes, extraction_mode='serial')] == [
+        'OEBPS/text/three.xhtml', 'OEBPS/text/two b.xhtml', 'OEBPS/text/one.xhtml', 'OEBPS/text/contents.xhtml',
+        'OEBPS/text/cover.xhtml', 'OEBPS/nav.xhtml'] # Only file names named "toc" are recognizable without a spine
+
+
+class InlinePool:
+    """Extraction pool stand-in that runs work in this process, or fails every member like a broken pool."""
+
+    def __init__(self, broken: bool = False):
+        self.broken = broken
+        self.submitted = 0
+        self.shut_down = False
+
+    def submit(self, fn, *args):
+        self.submitted += 1
+        future = Future()
+        if self.broken:
+            future.set_exception(BrokenProcessPool("A process in the process pool was terminated abruptly."))
+        else:
+            future.set_result(fn(*args))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+
+def test_broken_extraction_pool_is_replaced_without_losing_chapters(epub_report, monkeypatch):
+    epub_bytes = build_synthetic_epub(chapters=5, paragraphs_per_chapter=2)
+    broken_pool, fresh_pool = InlinePool(broken=True), InlinePool()
+    monkeypatch.setattr(epub_report, '_extraction_pool', broken_pool)
+    monkeypatch.setattr(epub_report, 'ProcessPoolExecutor', lambda **kwargs: fresh_pool)
+
+    with zipfile.ZipFile(io.BytesIO(epub_bytes)) as zip_ref:
+        results = list(epub_report._extract_members_in_pool(
+            epub_report._read_chapter_members(zip_ref), epub_report.HTML_EXTRACTOR_BACKEND, workers=1))
+
+    assert [(chapter['file'], chapter['text']) for _, chapter, _ in results] == [
+        (chapter['file'], chapter['text']) for chapter in epub_report.iter_epub_chapters(io.BytesIO(epub_bytes), extraction_mode='serial')]
+    assert broken_pool.shut_down
+    assert broken_pool.submitted == 2 # Members already in flight when the failure surfaced
+    assert fresh_pool.submitted == 3 and not fresh_pool.shut_down
+    assert epub_report._extraction_pool is fresh_pool
+
+
+# --- Request packing ---
+def chapter_of(index: int, tokens: int) -> dict:
+    """A chapter whose estimated size is `tokens`."""
+    return {'index': index, 'file': f'ch{index}.xhtml', 'text': "x" * ((tokens - 1) * 4)}
+
+
+def packed_indexes(requests) -> list:
+    return [[segment['chapter_index'] for segment in packed['segments']] for packed in requests]
+
+
+def test_small_chapters_are_packed_up_to_the_token_budget(epub_report):
+    chapters = [chapter_of(i, 30) for i in range(5)]
+    assert all(epub_report.estimate_tokens(chapter['text']) == 30 for chapter in chapters)
+
+    requests = list(epub_report.pack_chapter_requests(chapters, token_budget=100, small_chapter_tokens=40))
+
+    assert packed_indexes(requests) == [[0, 1, 2], [3, 4]]
+    for packed in requests:
+        assert sum(epub_report.estimate_tokens(segment['text']) for segment in packed['segments']) <= 100
+
+
+def test_larger_chapters_are_sent_alone_and_keep_reading_order(epub_report):
+    chapters = [chapter_of(0, 30), chapter_of(1, 30), chapter_of(2, 80), chapter_of(3, 30)]
+
+    requests = list(epub_report.pack_chapter_requests(chapters, token_budget=100, small_chapter_tokens=40))
+
+    assert packed_indexes(requests) == [[0, 1], [2], [3]]
+    assert all(segment['part_count'] == 1 for packed in requests for segment in packed['segments'])
+
+
+def test_chapters_over_the_budget_are_split_into_parts(epub_report):
+    text = " ".join(f"Sentence number {i} ends here." for i in range(60))
+    chapter = {'index': 7, 'file': 'ch7.xhtml', 'text': text}
+
+    requests = list(epub_report.pack_chapter_requests([chapter], token_budget=50, small_chapter_tokens=10))
+
+    segments = [packed['segments'][0] for packed in requests]
+    assert len(segments) > 1 and all(len(packed['segments']) == 1 for packed in requests)
+    assert [segment['part'] for segment in segments] == list(range(len(segments)))
+    assert {segment['part_count'] for segment in segments} == {len(segments)}
+    for segment in segments:
+        assert len(segment['text']) <= 50 * epub_report.CHARS_PER_TOKEN_ESTIMATE
+        assert text[segment['offset']:segment['offset'] + len(segment['text'])] == segment['text']
+    assert all(segment['text'].endswith("ends here.") for segment in segments) # Cut after sentences
+    assert " ".join(segment['text'] for segment in segments) == text
+
+
+def test_split_falls_back_to_whitespace_then_to_a_hard_cut(epub_report):
+    text = " ".join(f"word{i}" for i in range(100)) # No sentence ends
+    parts = epub_report.split_chapter_text(text, 64)
+    assert all(len(part) <= 64 for _, part in parts)
+    assert " ".join(part for _, part in parts) == text # No word was cut in two
+
+    unbroken = "x" * 150
+    assert epub_report.split_chapter_text(unbroken, 64) == [(0, "x" * 64), (64, "x" * 64), (128, "x" * 22)]
+    assert epub_report.split_chapter_text("Short.", 64) == [(0, "Short.")]
+
+
+def test_sections_are_assigned_back_to_their_chapters(epub_report):
+    segments = [
+        {'text': "The first chapter is about a storm at sea."},
+        {'text': "The second chapter has a fight in the tavern and then"},
+        {'text': "a long walk home through the rain."},
+    ]
+    sections = [
+        {'segment': 2, 'text': "a fight in the tavern"},
+        {'segment': "1", 'text': "a storm at sea"},
+        {'segment': 9, 'text': "a long walk home"}, # Invalid number: found by its text
+        {'text': "a fight in the tavern and then a long walk home"}, # Straddles two chapters: belongs where it starts
+        {'segment': None, 'text': "not in any chapter"},
+    ]
+
+    assigned = epub_report.assign_sections_to_segments(sections, segments)
+
+    assert [[section['text'] for section in chapter_sections] for chapter_sections in assigned] == [
+        ["a storm at sea", "not in any chapter"],
+        ["a fight in the tavern", "a fight in the tavern and then a long walk home"],
+        ["a long walk home"],
+    ]
+    assert all('segment' not in section for chapter_sections in assigned for section in chapter_sections)
+
+
+# --- Chapter result cache ---
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_chapter_cache_entries_expire_after_the_ttl(epub_report):
+    clock = FakeClock()
+    cache = epub_report.ChapterResultCache(10, ttl_seconds=60, clock=clock)
+    cache.put('a', [{'text': "storm"}])
+
+    clock.now += 59.9
+    assert cache.get('a') == [{'text': "storm"}]
+    clock.now += 0.1
+    assert cache.get('a') is None
+    assert len(cache) == 0 # Dropped on the read that found it expired
+
+
+def test_chapter_cache_evicts_the_least_recently_used_entry(epub_report):
+    cache = epub_report.ChapterResultCache(3, ttl_seconds=60, clock=FakeClock())
+    for key in 'abc':
+        cache.put(key, [{'text': key}])
+    cache.get('a') # Now the most recently used
+    cache.put('d', [])
+
+    assert len(cache) == 3
+    assert cache.get('b') is None
+    assert [cache.get(key) for key in 'acd'] == [[{'text': 'a'}], [{'text': 'c'}], []]
+
+
+def test_chapter_cache_returns_copies(epub_report):
+    cache = epub_report.ChapterResultCache(10, ttl_seconds=60, clock=FakeClock())
+    sections = [{'text': "storm"}]
+    cache.put('a', sections)
+    sections[0]['text'] = "changed"
+    cache.get('a')[0]['text'] = "changed again"
+    assert cache.get('a') == [{'text': "storm"}]
+
+
+class RecordingSupabase:
+    """Supabase client stand-in that records upserted reports."""
+
+    def __init__(self):
+        self.reports = []
+
+    def table(self, name):
+        return self
+
+    def upsert(self, data, on_conflict=None):
+        self.reports.append(data)
+        return self
+
+    def execute(self):
+        return self.reports[-1], None
+
+
+def test_chapter_cache_hits_and_misses_are_reported(epub_report, fake_model, firestore_fake, small_epub, monkeypatch):
+    supabase = RecordingSupabase()
+    monkeypatch.setattr(epub_report, 'supabase', supabase)
+    monkeypatch.setattr(epub_report, 'supabase_initialized', True)
+    monkeypatch.setattr(epub_report, 'db', firestore_fake)
+    monkeypatch.setattr(epub_report, 'firebase_initialized', True)
+    monkeypatch.setattr(epub_report, 'BUILD_FILTER_ARTIFACT', False)
+
+    epub_report.process_epub_from_bytes(small_epub, 'cache-1', None, None)
+    requests_sent = fake_model.calls
+    epub_report.process_epub_from_bytes(small_epub, 'cache-2', None, None) # Same chapters, new job
+
+    assert fake_model.calls == requests_sent # Every chapter came from the cache
+    assert firestore_fake.documents['epub_process_status/cache-1']['chapter_cache'] == {'hits': 0, 'misses': 3}
+    assert firestore_fake.documents['epub_process_status/cache-2']['chapter_cache'] == {'hits': 3, 'misses': 0}
+    metrics = [json.loads(report['processing_metrics'])['chapter_cache'] for report in supabase.reports]
+    assert metrics == [{'hits': 0, 'misses': 3}, {'hits': 3, 'misses': 0}]
+
+
+# --- Pre-screen and the whole-book cache key ---
+def test_prescreen_is_off_by_default(epub_report):
+    assert epub_report.PRESCREEN_THRESHOLD == 0
+    assert epub_report.chapter_needs_analysis("A quiet chapter about the weather.")
+
+
+def test_book_cache_key_changes_with_prescreen_settings(epub_report, small_epub, monkeypatch):
+    keys = {epub_report.compute_book_cache_key(small_epub)}
+    monkeypatch.setattr(epub_report, 'PRESCREEN_THRESHOLD', 2.0)
+    keys.add(epub_report.compute_book_cache_key(small_epub))
+    monkeypatch.setattr(epub_report, 'PRESCREEN_THRESHOLD', 3.0)
+    keys.add(epub_report.compute_book_cache_key(small_epub))
+    monkeypatch.setattr(epub_report, 'PRESCREEN_LEXICON_DIGEST', 'edited-lexicon')
+    keys.add(epub_report.compute_book_cache_key(small_epub))
+
+    assert len(keys) == 4
+
+
+def test_book_cache_key_changes_with_profanity_lexicon(epub_report, small_epub, monkeypatch):
+    default_key = epub_report.compute_book_cache_key(small_epub)
+    monkeypatch.setattr(epub_report, 'profanity_counter', ProfanityCounter(['darn']))
+
+    assert epub_report.compute_book_cache_key(small_epub) != default_key
+
+
+@pytest.mark.parametrize('setting, value', [
+    ('GEMINI_REQUEST_TOKEN_BUDGET', 4000),
+    ('SMALL_CHAPTER_TOKENS', 500),
+    ('MIN_CHAPTER_CHARS', 200),
+    ('BUILD_FILTER_ARTIFACT', False),
+])
+def test_book_cache_key_changes_with_extraction_and_packing_settings(epub_report, small_epub, monkeypatch, setting, value):
+    default_key = epub_report.compute_book_cache_key(small_epub)
+    assert getattr(epub_report, setting) != value
+    monkeypatch.setattr(epub_report, setting, value)
+
+    assert epub_report.compute_book_cache_key(small_epub) != default_key
+
+
+def test_sqlite_book_cache_evicts_the_oldest_entries(epub_report, tmp_path):
+    cache = epub_report.SQLiteBookResultCache(str(tmp_path / 'books.sqlite3'), max_entries=3)
+    for n in range(5):
+        cache.put(f'book-{n}', {'result': n})
+
+    assert len(cache) == 3
+    assert cache.get('book-0') is None and cache.get('book-1') is None
+    assert [cache.get(f'book-{n}') for n in (2, 3, 4)] == [{'result': 2}, {'result': 3}, {'result': 4}]
+
+    cache.put('book-2', {'result': 'again'}) # Rewriting an entry makes it the newest
+    cache.put('book-5', {'result': 5})
+    assert cache.get('book-3') is None
+    assert cache.get('book-2') == {'result': 'again'}
+
+
+def test_book_cache_uses_the_shared_supabase_table(epub_report, monkeypatch):
+    monkeypatch.setattr(epub_report, 'BOOK_CACHE_BACKEND', 'supabase')
+    monkeypatch.setattr(epub_report, 'supabase', object())
+    monkeypatch.setattr(epub_report, 'supabase_initialized', True)
+
+    assert isinstance(epub_report.init_book_result_cache(), epub_report.SupabaseBookResultCache)
+
+
+# --- Section anchoring ---
+ANCHOR_CHAPTER_TEXT = (
+    "The morning was quiet and grey. She walked down to the harbour and waited for the ferry.\n\n"
+    "He kissed her slowly, his hands in her hair, and pulled her close against the wall of the old boathouse "
+    "while the rain drummed on the roof above them.\n\n"
+    "Later they ate breakfast in silence and watched the boats come in."
+)
+ANCHOR_PASSAGE = (
+    "He kissed her slowly, his hands in her hair, and pulled her close against the wall of the old boathouse "
+    "while the rain drummed on the roof above them."
+)
+
+
+def test_exact_section_text_gets_its_offsets(epub_report):
+    anchored, = epub_report.anchor_flagged_sections('ch1.xhtml', ANCHOR_CHAPTER_TEXT, [{'text': ANCHOR_PASSAGE}])
+
+    assert anchored['match_method'] == epub_report.ANCHOR_METHOD_EXACT
+    assert anchored['match_confidence'] == 1.0
+    assert anchored['start_offset'] == ANCHOR_CHAPTER_TEXT.index("He kissed")
+    assert ANCHOR_CHAPTER_TEXT[anchored['start_offset']:anchored['end_offset']] == ANCHOR_PASSAGE
+    assert anchored['file'] == 'ch1.xhtml'
+
+
+def test_paraphrased_section_text_is_placed_fuzzily(epub_report):
+    # Gemini's copy drops punctuation and rewords the end
+    quoted = "He kissed her slowly his hands in her hair and pulled her close against the old boathouse wall"
+
+    anchored, = epub_report.anchor_flagged_sections('ch1.xhtml', ANCHOR_CHAPTER_TEXT, [{'text': quoted}])
+
+    assert anchored['match_method'] == epub_report.ANCHOR_METHOD_FUZZY
+    assert epub_report.SECTION_ANCHOR_MIN_CONFIDENCE <= anchored['match_confidence'] < 1.0
+    assert ANCHOR_CHAPTER_TEXT[anchored['start_offset']:anchored['end_offset']].startswith("He kissed her slowly, his hands")
+    assert anchored['text'] == quoted # Full-text sections keep Gemini's text
+    assert 'needs_requery' not in anchored
+
+
+def test_section_text_not_in_the_chapter_is_unmatched(epub_report):
+    sections = [{'text': "The dragon landed on the castle tower and breathed fire over the sleeping city below."}]
+
+    anchored, = epub_report.anchor_flagged_sections('ch1.xhtml', ANCHOR_CHAPTER_TEXT, sections)
+
+    assert anchored['match_method'] == epub_report.ANCHOR_METHOD_UNMATCHED
+    assert anchored['start_offset'] is None and anchored['end_offset'] is None
+    assert anchored['needs_requery'] is True
+    assert epub_report.flagged_section_length(anchored) == len(sections[0]['text'])
+
+
+def test_anchor_snippets_rebuild_section_text(epub_report):
+    sections = [{'chapter': "Chapter 1", 'start': "He kissed her slowly, his hands in her hair,",
+                 'end': "while the rain drummed on the roof above them."}]
+
+    anchored, = epub_report.anchor_flagged_sections('ch1.xhtml', ANCHOR_CHAPTER_TEXT, sections)
+
+    assert anchored['match_method'] == epub_report.ANCHOR_METHOD_EXACT
+    assert anchored['text'] == ANCHOR_PASSAGE
+    assert ANCHOR_CHAPTER_TEXT[anchored['start_offset']:anchored['end_offset']] == anchored['text']
+
+
+def test_fuzzy_anchor_snippets_rebuild_section_text_from_the_chapter(epub_report):
+    # Gemini's copy differs in punctuation and drops a word; the rebuilt text comes from the chapter, not the snippet
+    sections = [{'start': "He kissed her slowly his hands in hair, and pulled her close",
+                 'end': "the rain drummed on the roof above them"}]
+
+    anchored, = epub_report.anchor_flagged_sections('ch1.xhtml', ANCHOR_CHAPTER_TEXT, sections)
+
+    assert anchored['match_method'] == epub_report.ANCHOR_METHOD_FUZZY
+    assert anchored['text'].startswith("He kissed her slowly, his hands in her hair")
+    assert anchored['text'] == ANCHOR_CHAPTER_TEXT[anchored['start_offset']:anchored['end_offset']]
+    assert 'needs_requery' not in anchored
+
+
+def test_unmatched_anchor_snippets_keep_no_text(epub_report):
+    sections = [{'start': "Nothing like this appears anywhere", 'end': "in the chapter at all, not even close"}]
+
+    anchored, = epub_report.anchor_flagged_sections('ch1.xhtml', ANCHOR_CHAPTER_TEXT, sections)
+
+    assert anchored['match_method'] == epub_report.ANCHOR_METHOD_UNMATCHED
+    assert anchored['needs_requery'] is True
+    assert 'text' not in anchored
+
+
+# --- Prompt versions and the filter model ---
+class RecordingFactory:
+    """Model or cache factory that records its keyword arguments and returns (or raises) a fixed result."""
+
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.error:
+            raise self.error
+        return self.result if self.result is not None else object()
+
+
+def prompt_text(messages) -> str:
+    return "".join(part['text'] for message in messages for part in message['parts'])
+
+
+def test_user_turn_prompt_inlines_the_instructions(epub_report, fake_model, monkeypatch):
+    monkeypatch.setattr(epub_report, 'PROMPT_VERSION', 'v1')
+    instructions = epub_report.PROMPT_VERSION_REGISTRY['v1']['instructions']
+
+    assert instructions in prompt_text(epub_report.build_prompt("Chapter one."))
+    assert epub_report.filter_model() is fake_model # The shared model; no per-version model needed
+
+
+def test_system_instruction_prompt_sends_only_the_chapter(epub_report, monkeypatch):
+    monkeypatch.setattr(epub_report, 'PROMPT_VERSION', 'v2')
+    model_factory = RecordingFactory()
+    monkeypatch.setattr(epub_report, 'filter_models', epub_report.FilterModelProvider(model_factory))
+    instructions = epub_report.PROMPT_VERSION_REGISTRY['v2']['instructions']
+
+    text = prompt_text(epub_report.build_prompt("Chapter one."))
+    assert "Chapter one." in text and instructions not in text
+    assert epub_report.filter_model() is epub_report.filter_model() # Built once per version
+    assert model_factory.calls == [{'model_name': epub_report.MODEL, 'system_instruction': instructions}]
+
+
+def test_registering_a_version_again_must_not_change_its_text(epub_report, monkeypatch):
+    monkeypatch.setattr(epub_report, 'PROMPT_VERSION_REGISTRY', dict(epub_report.PROMPT_VERSION_REGISTRY))
+    v2 = epub_report.PROMPT_VERSION_REGISTRY['v2']
+
+    epub_report.register_prompt_version('v2', v2['instructions'], v2['output_mode'], v2['placement']) # Same text: fine
+    with pytest.raises(ValueError, match="v2"):
+        epub_report.register_prompt_version('v2', v2['instructions'] + " Also flag mild language.", v2['output_mode'], v2['placement'])
+    assert epub_report.PROMPT_VERSION_REGISTRY['v2'] == v2
+
+    epub_report.register_prompt_version('v3', "New instructions.", 'full_text', epub_report.PROMPT_PLACEMENT_SYSTEM)
+    assert epub_report.find_prompt_version('full_text', epub_report.PROMPT_PLACEMENT_SYSTEM) == 'v2' # First match wins
+    assert epub_report.prompt_version_info('v3')['instructions_sha256'] != v2['instructions_sha256']
+
+
+def test_refused_context_cache_falls_back_to_a_system_instruction_model(epub_report):
+    model_factory = RecordingFactory()
+    cache_factory = RecordingFactory(error=google_exceptions.InvalidArgument("Cached content is too small"))
+    cached_model_factory = RecordingFactory()
+    provider = epub_report.FilterModelProvider(model_factory, cache_factory, cached_model_factory)
+
+    first = provider.get('v2')
+    assert provider.get('v2') is first
+    assert len(cache_factory.calls) == 1 and cached_model_factory.calls == []
+    assert model_factory.calls[0]['system_instruction'] == epub_report.PROMPT_VERSION_REGISTRY['v2']['instructions']
+    assert provider.caches_created == 0
+
+    provider.get('v2-anchors') # Other versions still try the cache
+    assert len(cache_factory.calls) == 2
+
+
+def test_cached_model_is_rebuilt_before_the_cache_expires(epub_report):
+    cached_model_factory = RecordingFactory()
+    provider = epub_report.FilterModelProvider(RecordingFactory(), RecordingFactory(result='cache-handle'), cached_model_factory,
+                                               cache_ttl_seconds=60) # Shorter than the refresh margin: rebuilt on every get
+
+    provider.get('v2')
+    provider.get('v2')
+
+    assert provider.caches_created == 2
+    assert cached_model_factory.calls == [{'cached_content': 'cache-handle'}] * 2
+
+
+# --- Streaming responses ---
+def flag_opening_words(contents):
+    """FakeGeminiModel response that flags the first words of the chapter it was sent."""
+    text = "".join(part['text'] for message in contents for part in message['parts'])
+    chapter_text = text.split('Chapter:', 1)[-1].strip().strip('"').strip()
+    return json.dumps({'sections': [{'chapter': "Chapter", 'text': " ".join(chapter_text.split()[:12]), 'summary': "opening"}]})
+
+
+@pytest.mark.parametrize('accept, mimetype', [('application/x-ndjson', 'application/x-ndjson'), ('text/event-stream', 'text/event-stream')])
+def test_streamed_events_end_with_the_regular_response(epub_report, fake_model, small_epub, monkeypatch, accept, mimetype):
+    monkeypatch.setattr(epub_report, 'SMALL_CHAPTER_TOKENS', 1) # One request, and one chapter event, per chapter
+    monkeypatch.setattr(epub_report, 'BUILD_FILTER_ARTIFACT', False)
+    fake_model.respond = flag_opening_words
+    app = Flask(__name__)
+    app.add_url_rule('/', 'epub_report', lambda: epub_report.epub_report(request), methods=['POST'])
+    client = app.test_client()
+
+    expected = client.post('/', data=small_epub, headers={'X-Job-ID': 'plain-1'}).get_json()
+    response = client.post('/', data=small_epub, headers={'X-Job-ID': 'stream-1', 'Accept': accept})
+    body = response.get_data(as_text=True)
+    if mimetype == 'text/event-stream':
+        blocks = [block.split('\n') for block in body.strip().split('\n\n')]
+        assert all(lines[0] == f"event: {json.loads(lines[1][len('data: '):])['type']}" for lines in blocks)
+        events = [json.loads(lines[1][len('data: '):]) for lines in blocks]
+    else:
+        events = [json.loads(line) for line in body.splitlines()]
+
+    assert (response.status_code, response.mimetype) == (200, mimetype)
+    assert [event['type'] for event in events] == ['chapter'] * 3 + ['summary']
+    chapter_events = events[:-1]
+    assert sorted(event['chapterIndex'] for event in chapter_events) == [0, 1, 2]
+    assert [event['chaptersProcessed'] for event in chapter_events] == [1, 2, 3]
+    assert all(len(event['flaggedSections']) == 1 and event['job_id'] == 'stream-1' for event in chapter_events)
+    summary = dict(events[-1], job_id='plain-1')
+    del summary['type']
+    assert expected['affectedChapterCount'] == 3
+    assert summary == expected
+
+
+# --- Gemini rate limiting ---
+RATE_LIMITS = {'requests': 60, 'tokens': 6000} # One request and 100 tokens per second
+
+
+def test_bucket_takes_until_the_request_limit_and_refills(epub_report):
+    states = {}
+    for _ in range(60):
+        states, wait_seconds = epub_report._take_from_buckets(states, {'requests': 1, 'tokens': 10}, RATE_LIMITS, 100.0)
+        assert wait_seconds == 0
+
+    unchanged, wait_seconds = epub_report._take_from_buckets(states, {'requests': 1, 'tokens': 10}, RATE_LIMITS, 100.0)
+    assert wait_seconds == pytest.approx(1.0)
+    assert unchanged['requests'][0] == pytest.approx(0.0)
+
+    states, wait_seconds = epub_report._take_from_buckets(states, {'requests': 1, 'tokens': 10}, RATE_LIMITS, 101.0)
+    assert wait_seconds == 0 # One second refilled one request
+
+
+def test_bucket_waits_for_tokens_and_takes_all_or_nothing(epub_report):
+    states, wait_seconds = epub_report._take_from_buckets({}, {'requests': 1, 'tokens': 5000}, RATE_LIMITS, 0.0)
+    assert wait_seconds == 0
+
+    after_wait, wait_seconds = epub_report._take_from_buckets(states, {'requests': 1, 'tokens': 2000}, RATE_LIMITS, 0.0)
+    assert wait_seconds == pytest.approx(10.0) # 1000 tokens short at 100 tokens/second
+    assert after_wait['requests'][0] == pytest.approx(59.0) # The request was not taken either
+
+
+def test_bucket_clamps_an_oversized_take_to_a_full_bucket(epub_report):
+    states, _ = epub_report._take_from_buckets({}, {'requests': 1, 'tokens': 3000}, RATE_LIMITS, 0.0)
+
+    _, wait_seconds = epub_report._take_from_buckets(states, {'requests': 1, 'tokens': 50000}, RATE_LIMITS, 0.0)
+    assert wait_seconds == pytest.approx(30.0) # Waits until the bucket is full again, not forever
+    states, wait_seconds = epub_report._take_from_buckets(states, {'requests': 1, 'tokens': 50000}, RATE_LIMITS, 30.0)
+    assert wait_seconds == 0
+    assert states['tokens'][0] == pytest.approx(0.0)
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'firestore'])
+def rate_limit_backend(request, epub_report, tmp_path, firestore_fake):
+    if request.param == 'memory':
+        return epub_report.InMemoryRateLimitBackend()
+    if request.param == 'sqlite':
+        return epub_report.SQLiteRateLimitBackend(str(tmp_path / 'rate_limit.sqlite3'))
+    return epub_report.FirestoreRateLimitBackend(firestore_fake, shards=1)
+
+
+def test_backend_enforces_the_request_limit(rate_limit_backend):
+    limits = {'requests': 3, 'tokens': 1000}
+    assert [rate_limit_backend.try_take({'requests': 1, 'tokens': 10}, limits) for _ in range(3)] == [0, 0, 0]
+
+    wait_seconds = rate_limit_backend.try_take({'requests': 1, 'tokens': 10}, limits)
+    assert 19 < wait_seconds <= 20 # One request per 20 seconds
+
+
+def test_backend_enforces_the_token_limit(rate_limit_backend):
+    limits = {'requests': 100, 'tokens': 600}
+    assert rate_limit_backend.try_take({'requests': 1, 'tokens': 500}, limits) == 0
+
+    wait_seconds = rate_limit_backend.try_take({'requests': 1, 'tokens': 200}, limits)
+    assert 9 < wait_seconds <= 10 # 100 tokens short at 10 tokens/second
+
+
+def test_sqlite_backend_does_not_write_a_failed_take(epub_report, tmp_path):
+    backend = epub_report.SQLiteRateLimitBackend(str(tmp_path / 'rate_limit.sqlite3'))
+    limits = {'requests': 1, 'tokens': 1000}
+    backend.try_take({'requests': 1, 'tokens': 10}, limits)
+    stored = backend._conn.execute("SELECT name, level, updated_at FROM rate_limit_buckets ORDER BY name").fetchall()
+
+    assert backend.try_take({'requests': 1, 'tokens': 10}, limits) > 0
+    assert backend._conn.execute("SELECT name, level, updated_at FROM rate_limit_buckets ORDER BY name").fetchall() == stored
+
+
+def test_firestore_backend_spreads_takes_over_shards_and_skips_failed_writes(epub_report, firestore_fake):
+    backend = epub_report.FirestoreRateLimitBackend(firestore_fake, shards=2)
+    limits = {'requests': 2, 'tokens': 1000} # One request per shard
+
+    assert backend.try_take({'requests': 1, 'tokens': 10}, limits) == 0
+    assert backend.try_take({'requests': 1, 'tokens': 10}, limits) == 0 # The first shard tried may be empty: tries the other
+    assert sorted(firestore_fake.documents) == ['gemini_rate_limits/gemini-0', 'gemini_rate_limits/gemini-1']
+    writes = firestore_fake.writes
+
+    assert backend.try_take({'requests': 1, 'tokens': 10}, limits) > 0
+    assert firestore_fake.writes == writes
+
+
+def test_rate_limiter_waits_for_capacity(epub_report):
+    limiter = epub_report.GeminiRateLimiter(epub_report.InMemoryRateLimitBackend(), 600, 100000) # 10 requests/second
+    for _ in range(600):
+        assert limiter.acquire(10) == 0
+
+    started = time.monotonic()
+    waited = limiter.acquire(10)
+    assert 0.05 < waited <= 0.1
+    assert time.monotonic() - started >= 0.05
+    assert asyncio.run(limiter.acquire_async(10)) > 0
+
+
+class FlakyRateLimitBackend:
+    blocking = False
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.calls = 0
+
+    def try_take(self, amounts, limits_per_minute):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError("contention: too much contention on these documents")
+        return 0.0
+
+
+def test_rate_limiter_fail_open_is_counted(epub_report, capsys):
+    limiter = epub_report.GeminiRateLimiter(FlakyRateLimitBackend(failures=1), 60, 1000, fail_open=True)
+    job_counters = epub_report.JobCounters()
+
+    assert limiter.acquire(10, job_counters) == 0
+
+    assert limiter.backend_errors == 1
+    assert job_counters.get('rate_limit_backend_errors') == 1
+    assert "fail-open" in capsys.readouterr().out
+
+
+def test_rate_limiter_fail_closed_waits_and_retries(epub_report):
+    backend = FlakyRateLimitBackend(failures=2)
+    limiter = epub_report.GeminiRateLimiter(backend, 60, 1000, fail_open=False, error_retry_seconds=0.01)
+    job_counters = epub_report.JobCounters()
+
+    waited = asyncio.run(limiter.acquire_async(10, job_counters))
+
+    assert waited == pytest.approx(0.02)
+    assert backend.calls == 3
+    assert job_counters.get('rate_limit_backend_errors') == 2
+
+
+# --- Async Gemini dispatch ---
+GEMINI_MESSAGES = [{'role': 'user', 'parts': [{'text': "Chapter text"}]}]
+
+
+def test_deadline_covers_the_wait_for_a_concurrency_slot(epub_report, fake_model):
+    async def send_while_slot_is_busy():
+        limiter = epub_report.AdaptiveConcurrencyLimiter(1, 1, 1, 30)
+
+        async def hold_slot():
+            async with limiter.slot() as slot:
+                slot.abandon() # Keep this holder's outcome out of the limiter's counts
+                await asyncio.sleep(0.2)
+        holder = asyncio.ensure_future(hold_slot())
+        await asyncio.sleep(0)
+        result = await epub_report.send_prompt_to_gemini_async(GEMINI_MESSAGES, 'ch1.xhtml', 'job-1', limiter,
+                                                               deadline_seconds=0.05)
+        await holder
+        return result, limiter
+
+    result, limiter = asyncio.run(send_while_slot_is_busy())
+
+    assert result is None
+    assert fake_model.calls == 0 # Not sent with a stale (pre-wait) timeout
+    assert limiter.in_flight == 0 and limiter._healthy_in_window == 0 # Slot released, no outcome counted
+
+
+def test_deadline_covers_the_rate_limiter_wait(epub_report, fake_model, monkeypatch):
+    class SlowRateLimiter:
+        async def acquire_async(self, tokens, job_counters=None):
+            await asyncio.sleep(0.1)
+            return 0.1
+    monkeypatch.setattr(epub_report, 'gemini_rate_limiter', SlowRateLimiter())
+    limiter = epub_report.AdaptiveConcurrencyLimiter(1, 1, 1, 30)
+
+    result = asyncio.run(epub_report.send_prompt_to_gemini_async(GEMINI_MESSAGES, 'ch1.xhtml', 'job-1', limiter,
+                                                                 deadline_seconds=0.05))
+
+    assert result is None
+    assert fake_model.calls == 0
+
+
+def test_request_within_its_deadline_is_sent(epub_report, fake_model):
+    limiter = epub_report.AdaptiveConcurrencyLimiter(1, 1, 1, 30)
+
+    result = asyncio.run(epub_report.send_prompt_to_gemini_async(GEMINI_MESSAGES, 'ch1.xhtml', 'job-1', limiter,
+                                                                 deadline_seconds=5))
+
+    assert result == []
+    assert fake_model.calls == 1
+
+
+# --- Adaptive concurrency ---
+async def run_through_limiter(limiter, requests: int, error: Exception = None) -> None:
+    """Sends requests through the limiter at once; each holds its slot briefly and then succeeds or raises error."""
+    async def one_request(n):
+        async with limiter.slot():
+            await asyncio.sleep(0.002 * (1 + n % 3))
+            if error is not None:
+                raise error
+    await asyncio.gather(*(one_request(n) for n in range(requests)), return_exceptions=True)
+
+
+def test_limiter_backs_off_once_per_burst_of_429s(epub_report):
+    limiter = epub_report.AdaptiveConcurrencyLimiter(8, 1, 32, 10)
+
+    asyncio.run(run_through_limiter(limiter, 8, google_exceptions.ResourceExhausted("429 Quota exceeded")))
+    assert limiter.limit == int(8 * epub_report.CONCURRENCY_DECREASE_FACTOR)
+
+    asyncio.run(run_through_limiter(limiter, 6, RuntimeError("HTTP 429 Too Many Requests")))
+    assert limiter.limit == int(6 * epub_report.CONCURRENCY_DECREASE_FACTOR)
+    assert limiter.in_flight == 0
+
+
+def test_limiter_ignores_errors_that_are_not_overload(epub_report):
+    limiter = epub_report.AdaptiveConcurrencyLimiter(8, 1, 32, 10)
+    asyncio.run(run_through_limiter(limiter, 8, ValueError("Malformed JSON")))
+    assert limiter.limit == 8
+
+
+def test_limiter_recovers_after_backing_off(epub_report):
+    limiter = epub_report.AdaptiveConcurrencyLimiter(8, 1, 32, 10)
+    asyncio.run(run_through_limiter(limiter, 8, google_exceptions.ResourceExhausted("429 Quota exceeded")))
+    backed_off = limiter.limit
+
+    asyncio.run(run_through_limiter(limiter, 300))
+
+    assert limiter.limit > backed_off
+    assert limiter.peak_limit == limiter.limit <= limiter.maximum
+
+
+def test_limiter_does_not_grow_past_its_maximum(epub_report):
+    limiter = epub_report.AdaptiveConcurrencyLimiter(2, 1, 3, 10)
+    asyncio.run(run_through_limiter(limiter, 300))
+    assert limiter.limit == 3
+
+
+class ConcurrencyQuota:
+    """Simulated Gemini quota: a request fails with 429 if more than `quota` requests are in flight when it ends.
+
+    Requests take a fixed number of event loop turns instead of wall-clock time, so a run is deterministic.
+    """
+
+    def __init__(self, quota: int):
+        self.quota = quota
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.rejected = 0
+
+    async def request(self, turns: int) -> None:
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            for _ in range(turns):
+                await asyncio.sleep(0)
+            if self.in_flight > self.quota:
+                self.rejected += 1
+                raise google_exceptions.ResourceExhausted("429 Quota exceeded (simulated)")
+        finally:
+            self.in_flight -= 1
+
+
+def run_against_quota(limiter, quota: ConcurrencyQuota, requests: int) -> list:
+    """Sends requests through the limiter; returns the limit seen as each one finished."""
+    limits = []
+
+    async def one_request(n):
+        async with limiter.slot():
+            await quota.request(3 + n % 4)
+        limits.append(limiter.limit)
+
+    async def run_all():
+        await asyncio.gather(*(one_request(n) for n in range(requests)), return_exceptions=True)
+    asyncio.run(run_all())
+    return limits
+
+
+@pytest.mark.parametrize('initial', [1, 4])
+def test_limiter_converges_on_a_concurrency_quota_with_one_step_of_overshoot(epub_report, initial):
+    quota = ConcurrencyQuota(10)
+    limiter = epub_report.AdaptiveConcurrencyLimiter(initial, 1, 40, 10)
+
+    limits = run_against_quota(limiter, quota, 800)
+
+    assert limiter.peak_limit == quota.peak_in_flight == 11 # Probing finds the quota by exceeding it by one
+    assert quota.rejected <= 16 # A few per probe: under 2% of the requests
+    steady_state = limits[len(limits) // 2:]
+    assert int(epub_report.CONCURRENCY_DECREASE_FACTOR * 11) <= min(steady_state) and max(steady_state) <= 11
+
+
+def test_limiter_starting_above_the_quota_backs_off_to_it(epub_report):
+    quota = ConcurrencyQuota(10)
+    limiter = epub_report.AdaptiveConcurrencyLimiter(30, 1, 40, 10)
+
+    limits = run_against_quota(limiter, quota, 800)
+
+    assert limiter.peak_limit == 30 # The initial limit
+    steady_state = limits[len(limits) // 2:]
+    assert int(epub_report.CONCURRENCY_DECREASE_FACTOR * 11) <= min(steady_state) and max(steady_state) <= 11
+    assert limiter.in_flight == 0
+
+
+# --- Gemini circuit breaker ---
+def open_breaker(epub_report, monkeypatch):
+    breaker = epub_report.GeminiCircuitBreaker(failure_threshold=1, cooldown_seconds=0.01)
+    monkeypatch.setattr(epub_report, 'gemini_circuit_breaker', breaker)
+    breaker.record_failure()
+    time.sleep(0.02) # Cooldown over: the next call is the half-open probe
+    return breaker
+
+
+def test_cancelled_half_open_probe_lets_the_next_probe_through(epub_report, fake_model, monkeypatch):
+    breaker = open_breaker(epub_report, monkeypatch)
+
+    async def run_and_cancel_probe():
+        probe_started = asyncio.Event()
+
+        async def hang(contents, **kwargs):
+            probe_started.set()
+            await asyncio.Event().wait()
+        monkeypatch.setattr(fake_model, 'generate_content_async', hang)
+        limiter = epub_report.AdaptiveConcurrencyLimiter(1, 1, 1, 30)
+        messages = [{'role': 'user', 'parts': [{'text': "Chapter text"}]}]
+        probe = asyncio.ensure_future(epub_report.send_prompt_to_gemini_async(messages, 'ch1.xhtml', 'job-1', limiter))
+        await probe_started.wait()
+        assert not breaker.allow_request() # Only one probe at a time
+        probe.cancel() # As AsyncGeminiDispatcher.__exit__ or an outer wait_for would
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+    asyncio.run(run_and_cancel_probe())
+    assert breaker.allow_request()
+
+
+def test_abandoning_a_finished_probe_does_not_release_a_newer_one(epub_report, monkeypatch):
+    breaker = open_breaker(epub_report, monkeypatch)
+    first_probe = breaker.admit()
+    breaker.record_failure() # First probe failed: open again
+    time.sleep(0.02)
+    second_probe = breaker.admit()
+    assert second_probe and second_probe != first_probe
+
+    breaker.abandon_probe(first_probe)
+    breaker.abandon_probe(0) # A call made while the breaker was closed
+
+    assert breaker.admit() is None # The second probe is still the only one in flight
@@ -0,0 +1,218 @@
+"""Tests for get_epub_status against the in-memory Firestore fake (see firestore_fake.py)."""
+import contextlib
+import importlib
+import io
+import threading
+import time
+
+import firebase_admin
+import pytest
+from firebase_admin import firestore
+from flask import Flask, request
+
+
+@pytest.fixture
+def get_epub_status(monkeypatch, firestore_fake):
+    monkeypatch.setattr(firebase_admin, '_apps', {'[DEFAULT]': object()}) # Skip initialize_app at import
+    monkeypatch.setattr(firestore, 'client', lambda *args, **kwargs: firestore_fake)
+    with contextlib.redirect_stdout(io.StringIO()):
+        module = importlib.import_module('get_epub_status')
+    monkeypatch.setattr(module, 'db', firestore_fake)
+    monkeypatch.setattr(module, 'status_cache', module.StatusCache(module.STATUS_CACHE_TTL_SECONDS))
+    monkeypatch.setattr(module, '_watchers', {})
+    monkeypatch.setattr(module, 'STATUS_STREAM_HEARTBEAT_SECONDS', 0.2)
+    return module
+
+
+@pytest.fixture
+def client(get_epub_status):
+    app = Flask(__name__)
+    app.add_url_rule('/status', 'status', lambda: get_epub_status.get_epub_status(request), methods=['GET', 'POST'])
+    app.add_url_rule('/stream', 'stream', lambda: get_epub_status.stream_epub_status(request))
+    return app.test_client()
+
+
+def status_document(firestore_fake, job_id):
+    return firestore_fake.collection('epub_process_status').document(job_id)
+
+
+def wait_until(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.01)
+
+
+# --- Polling ---
+def test_matching_etag_gets_304(client, firestore_fake):
+    status_document(firestore_fake, 'job-1').set({'status': 'processing', 'progress': 5})
+
+    response = client.get('/status?job_id=job-1')
+    assert response.status_code == 200
+    assert response.get_json()['progress'] == 5
+    etag = response.headers['ETag']
+
+    not_modified = client.get('/status?job_id=job-1', headers={'If-None-Match': etag})
+    assert not_modified.status_code == 304
+    assert not_modified.headers['ETag'] == etag
+
+
+def test_etag_changes_with_the_status(client, firestore_fake, get_epub_status, monkeypatch):
+    monkeypatch.setattr(get_epub_status, 'status_cache', get_epub_status.StatusCache(0))
+    document = status_document(firestore_fake, 'job-1')
+    document.set({'status': 'processing', 'progress': 5})
+    etag = client.get('/status?job_id=job-1').headers['ETag']
+
+    document.update({'progress': 6})
+    response = client.get('/status?job_id=job-1', headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert response.get_json()['progress'] == 6
+    assert response.headers['ETag'] != etag
+
+
+def test_polls_within_the_cache_ttl_share_one_read(client, firestore_fake):
+    status_document(firestore_fake, 'job-1').set({'status': 'processing', 'progress': 5})
+    for _ in range(10):
+        assert client.get('/status?job_id=job-1').status_code == 200
+    assert firestore_fake.reads == 1
+
+
+def test_long_poll_times_out_with_304(client, firestore_fake):
+    status_document(firestore_fake, 'job-1').set({'status': 'processing', 'progress': 5})
+    etag = client.get('/status?job_id=job-1').headers['ETag']
+
+    started = time.monotonic()
+    response = client.get('/status?job_id=job-1&wait=0.5', headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert 0.4 <= time.monotonic() - started < 3
+    assert firestore_fake.active_watches('epub_process_status/job-1') == 0
+
+
+def test_long_poll_wakes_up_on_change(client, firestore_fake):
+    document = status_document(firestore_fake, 'job-1')
+    document.set({'status': 'processing', 'progress': 5})
+    etag = client.get('/status?job_id=job-1').headers['ETag']
+    threading.Timer(0.3, lambda: document.update({'progress': 50})).start()
+
+    started = time.monotonic()
+    response = client.get('/status?job_id=job-1&wait=10', headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert response.get_json()['progress'] == 50
+    assert response.headers['ETag'] != etag
+    assert time.monotonic() - started < 5
+    assert firestore_fake.active_watches('epub_process_status/job-1') == 0
+
+
+def test_status_cache_drops_job_ids_nobody_polls_any_more(get_epub_status):
+    now = [0.0]
+    cache = get_epub_status.StatusCache(1.0, max_entries=100, clock=lambda: now[0])
+    for i in range(50):
+        cache.put(f'job-{i}', {'progress': i})
+    now[0] = 2.0
+    cache.put('job-new', {'progress': 0})
+
+    assert len(cache) == 1 # The expired entries were pruned without ever being read again
+    assert cache.get('job-new') == (True, {'progress': 0})
+    assert cache.get('job-0') == (False, None)
+
+
+def test_status_cache_keeps_at_most_max_entries(get_epub_status):
+    now = [0.0]
+    cache = get_epub_status.StatusCache(60.0, max_entries=3, clock=lambda: now[0])
+    for i in range(5):
+        now[0] += 0.1
+        cache.put(f'job-{i}', {'progress': i})
+    cache.put('job-2', {'progress': 20}) # Rewritten: now the newest
+
+    assert len(cache) == 3
+    assert [cache.get(f'job-{i}')[0] for i in range(5)] == [False, False, True, True, True]
+    assert cache.get('job-2') == (True, {'progress': 20})
+    now[0] += 61.0
+    assert cache.get('job-4') == (False, None) # And entries still expire on read
+
+
+def test_batch_status_reads_every_job_in_one_round_trip(client, firestore_fake):
+    for i in range(3):
+        status_document(firestore_fake, f'job-{i}').set({'status': 'processing', 'progress': i * 10, 'chapter_cache': {'hits': 1}})
+
+    response = client.post('/status', json={'job_ids': ['job-0', 'missing', 'job-1', 'job-2', 'job-0']})
+
+    assert response.status_code == 200
+    jobs = response.get_json()['jobs']
+    assert sorted(jobs) == ['job-0', 'job-1', 'job-2', 'missing'] # Duplicates collapsed
+    assert jobs['missing'] == {'status': 'not_found'} # Inline, without failing the batch
+    assert jobs['job-2'] == {'status': 'processing', 'progress': 20} # Compact: no chapter_cache
+    assert firestore_fake.get_all_calls == 1 and firestore_fake.reads == 4
+
+    client.get('/status?job_ids=job-0,job-1,missing') # Within the cache TTL: no Firestore round trip
+    assert firestore_fake.get_all_calls == 1
+
+
+def test_batch_status_rejects_too_many_job_ids(client, firestore_fake, get_epub_status):
+    job_ids = [f'job-{i}' for i in range(get_epub_status.MAX_BATCH_JOB_IDS + 1)]
+    assert get_epub_status.MAX_BATCH_JOB_IDS == 300
+
+    response = client.post('/status', json={'job_ids': job_ids})
+
+    assert response.status_code == 400
+    assert "300" in response.get_json()['error']
+    assert firestore_fake.get_all_calls == 0
+    assert client.post('/status', json={'job_ids': job_ids[:-1]}).status_code == 200
+    assert client.post('/status', json={'job_ids': []}).status_code == 400
+
+
+def test_unknown_job_is_404(client):
+    assert client.get('/status?job_id=missing').status_code == 404
+
+
+# --- Server-Sent Events ---
+def read_stream(client, path, results, index):
+    response = client.get(path, buffered=False)
+    results[index] = (response.status_code, response.mimetype, b''.join(response.response).decode())
+
+
+def test_concurrent_streams_share_one_listener(client, firestore_fake, get_epub_status):
+    document = status_document(firestore_fake, 'job-1')
+    document.set({'status': 'processing', 'progress': 0})
+    results = {}
+    readers = [threading.Thread(target=read_stream, args=(client, '/stream?job_id=job-1', results, i)) for i in range(3)]
+    for reader in readers:
+        reader.start()
+    wait_until(lambda: 'job-1' in get_epub_status._watchers and get_epub_status._watchers['job-1'].subscribers == 3)
+
+    document.update({'progress': 60})
+    time.sleep(0.1)
+    document.update({'status': 'completed', 'progress': 100})
+    for reader in readers:
+        reader.join(5)
+
+    assert firestore_fake.listeners_started == 1
+    assert len(results) == 3
+    for status_code, mimetype, body in results.values():
+        assert (status_code, mimetype) == (200, 'text/event-stream')
+        assert body.count('event: status') >= 2
+        assert '"progress": 100' in body
+        assert body.rstrip().endswith('data: {"job_id": "job-1", "status": "completed"}')
+    assert get_epub_status._watchers == {}
+    assert firestore_fake.active_watches('epub_process_status/job-1') == 0
+
+
+def test_listener_is_closed_when_the_last_client_disconnects(client, firestore_fake, get_epub_status):
+    status_document(firestore_fake, 'job-1').set({'status': 'processing', 'progress': 0})
+    first = client.get('/stream?job_id=job-1', buffered=False)
+    second = client.get('/stream?job_id=job-1', buffered=False)
+    first_events, second_events = iter(first.response), iter(second.response)
+    assert b'event: status' in next(first_events) # Generators start (and subscribe) on first read
+    assert b'event: status' in next(second_events)
+    assert firestore_fake.listeners_started == 1
+
+    first.close()
+    assert get_epub_status._watchers['job-1'].subscribers == 1
+    assert firestore_fake.active_watches('epub_process_status/job-1') == 1
+
+    second.close()
+    assert get_epub_status._watchers == {}
+    assert firestore_fake.active_watches('epub_process_status/job-1') == 0
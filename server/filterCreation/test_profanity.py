@@ -0,0 +1,38 @@
+"""Tests for profanity (no fixtures needed: the module has no service setup)."""
+import profanity
+
+
+def test_counts_tokens_with_punctuation_removed():
+    counter = profanity.ProfanityCounter(profanity.SWEAR_WORDS)
+    assert counter.count('"Damn!" said the ass-hole. What the hell\'s going on, f.u.c.k') == {
+        'damn': 1, 'asshole': 1, 'fuck': 1}
+
+
+def test_scan_offsets_exclude_surrounding_punctuation():
+    text = 'Well, "damn!"'
+    offsets = profanity.ProfanityCounter(['damn']).scan(text)
+    (start, end), = offsets['damn']
+    assert text[start:end] == 'damn'
+
+
+def test_lexicon_file_replaces_the_built_in_words(tmp_path):
+    lexicon = tmp_path / 'lexicon.txt'
+    lexicon.write_text("# Custom list\nDarn\nheck # mild\n\n", encoding='utf-8')
+
+    counter = profanity.init_profanity_counter(str(lexicon))
+
+    assert counter.words == {'darn', 'heck'}
+    assert counter.count("Darn it, what the heck, damn.") == {'darn': 1, 'heck': 1}
+
+
+def test_unreadable_lexicon_falls_back_to_the_built_in_words(tmp_path, capsys):
+    counter = profanity.init_profanity_counter(str(tmp_path / 'missing.txt'))
+
+    assert counter.words == profanity.ProfanityCounter(profanity.SWEAR_WORDS).words
+    assert "Using the built-in word list" in capsys.readouterr().out
+
+
+def test_lexicon_digest_tracks_the_word_list():
+    assert (profanity.ProfanityCounter(['darn', 'heck']).lexicon_digest
+            == profanity.ProfanityCounter(['Heck', 'darn']).lexicon_digest
+            != profanity.ProfanityCounter(['darn']).lexicon_digest)
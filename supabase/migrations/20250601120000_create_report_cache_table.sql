@@ -0,0 +1,25 @@
+-- Create the report_cache table (whole-book result cache for epub_report)
+CREATE TABLE public.report_cache (
+    cache_key TEXT PRIMARY KEY,
+    entry JSONB NOT NULL,
+    model TEXT,
+    prompt_version TEXT,
+    created_at TIMESTAMPTZ DEFAULT timezone('utc'::text, now()) NOT NULL
+);
+
+-- Add comments to describe the columns
+COMMENT ON COLUMN public.report_cache.cache_key IS 'SHA-256 of the uploaded EPUB bytes combined with the Gemini model and prompt version.';
+COMMENT ON COLUMN public.report_cache.entry IS 'Cached final result payload and report fields for the book.';
+COMMENT ON COLUMN public.report_cache.model IS 'Gemini model version that produced the cached result.';
+COMMENT ON COLUMN public.report_cache.prompt_version IS 'Prompt version that produced the cached result.';
+COMMENT ON COLUMN public.report_cache.created_at IS 'Timestamp of cache entry creation.';
+
+-- Enable Row Level Security (RLS)
+ALTER TABLE public.report_cache ENABLE ROW LEVEL SECURITY;
+
+-- Only backend functions (service_role) read and write the cache.
+CREATE POLICY "Allow full access for service_role" ON public.report_cache
+FOR ALL
+TO service_role
+USING (true)
+WITH CHECK (true);
@@ -0,0 +1,5 @@
+-- Add processing metrics (cache hit/miss counts and other per-job counters) to reports
+ALTER TABLE public.reports
+ADD COLUMN processing_metrics JSONB NULL;
+
+COMMENT ON COLUMN public.reports.processing_metrics IS 'JSON object with per-job processing counters, e.g. book and chapter cache hits/misses.';
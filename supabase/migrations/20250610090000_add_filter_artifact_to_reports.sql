@@ -0,0 +1,5 @@
+-- Add the precomputed per-book filter artifact (hide ranges and word hits per spine item) to reports
+ALTER TABLE public.reports
+ADD COLUMN filter_artifact JSONB NULL;
+
+COMMENT ON COLUMN public.reports.filter_artifact IS 'Versioned JSON filter artifact: per spine item, sorted non-overlapping hide ranges and word hits as chapter text offsets plus EPUB CFI ranges.';